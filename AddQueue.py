@@ -0,0 +1,195 @@
+from typing import Callable, NamedTuple, Optional
+from JSONtools import atomic_write
+import logging, asyncio, time, json, os
+log = logging.getLogger('queue')
+
+class PendingAdd(NamedTuple):
+    playlist: str
+    uri: str
+    queued: float
+    on_failure: Optional[Callable[[], None]]
+    spooled: bool = False
+
+# collects track URIs for a short window (or until a batch fills up) and
+# sends them to Spotify in as few playlist_add_items calls as possible.
+# batches that fail for transient reasons (throttling, outages, an open
+# circuit breaker) are written to a spool file and replayed later, so a
+# track that made it into the local record always reaches the playlist.
+# a batch that timed out may have landed anyway, so replays first drop
+# whatever the playlist already has rather than adding it twice.
+# when shards share state, the spool lives there instead of in a file.
+class AddQueue:
+    max_items: int = 100 # spotify's limit per playlist_add_items call
+
+    def __init__(self, sp, window: float = 1.0, max_batch: int = 100, spool_file: Optional[str] = None,
+                 replay_delay: float = 30.0, shared = None, spool_key: str = 'spool') -> None:
+        self.sp = sp
+        self.window = window
+        self.max_batch = max_batch
+        self.spool_file = spool_file
+        self.replay_delay = replay_delay
+        self.shared = shared
+        self.spool_key = spool_key
+        self.pending: list[PendingAdd] = []
+        self.inflight: list[PendingAdd] = []
+        self.spool: list[PendingAdd] = []
+        self.replay_handle: Optional[asyncio.TimerHandle] = None
+        self.wake = asyncio.Event()
+        self.full = asyncio.Event()
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.landed = asyncio.Condition() # notified after every batch, for per-playlist drains
+        self.task: Optional[asyncio.Task] = None
+        # exposed for monitoring
+        self.sent: int = 0
+        self.failed: int = 0
+        self.batches: int = 0
+        self.flush_latency: float = 0.0 # seconds from the oldest item being queued to its batch landing
+        if self.shared is not None:
+            lines = self.shared.load_list(self.spool_key)
+        elif self.spool_file is not None and os.path.exists(self.spool_file):
+            with open(self.spool_file, 'r', encoding='utf-8') as spool:
+                lines = spool.readlines()
+        else:
+            lines = []
+        self.spool = [PendingAdd(item['playlist'], item['uri'], time.monotonic(), None, True)
+                      for item in map(json.loads, lines) if item]
+        if self.spool:
+            log.warning(f'Loaded {len(self.spool)} spooled adds from {self.spool_key if self.shared else self.spool_file}')
+
+    @property
+    def depth(self) -> int:
+        return len(self.pending)
+
+    def stats(self) -> dict[str, float]:
+        return {'depth': self.depth, 'spooled': len(self.spool), 'sent': self.sent, 'failed': self.failed,
+                'batches': self.batches, 'flush_latency': self.flush_latency}
+
+    def put(self, playlist: str, uri: str, on_failure: Optional[Callable[[], None]] = None) -> None:
+        self.enqueue([PendingAdd(playlist, uri, time.monotonic(), on_failure)])
+
+    def enqueue(self, items: list[PendingAdd]) -> None:
+        self.pending.extend(items)
+        self.idle.clear()
+        self.wake.set()
+        if len(self.pending) >= self.max_batch:
+            self.full.set()
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def resume(self) -> None:
+        # replay anything left in the spool by a previous run
+        if self.spool:
+            self.schedule_replay(0)
+
+    async def run(self) -> None:
+        while True:
+            await self.wake.wait()
+            # give more links a chance to arrive, unless the batch is already full
+            try:
+                await asyncio.wait_for(self.full.wait(), self.window)
+            except asyncio.TimeoutError:
+                pass
+            batch, self.pending = self.pending[:self.max_batch], self.pending[self.max_batch:]
+            # a burst bigger than one batch goes out back to back
+            if len(self.pending) < self.max_batch:
+                self.full.clear()
+            if not self.pending:
+                self.wake.clear()
+            await self.flush(batch)
+            if not self.pending:
+                self.idle.set()
+            async with self.landed:
+                self.landed.notify_all()
+
+    async def flush(self, batch: list[PendingAdd]) -> None:
+        self.inflight = list(batch)
+        by_playlist: dict[str, list[PendingAdd]] = {}
+        for item in batch:
+            by_playlist.setdefault(item.playlist, []).append(item)
+        for playlist, items in by_playlist.items():
+            for i in range(0, len(items), self.max_items):
+                await self.send(playlist, items[i:i + self.max_items])
+        self.inflight = []
+
+    async def send(self, playlist: str, items: list[PendingAdd]) -> None:
+        uris = [item.uri for item in items]
+        try:
+            if any(item.spooled for item in items):
+                present = await self.sp.get_playlist_uris(playlist)
+                if present.intersection(uris):
+                    log.info(f'{len(present.intersection(uris))} spooled tracks for {playlist} had already landed')
+                uris = [uri for uri in uris if uri not in present]
+            if uris:
+                await self.sp.add(uris, playlist)
+        except Exception as e:
+            self.inflight = [item for item in self.inflight if item not in items]
+            if self.sp.is_transient(e):
+                log.warning(f'Holding {len(uris)} tracks for {playlist} until Spotify recovers: {e!r}')
+                self.hold(items)
+            else:
+                # spotify rejected the batch outright, so let each item undo its local record
+                log.error(f'Dropping {len(uris)} tracks for {playlist}: {e!r}')
+                self.failed += len(items)
+                for item in items:
+                    if item.on_failure is not None:
+                        item.on_failure()
+                if any(item.spooled for item in items):
+                    self.save_spool()
+            return
+        self.inflight = [item for item in self.inflight if item not in items]
+        self.sent += len(items)
+        self.batches += 1
+        self.flush_latency = time.monotonic() - min(item.queued for item in items)
+        if any(item.spooled for item in items):
+            self.save_spool()
+        log.debug(f'Added {len(uris)} tracks to {playlist}, {self.depth} still queued, {self.flush_latency:.2f}s flush latency')
+
+    def hold(self, items: list[PendingAdd]) -> None:
+        # local records stay put; the items are replayed once the breaker lets calls through
+        self.spool += [item._replace(spooled=True) for item in items]
+        self.save_spool()
+        self.schedule_replay(max(self.sp.breaker.retry_in(), self.replay_delay))
+
+    def schedule_replay(self, delay: float) -> None:
+        if self.replay_handle is None:
+            self.replay_handle = asyncio.get_running_loop().call_later(delay, self.replay)
+
+    def replay(self) -> None:
+        self.replay_handle = None
+        if not self.spool:
+            return
+        log.info(f'Replaying {len(self.spool)} spooled adds')
+        items, self.spool = self.spool, []
+        self.enqueue(items)
+
+    def save_spool(self) -> None:
+        # everything not yet confirmed by spotify: waiting, replayed-but-queued and in flight
+        durable = self.spool + [item for item in self.pending + self.inflight if item.spooled]
+        lines = [json.dumps({'playlist': item.playlist, 'uri': item.uri}) for item in durable]
+        if self.shared is not None:
+            self.shared.save_list(self.spool_key, lines)
+        elif self.spool_file is not None:
+            atomic_write(self.spool_file, ''.join(line + '\n' for line in lines))
+
+    def held(self, playlist: str) -> set[str]:
+        # uris for this playlist that spotify hasn't confirmed yet
+        return set(item.uri for item in self.pending + self.inflight + self.spool if item.playlist == playlist)
+
+    def holds(self, playlist: str) -> bool:
+        # whether anything for this playlist is still waiting, in flight or spooled
+        return any(item.playlist == playlist for item in self.pending + self.inflight + self.spool)
+
+    async def drain(self, playlist: Optional[str] = None) -> None:
+        if playlist is None:
+            await self.idle.wait()
+            return
+        # spooled items only land once spotify recovers, so don't wait on those here
+        async with self.landed:
+            await self.landed.wait_for(lambda: not any(item.playlist == playlist for item in self.pending + self.inflight))
+
+    def close(self) -> None:
+        if self.replay_handle is not None:
+            self.replay_handle.cancel()
+        if self.task is not None:
+            self.task.cancel()
@@ -0,0 +1,156 @@
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from typing import Iterable, Optional
+from Rankings import RankingIndex
+
+DAY = 86400
+
+# every track posted in a channel across all months, as parallel columns
+# (user, track, time) sorted by time, so a date range is two bisects and
+# the queries below are a single pass over a slice of machine ints. users
+# and tracks are dictionary encoded; a rolled back row keeps its place
+# with its user set to -1.
+class HistoryIndex:
+    def __init__(self) -> None:
+        self.users = array('q')
+        self.tracks = array('q')
+        self.times = array('q')
+        self.user_ids: list[int] = []
+        self.user_codes: dict[int, int] = {}
+        self.track_ids: list[str] = []
+        self.track_codes: dict[str, int] = {}
+        self.rows_by_user: dict[int, array] = {} # user code -> row numbers, ascending
+        self.artists: dict[int, str] = {} # track code -> artist, filled in by whoever has the metadata
+        self.size: int = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def add(self, uid: int, track_id: str, when: int) -> None:
+        # rows arrive in posting order; a clock that steps back a little
+        # shouldn't break the sort, so clamp to the latest time seen
+        if self.times and when < self.times[-1]:
+            when = self.times[-1]
+        user = self.user_codes.get(uid)
+        if user is None:
+            user = self.user_codes[uid] = len(self.user_ids)
+            self.user_ids.append(uid)
+            self.rows_by_user[user] = array('q')
+        track = self.track_codes.get(track_id)
+        if track is None:
+            track = self.track_codes[track_id] = len(self.track_ids)
+            self.track_ids.append(track_id)
+        self.rows_by_user[user].append(len(self.times))
+        self.users.append(user)
+        self.tracks.append(track)
+        self.times.append(when)
+        self.size += 1
+
+    def remove(self, uid: int, track_id: str) -> bool:
+        user, track = self.user_codes.get(uid), self.track_codes.get(track_id)
+        if user is None or track is None:
+            return False
+        rows = self.rows_by_user[user]
+        # rollbacks come shortly after the add, so search from the end
+        for i in range(len(rows) - 1, -1, -1):
+            if self.tracks[rows[i]] == track:
+                self.users[rows[i]] = -1
+                del rows[i]
+                self.size -= 1
+                return True
+        return False
+
+    def span(self, start: Optional[int] = None, end: Optional[int] = None) -> tuple[int, int]:
+        lo = 0 if start is None else bisect_left(self.times, start)
+        hi = len(self.times) if end is None else bisect_left(self.times, end)
+        return lo, hi
+
+    def user_rows(self, uid: int, start: Optional[int] = None, end: Optional[int] = None) -> array:
+        rows = self.rows_by_user.get(self.user_codes.get(uid), array('q'))
+        lo, hi = self.span(start, end)
+        return rows[bisect_left(rows, lo):bisect_left(rows, hi)]
+
+    def totals(self, start: Optional[int] = None, end: Optional[int] = None) -> dict[int, int]:
+        lo, hi = self.span(start, end)
+        counts = Counter(self.users[lo:hi])
+        counts.pop(-1, None)
+        return {self.user_ids[user]: count for user, count in counts.items()}
+
+    def rankings(self, start: Optional[int] = None, end: Optional[int] = None) -> RankingIndex:
+        # a leaderboard for any date range, in the same shape as the live ones
+        lo, hi = self.span(start, end)
+        counts = Counter(self.users[lo:hi])
+        counts.pop(-1, None)
+        last = {}
+        for row in range(hi - 1, lo - 1, -1):
+            user = self.users[row]
+            if user >= 0 and user not in last:
+                last[user] = row
+                if len(last) == len(counts):
+                    break
+        return RankingIndex.from_rows((self.user_ids[user], count, self.track_ids[self.tracks[last[user]]], self.times[last[user]])
+                                      for user, count in counts.items())
+
+    def track_counts(self, start: Optional[int] = None, end: Optional[int] = None) -> Counter:
+        lo, hi = self.span(start, end)
+        counts = Counter(track for user, track in zip(self.users[lo:hi], self.tracks[lo:hi]) if user >= 0)
+        return Counter({self.track_ids[track]: count for track, count in counts.items()})
+
+    def missing_artists(self, start: Optional[int] = None, end: Optional[int] = None) -> list[str]:
+        lo, hi = self.span(start, end)
+        return [self.track_ids[track] for track in set(self.tracks[lo:hi]) if track not in self.artists]
+
+    def set_artist(self, track_id: str, artist: str) -> None:
+        self.artists[self.track_codes[track_id]] = artist
+
+    def set_artists(self, artists: dict[str, str]) -> None:
+        # track -> artist, for any of those tracks that are in the index
+        for track_id, track in self.track_codes.items():
+            artist = artists.get(track_id)
+            if artist is not None:
+                self.artists[track] = artist
+
+    def top_artists(self, n: int = 10, start: Optional[int] = None, end: Optional[int] = None) -> list[tuple[str, int]]:
+        # only counts tracks whose artist has been filled in, see missing_artists
+        lo, hi = self.span(start, end)
+        artists = self.artists
+        counts = Counter(artists[track] for user, track in zip(self.users[lo:hi], self.tracks[lo:hi])
+                         if user >= 0 and track in artists)
+        return counts.most_common(n)
+
+    def heatmap(self, uid: Optional[int] = None, start: Optional[int] = None, end: Optional[int] = None) -> list[list[int]]:
+        # posts per UTC weekday (monday first) and hour
+        if uid is None:
+            lo, hi = self.span(start, end)
+            times = (when for user, when in zip(self.users[lo:hi], self.times[lo:hi]) if user >= 0)
+        else:
+            times = (self.times[row] for row in self.user_rows(uid, start, end))
+        grid = [[0] * 24 for _ in range(7)]
+        for when in times:
+            # the epoch was a thursday
+            grid[(when // DAY + 3) % 7][when % DAY // 3600] += 1
+        return grid
+
+    def streak(self, uid: int, now: int) -> tuple[int, int]:
+        # (longest, current) runs of consecutive UTC days with a post
+        days = sorted(set(self.times[row] // DAY for row in self.rows_by_user.get(self.user_codes.get(uid), ())))
+        longest = run = 0
+        for i, day in enumerate(days):
+            run = run + 1 if i and day == days[i - 1] + 1 else 1
+            longest = max(longest, run)
+        # today's streak is still alive if they posted yesterday
+        current = run if days and days[-1] >= now // DAY - 1 else 0
+        return longest, current
+
+    def streaks(self, now: int) -> list[tuple[int, int, int]]:
+        out = [(uid, *self.streak(uid, now)) for uid in self.user_ids if self.rows_by_user[self.user_codes[uid]]]
+        return sorted(out, key=lambda s: (-s[1], -s[2], s[0]))
+
+    @staticmethod
+    def from_rows(rows: Iterable[tuple[int, str, int]]) -> 'HistoryIndex':
+        # rows of (uid, track, time) in any order
+        index = HistoryIndex()
+        for uid, track_id, when in sorted(rows, key=lambda r: r[2]):
+            index.add(uid, track_id, when)
+        return index
@@ -0,0 +1,184 @@
+from array import array
+from types import TracebackType
+from typing import Iterator, Optional, Type
+import logging, mmap, os, struct, sys, zlib
+log = logging.getLogger('archive')
+
+HEADER = struct.Struct('<8sIIIq32s') # magic, version, rows, distinct tracks, creation time, playlist
+SECTION = struct.Struct('<QQQ') # offset, stored size, raw size
+MAGIC = b'SPOTARCH'
+SUFFIX = '.arc'
+# users, index into the track table and time of every row, then the table itself
+COLUMNS = (('users', 'q'), ('tracks', 'I'), ('times', 'q'))
+
+# a closed month as columns instead of indented JSON: one row per track,
+# sorted by user and then time, with the track IDs dictionary-encoded into a
+# sorted table. each column is zlib-compressed on its own (or stored as is
+# at level 0) and read straight out of the memory-mapped file, so opening an
+# archive costs nothing and a query only inflates the columns it uses.
+# stored columns are memoryviews over the map itself, and any column can be
+# handed to numpy.frombuffer without a copy.
+class MonthArchive:
+    def __init__(self, file_name: str) -> None:
+        self.file = file_name
+        with open(self.file, 'rb') as archive_file:
+            magic, version, self.rows, self.size, self.creation_time, playlist = HEADER.unpack(archive_file.read(HEADER.size))
+            if magic != MAGIC or version != 1:
+                raise ValueError(f'{self.file} is not a playlist archive')
+            self.sections = [SECTION.unpack(archive_file.read(SECTION.size)) for _ in range(len(COLUMNS) + 1)]
+            self.mm = mmap.mmap(archive_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.playlist: str = playlist.rstrip(b'\0').decode()
+        self.columns: dict[str, memoryview] = {}
+        self.views: list[memoryview] = [] # released on close, or the map can't be
+        self.table: Optional[list[str]] = None
+
+    def __enter__(self) -> 'MonthArchive':
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return self.rows
+
+    def section(self, idx: int) -> memoryview:
+        offset, stored, raw = self.sections[idx]
+        view = memoryview(self.mm)[offset:offset + stored]
+        self.views.append(view)
+        if stored == raw:
+            return view
+        return memoryview(zlib.decompress(view, bufsize=raw))
+
+    def column(self, name: str) -> memoryview:
+        if name not in self.columns:
+            idx, typecode = next((i, typecode) for i, (column, typecode) in enumerate(COLUMNS) if column == name)
+            data = self.section(idx)
+            if sys.byteorder != 'little':
+                data = array(typecode, data)
+                data.byteswap()
+                data = memoryview(data)
+            column = data.cast('B').cast(typecode)
+            self.views.append(column)
+            self.columns[name] = column
+        return self.columns[name]
+
+    def track_table(self) -> list[str]:
+        if self.table is None:
+            text = bytes(self.section(len(COLUMNS))).decode()
+            self.table = text.split('\n') if text else []
+        return self.table
+
+    def __iter__(self) -> Iterator[tuple[int, str, int]]:
+        # (user, track, time) rows
+        table = self.track_table()
+        return ((uid, table[idx], when) for uid, idx, when in
+                zip(self.column('users'), self.column('tracks'), self.column('times')))
+
+    def as_dict(self) -> dict:
+        # the layout of a monthly JSON file, for anything that reads those
+        cur_dict = {'playlist': self.playlist, 'creation_time': self.creation_time}
+        table = self.track_table()
+        users, tracks, times = self.column('users').tolist(), self.column('tracks').tolist(), self.column('times').tolist()
+        start = 0
+        while start < len(users):
+            uid = users[start]
+            end = start + 1
+            while end < len(users) and users[end] == uid:
+                end += 1
+            cur_dict[uid] = {'tracks': [table[idx] for idx in tracks[start:end]], 'times': times[start:end]}
+            start = end
+        return cur_dict
+
+    def close(self) -> None:
+        for view in reversed(self.views):
+            view.release()
+        self.views.clear()
+        self.columns.clear()
+        self.mm.close()
+
+    @staticmethod
+    def path_for(file_name: str) -> str:
+        return os.path.splitext(file_name)[0] + SUFFIX
+
+    @staticmethod
+    def is_archive(file_name: str) -> bool:
+        return file_name.endswith(SUFFIX)
+
+    @staticmethod
+    def write(file_name: str, cur_dict: dict, level: int = 6) -> None:
+        # users' lists are already in time order, so sorting by user is enough
+        uids = sorted(uid for uid in cur_dict.keys() if type(uid) == int)
+        table = sorted(set(track for uid in uids for track in cur_dict[uid]['tracks']))
+        index = {track: idx for idx, track in enumerate(table)}
+        columns = [array('q', (uid for uid in uids for _ in cur_dict[uid]['tracks'])),
+                   array('I', (index[track] for uid in uids for track in cur_dict[uid]['tracks'])),
+                   array('q', (when for uid in uids for when in cur_dict[uid]['times']))]
+        if sys.byteorder != 'little':
+            for column in columns:
+                column.byteswap()
+        raw = [column.tobytes() for column in columns] + ['\n'.join(table).encode()]
+        stored = [data if level == 0 else zlib.compress(data, level) for data in raw]
+        offset = HEADER.size + SECTION.size * len(raw)
+        sections = []
+        for data, data_raw in zip(stored, raw):
+            sections.append(SECTION.pack(offset, len(data), len(data_raw)))
+            offset += len(data)
+        tmp = file_name + '.tmp'
+        with open(tmp, 'wb') as out_file:
+            out_file.write(HEADER.pack(MAGIC, 1, len(columns[0]), len(table), cur_dict['creation_time'],
+                                       cur_dict['playlist'].encode()))
+            out_file.write(b''.join(sections))
+            out_file.write(b''.join(stored))
+            out_file.flush()
+            os.fsync(out_file.fileno())
+        os.replace(tmp, file_name)
+
+    @staticmethod
+    def archive(file_name: str, level: int = 6, keep: bool = False) -> bool:
+        # converts a closed monthly JSON file (plus its event log) and checks the result before removing them
+        from JSONtools import EventLogStore
+        out = MonthArchive.path_for(file_name)
+        if os.path.exists(out):
+            log.info(f'{out} already exists, skipping')
+            return False
+        cur_dict = EventLogStore(file_name).load()
+        MonthArchive.write(out, cur_dict, level)
+        with MonthArchive(out) as archive:
+            if archive.as_dict() != {key: value for key, value in cur_dict.items() if key != 'seq'}:
+                os.remove(out)
+                raise ValueError(f'{out} does not match {file_name}')
+        before = sum(os.path.getsize(path) for path in (file_name, os.path.splitext(file_name)[0] + '.jsonl') if os.path.exists(path))
+        log.info(f'Archived {file_name} to {out}: {before} bytes down to {os.path.getsize(out)}')
+        if not keep:
+            for path in (file_name, os.path.splitext(file_name)[0] + '.jsonl'):
+                if os.path.exists(path):
+                    os.remove(path)
+        return True
+
+
+if __name__ == '__main__':
+    import argparse, glob, json, time
+    parser = argparse.ArgumentParser(prog = 'Archive.py', description='Convert closed monthly playlist JSON files to compressed archives.')
+    parser.add_argument('files', nargs='*', help='files to archive (default: closed months in playlist_data/*.json)')
+    parser.add_argument('-l', '--level', type = int, help ='zlib level, 0 stores columns uncompressed for zero-copy reads', default = 6)
+    parser.add_argument('-k', '--keep', action = 'store_true', help ='keep the JSON files after archiving')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    files = args.files
+    if not files:
+        # leave the live month (and any month staged ahead of it) alone
+        this_month = time.strftime('%Y-%m', time.gmtime())
+        try:
+            with open('playlist_data/.manifest', 'r', encoding='utf-8') as manifest_file:
+                live = json.load(manifest_file)['file']
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            live = None
+        files = [file_name for file_name in sorted(glob.glob('playlist_data/*.json'))
+                 if os.path.basename(file_name)[:7] < this_month and (live is None or not os.path.samefile(file_name, live))]
+    for file_name in files:
+        MonthArchive.archive(file_name, args.level, args.keep)
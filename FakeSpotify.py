@@ -0,0 +1,158 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from typing import Optional
+import logging, json, random, threading, time, uuid
+log = logging.getLogger('FAKE')
+
+# stand-in for the handful of Spotify Web API endpoints the bot uses, so the
+# real SpotifyHandler code path can be driven without a network connection.
+# point "spotify_api_url" in the config at http://host:port/v1/ to use it.
+class FakeSpotify(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port: int = 8080, latency: float = 0.0, jitter: float = 0.0, throttle_rate: float = 0.0,
+                 retry_after: int = 1, error_rate: float = 0.0, host: str = '127.0.0.1') -> None:
+        super().__init__((host, port), FakeSpotifyRequest)
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.error_rate = error_rate
+        self.user = 'fake-user'
+        self.playlists: dict[str, dict] = {}
+        self.lock = threading.Lock()
+        self.requests: dict[str, int] = {}
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/v1/'
+
+    def start(self) -> 'FakeSpotify':
+        self.thread = threading.Thread(target=self.serve_forever, name='fake-spotify', daemon=True)
+        self.thread.start()
+        log.info(f'Serving fake Spotify API on {self.url}')
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+    def snapshot(self, playlist: dict) -> str:
+        playlist['version'] += 1
+        return FakeSpotify.snapshot_id(playlist)
+
+    @staticmethod
+    def snapshot_id(playlist: dict) -> str:
+        return f"{playlist['id']}-{playlist['version']}"
+
+    def items(self, playlist: dict, offset: int = 0, limit: int = 100) -> dict:
+        # a paging object of playlist items, as from GET /playlists/{id}/tracks
+        items = [{'added_at': playlist['added'].get(uri), 'added_by': {'id': self.user},
+                  'track': {'id': uri.split(':')[-1], 'type': 'track', 'is_local': False}}
+                 for uri in playlist['tracks'][offset:offset + limit]]
+        more = offset + limit < len(playlist['tracks'])
+        return {'items': items, 'total': len(playlist['tracks']), 'offset': offset, 'limit': limit,
+                'next': f"{self.url}playlists/{playlist['id']}/tracks?offset={offset + limit}&limit={limit}" if more else None}
+
+    @staticmethod
+    def track(track_id: str) -> dict:
+        return {'id': track_id, 'name': f'Track {track_id}', 'uri': f'spotify:track:{track_id}',
+                'artists': [{'name': f'Artist {track_id[:4]}'}],
+                'external_urls': {'spotify': f'https://open.spotify.com/track/{track_id}'},
+                'album': {'name': f'Album {track_id[:6]}', 'images': [{'url': f'https://i.scdn.co/image/{track_id}'}]}}
+
+class FakeSpotifyRequest(BaseHTTPRequestHandler):
+    server: FakeSpotify
+
+    def log_message(self, format, *args) -> None:
+        log.debug(format % args)
+
+    def do_GET(self) -> None:
+        self.handle_request('GET')
+
+    def do_POST(self) -> None:
+        self.handle_request('POST')
+
+    def do_DELETE(self) -> None:
+        self.handle_request('DELETE')
+
+    def handle_request(self, method: str) -> None:
+        fake = self.server
+        url = urlsplit(self.path)
+        parts = [p for p in url.path.split('/') if p][1:] # drop the v1 prefix
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else {}
+        with fake.lock:
+            key = method + ' ' + (parts[0] if parts else '')
+            fake.requests[key] = fake.requests.get(key, 0) + 1
+        time.sleep(max(0.0, fake.latency + random.uniform(-fake.jitter, fake.jitter)))
+        if random.random() < fake.throttle_rate:
+            return self.reply(429, {'error': {'status': 429, 'message': 'API rate limit exceeded'}},
+                              {'Retry-After': str(fake.retry_after)})
+        if random.random() < fake.error_rate:
+            return self.reply(500, {'error': {'status': 500, 'message': 'Server error'}})
+
+        if method == 'GET' and parts == ['me']:
+            return self.reply(200, {'id': fake.user, 'display_name': 'Fake user'})
+        if method == 'GET' and parts == ['tracks']:
+            ids = parse_qs(url.query).get('ids', [''])[0].split(',')
+            return self.reply(200, {'tracks': [FakeSpotify.track(i) for i in ids if i]})
+        if method == 'POST' and len(parts) == 3 and parts[0] == 'users' and parts[2] == 'playlists':
+            playlist = {'id': uuid.uuid4().hex[:22], 'name': body.get('name'), 'description': body.get('description'),
+                        'tracks': [], 'added': {}, 'version': 0}
+            with fake.lock:
+                fake.playlists[playlist['id']] = playlist
+            return self.reply(201, {k: v for k, v in playlist.items() if k not in ('tracks', 'added', 'version')})
+        if len(parts) == 2 and parts[0] == 'playlists' and method == 'GET':
+            # the fields filter is ignored, the reply is already the filtered shape
+            with fake.lock:
+                playlist = fake.playlists.setdefault(parts[1], {'id': parts[1], 'name': parts[1], 'tracks': [], 'added': {}, 'version': 0})
+                return self.reply(200, {'snapshot_id': FakeSpotify.snapshot_id(playlist), 'tracks': fake.items(playlist)})
+        if len(parts) == 3 and parts[0] == 'playlists' and parts[2] == 'tracks':
+            with fake.lock:
+                playlist = fake.playlists.setdefault(parts[1], {'id': parts[1], 'name': parts[1], 'tracks': [], 'added': {}, 'version': 0})
+                if method == 'GET':
+                    query = parse_qs(url.query)
+                    offset, limit = int(query.get('offset', ['0'])[0]), int(query.get('limit', ['100'])[0])
+                    return self.reply(200, fake.items(playlist, offset, min(limit, 100)))
+                if method == 'POST':
+                    # spotipy sends a bare list of uris unless it also gives a position
+                    uris = body if isinstance(body, list) else body.get('uris', [])
+                    added_at = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+                    for uri in uris:
+                        playlist['added'].setdefault(uri, added_at)
+                    playlist['tracks'] += uris
+                    return self.reply(201, {'snapshot_id': fake.snapshot(playlist)})
+                if method == 'DELETE':
+                    gone = set(t['uri'] for t in body.get('tracks', []))
+                    playlist['tracks'] = [t for t in playlist['tracks'] if t not in gone]
+                    return self.reply(200, {'snapshot_id': fake.snapshot(playlist)})
+        return self.reply(404, {'error': {'status': 404, 'message': 'Not found'}})
+
+    def reply(self, status: int, payload: dict, headers: Optional[dict[str, str]] = None) -> None:
+        out = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(out)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(out)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(prog = 'FakeSpotify.py', description='Serve a local stand-in for the Spotify Web API.')
+    parser.add_argument('-p', '--port', type = int, help ='port to listen on', default = 8080)
+    parser.add_argument('--latency', type = float, help ='seconds added to every response', default = 0.0)
+    parser.add_argument('--jitter', type = float, help ='random +/- seconds on top of the latency', default = 0.0)
+    parser.add_argument('--throttle-rate', type = float, help ='fraction of requests answered with 429', default = 0.0)
+    parser.add_argument('--retry-after', type = int, help ='Retry-After seconds sent with a 429', default = 1)
+    parser.add_argument('--error-rate', type = float, help ='fraction of requests answered with 500', default = 0.0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    server = FakeSpotify(args.port, args.latency, args.jitter, args.throttle_rate, args.retry_after, args.error_rate)
+    log.info(f'Serving fake Spotify API on {server.url}')
+    server.serve_forever()
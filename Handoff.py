@@ -0,0 +1,82 @@
+from collections import deque
+from typing import Callable, Optional
+import logging, asyncio, heapq, itertools, time
+log = logging.getLogger('handoff')
+
+# matches links posted by other music bots to whoever asked for them. a
+# command for another bot leaves a waiter in its channel for `timeout`
+# seconds, and that bot's next link there goes to the oldest waiter (or the
+# one it replied to). every waiter's deadline sits in one heap, drained by
+# a single coroutine, so a burst of commands costs O(log n) each instead of
+# a task apiece. callers replaying old messages pass their own `now`.
+class HandoffScheduler:
+    def __init__(self, timeout: float = 5.0, clock: Callable[[], float] = time.monotonic) -> None:
+        self.timeout = timeout
+        self.clock = clock
+        self.deadlines: list[tuple[float, int, int, int]] = [] # (deadline, seq, channel, user)
+        self.waiting: dict[int, deque[tuple[int, int]]] = {} # channel -> (seq, user), oldest first
+        self.live: set[int] = set() # seqs neither matched nor expired; the heap drops the rest lazily
+        self.seq = itertools.count()
+        self.wake = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        # exposed for monitoring
+        self.matched: int = 0
+        self.expired: int = 0
+
+    def __len__(self) -> int:
+        return len(self.live)
+
+    def expect(self, channel: int, user: int, now: Optional[float] = None) -> None:
+        now = self.clock() if now is None else now
+        seq = next(self.seq)
+        heapq.heappush(self.deadlines, (now + self.timeout, seq, channel, user))
+        self.waiting.setdefault(channel, deque()).append((seq, user))
+        self.live.add(seq)
+        if self.deadlines[0][1] == seq:
+            self.wake.set() # the scheduler is sleeping towards a later deadline
+        log.debug(f'{user} waiting for another bot in {channel}, {len(self.live)} waiting')
+
+    def claim(self, channel: int, user: Optional[int] = None, now: Optional[float] = None) -> Optional[int]:
+        # the waiter a bot's link belongs to, if any: `user` if they are waiting, else the oldest
+        self.expire(self.clock() if now is None else now)
+        waiters = self.waiting.get(channel)
+        if not waiters:
+            return None
+        entry = next((waiter for waiter in waiters if waiter[1] == user), waiters[0])
+        self.drop(channel, entry)
+        self.matched += 1
+        return entry[1]
+
+    def expire(self, now: float) -> None:
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, seq, channel, user = heapq.heappop(self.deadlines)
+            if seq in self.live:
+                self.drop(channel, (seq, user))
+                self.expired += 1
+                log.warning(f'Timeout, {user} from queue in {channel}')
+
+    def drop(self, channel: int, entry: tuple[int, int]) -> None:
+        waiters = self.waiting[channel]
+        waiters.remove(entry)
+        if not waiters:
+            del self.waiting[channel]
+        self.live.discard(entry[0])
+
+    async def run(self) -> None:
+        while True:
+            self.wake.clear()
+            delay = self.deadlines[0][0] - self.clock() if self.deadlines else None
+            if delay is None or delay > 0:
+                try:
+                    await asyncio.wait_for(self.wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+            self.expire(self.clock())
+
+    def start(self) -> None:
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
@@ -1,6 +1,11 @@
+from bisect import bisect_right
 from types import TracebackType
-from typing import Any, IO, Optional, Type
-import logging, time, os, json
+from typing import Any, Callable, IO, Iterable, Optional, Type
+from Rankings import RankingIndex
+from Sampling import TrackSampler
+from Metrics import storage_writes
+from Archive import MonthArchive
+import logging, time, os, json, threading, glob
 
 class JSONFileLoader:
     def __init__(self, file_path: str, mode: Optional[str] = 'r+') -> None:
@@ -27,73 +32,460 @@ class JSONFileLoader:
     def object_hook(d):
         return {int(k) if k.lstrip('-').isdigit() else k: v for k, v in d.items()}
 
+# background thread which calls `flush` every `interval` seconds,
+# or sooner once `threshold` writes have piled up since the last flush
+class WriteBehind:
+    def __init__(self, flush: Callable[[], None], interval: float = 10.0, threshold: int = 25) -> None:
+        self.flush = flush
+        self.interval = interval
+        self.threshold = threshold
+        self.dirty: int = 0
+        self.wake = threading.Event()
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, name='json-flusher', daemon=True)
+        self.thread.start()
+
+    def mark_dirty(self, n: int = 1) -> None:
+        self.dirty += n
+        if self.dirty >= self.threshold:
+            self.wake.set()
+
+    def run(self) -> None:
+        while not self.stopping:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            if self.dirty:
+                self.dirty = 0
+                try:
+                    self.flush()
+                except Exception:
+                    logging.getLogger('JSON.flush').exception('Write-behind flush failed')
+                    self.dirty += 1 # try again next time around
+
+    def stop(self) -> None:
+        self.stopping = True
+        self.wake.set()
+        self.thread.join()
+
+def atomic_write(path: str, text: str) -> None:
+    # write to a temp file and swap it in so a crash mid-write
+    # never leaves a truncated file behind
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as out_file:
+        out_file.write(text)
+        out_file.flush()
+        os.fsync(out_file.fileno())
+    os.replace(tmp, path)
+
+def load_month(file_name: str) -> dict:
+    # a closed month's users, from its archive, snapshot or event log
+    if MonthArchive.is_archive(file_name):
+        with MonthArchive(file_name) as archive:
+            return archive.as_dict()
+    return EventLogStore(file_name).load()
+
+def month_files(folder: str) -> list[str]:
+    # every month in a data directory, archived or not; a month archived
+    # with --keep is read from its archive
+    archived = glob.glob(os.path.join(folder, '*.arc'))
+    names = set(os.path.splitext(file_name)[0] for file_name in archived)
+    return sorted(archived + [file_name for file_name in glob.glob(os.path.join(folder, '*.json'))
+                              if os.path.splitext(file_name)[0] not in names])
+
+# persists the whole monthly dict, rewriting it from memory in the background
+class SnapshotStore:
+    read_only: bool = False
+
+    def __init__(self, file_name: str, flush_interval: float = 10.0, flush_threshold: int = 25) -> None:
+        self.file = file_name
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.writer: Optional[WriteBehind] = None
+
+    def load(self) -> Optional[dict]:
+        if not os.path.exists(self.file):
+            return None
+        with JSONFileLoader(self.file, mode = 'r') as cur_dict:
+            return cur_dict
+
+    def start(self, snapshot: Callable[[], dict], lock: threading.Lock, is_new: bool) -> None:
+        self.snapshot = snapshot
+        self.lock = lock
+        if is_new:
+            self.flush()
+        self.writer = WriteBehind(self.flush, self.flush_interval, self.flush_threshold)
+
+    def record(self, disc_id: int, track_id: str, when: int) -> None:
+        self.writer.mark_dirty()
+
+    def record_many(self, rows: list[tuple[int, str, int]]) -> None:
+        self.writer.mark_dirty(len(rows))
+
+    def remove(self, disc_id: int, track_id: str) -> None:
+        self.writer.mark_dirty()
+
+    def remove_many(self, rows: list[tuple[int, str]]) -> None:
+        self.writer.mark_dirty(len(rows))
+
+    def flush(self) -> None:
+        start = time.perf_counter()
+        with self.lock:
+            text = json.dumps(self.snapshot(), ensure_ascii=True, indent=4)
+        atomic_write(self.file, text)
+        storage_writes.observe(time.perf_counter() - start, 'snapshot')
+        logging.getLogger('JSON.flush').debug(f'Flushed snapshot to {self.file}')
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.stop()
+        self.flush()
+
+# appends one JSON line per add to YYYY-MM.jsonl and periodically compacts the
+# log into the usual YYYY-MM.json snapshot, stamped with the last sequence number
+# it contains. on load, the snapshot is read and any later log entries replayed.
+class EventLogStore(SnapshotStore):
+    def __init__(self, file_name: str, flush_interval: float = 300.0, flush_threshold: int = 1000, fsync: bool = True) -> None:
+        super().__init__(file_name, flush_interval, flush_threshold)
+        self.log_file = os.path.splitext(file_name)[0] + '.jsonl'
+        self.fsync = fsync
+        self.seq: int = 0
+        self.log: Optional[IO] = None
+
+    def load(self) -> Optional[dict]:
+        cur_dict = super().load()
+        snap_seq = 0 if cur_dict is None else cur_dict.get('seq', 0)
+        self.seq = snap_seq
+        if not os.path.exists(self.log_file):
+            return cur_dict
+        replayed = 0
+        with open(self.log_file, 'r', encoding='utf-8') as log_file:
+            lines = log_file.read().splitlines(keepends=True)
+        header = json.loads(lines[0])
+        if cur_dict is None:
+            cur_dict = {'playlist': header['playlist'], 'creation_time': header['creation_time']}
+        # tracks are unique per playlist, so this keeps replay idempotent even if the seq stamp was lost
+        seen = set(t for users in cur_dict.keys() if type(users) == int for t in cur_dict[users]['tracks'])
+        for i, line in enumerate(lines[1:], start=1):
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                # a crash mid-append leaves a partial last line, cut it off before appending again
+                logging.getLogger('JSON.log').warning(f'Dropping torn entry at the end of {self.log_file}')
+                atomic_write(self.log_file, ''.join(lines[:i]))
+                break
+            if event['seq'] <= snap_seq:
+                continue
+            if event.get('op') == 'remove':
+                if event['track'] not in seen:
+                    continue
+                seen.discard(event['track'])
+            elif event['track'] in seen:
+                continue
+            else:
+                seen.add(event['track'])
+            EventLogStore.apply(cur_dict, event)
+            self.seq = event['seq']
+            replayed += 1
+        logging.getLogger('JSON.log').info(f'Replayed {replayed} events from {self.log_file} on top of snapshot {snap_seq}')
+        return cur_dict
+
+    def start(self, snapshot: Callable[[], dict], lock: threading.Lock, is_new: bool) -> None:
+        self.snapshot = snapshot
+        self.lock = lock
+        if not os.path.exists(self.log_file):
+            atomic_write(self.log_file, self.header())
+        self.log = open(self.log_file, 'a', encoding='utf-8')
+        super().start(snapshot, lock, is_new)
+
+    def header(self) -> str:
+        cur_dict = self.snapshot()
+        return json.dumps({'playlist': cur_dict['playlist'], 'creation_time': cur_dict['creation_time']}) + '\n'
+
+    def record(self, disc_id: int, track_id: str, when: int) -> None:
+        self.write({'user': disc_id, 'track': track_id, 'time': when})
+
+    def record_many(self, rows: list[tuple[int, str, int]]) -> None:
+        self.write(*({'user': disc_id, 'track': track_id, 'time': when} for disc_id, track_id, when in rows))
+
+    def remove(self, disc_id: int, track_id: str) -> None:
+        self.write({'op': 'remove', 'user': disc_id, 'track': track_id})
+
+    def remove_many(self, rows: list[tuple[int, str]]) -> None:
+        self.write(*({'op': 'remove', 'user': disc_id, 'track': track_id} for disc_id, track_id in rows))
+
+    def write(self, *events: dict) -> None:
+        # called with the parser lock held, so seq order matches log order.
+        # several events share one flush and fsync
+        start = time.perf_counter()
+        lines = []
+        for event in events:
+            self.seq += 1
+            lines.append(json.dumps({'seq': self.seq, **event}) + '\n')
+        self.log.write(''.join(lines))
+        self.log.flush()
+        if self.fsync:
+            os.fsync(self.log.fileno())
+        storage_writes.observe(time.perf_counter() - start, 'eventlog')
+        self.writer.mark_dirty(len(lines))
+
+    def flush(self) -> None:
+        start = time.perf_counter()
+        with self.lock:
+            cur_dict = self.snapshot()
+            cur_dict['seq'] = self.seq
+            text = json.dumps(cur_dict, ensure_ascii=True, indent=4)
+            pos = self.log.tell()
+        atomic_write(self.file, text)
+        # everything before pos is now in the snapshot, keep only the tail
+        with self.lock:
+            self.log.flush()
+            with open(self.log_file, 'r', encoding='utf-8') as log_file:
+                log_file.seek(pos)
+                tail = log_file.read()
+            atomic_write(self.log_file, self.header() + tail)
+            self.log.close()
+            self.log = open(self.log_file, 'a', encoding='utf-8')
+        storage_writes.observe(time.perf_counter() - start, 'compaction')
+        logging.getLogger('JSON.log').debug(f'Compacted {self.log_file} into {self.file} at seq {cur_dict["seq"]}')
+
+    def close(self) -> None:
+        super().close()
+        self.log.close()
+
+    @staticmethod
+    def apply(cur_dict: dict, event: dict) -> None:
+        disc_id = int(event['user'])
+        if event.get('op') == 'remove':
+            JSONparser.drop(cur_dict, disc_id, event['track'])
+            return
+        JSONparser.insert(cur_dict.setdefault(disc_id, {'tracks': [], 'times': []}), event['track'], event['time'])
+
+    @staticmethod
+    def migrate(file_name: str) -> bool:
+        # one-shot conversion of an existing monthly JSON into a log + stamped snapshot
+        log_file = os.path.splitext(file_name)[0] + '.jsonl'
+        if os.path.exists(log_file):
+            logging.getLogger('JSON.migrate').info(f'{log_file} already exists, skipping')
+            return False
+        with JSONFileLoader(file_name, mode = 'r') as cur_dict:
+            events = [(when, users, track) for users in cur_dict.keys() if type(users) == int
+                      for track, when in zip(cur_dict[users]['tracks'], cur_dict[users]['times'])]
+        events.sort(key=lambda e: e[0]) # stable, so per-user order is kept
+        lines = [json.dumps({'playlist': cur_dict['playlist'], 'creation_time': cur_dict['creation_time']})]
+        lines += [json.dumps({'seq': seq, 'user': users, 'track': track, 'time': when})
+                  for seq, (when, users, track) in enumerate(events, start=1)]
+        atomic_write(log_file, '\n'.join(lines) + '\n')
+        cur_dict['seq'] = len(events)
+        atomic_write(file_name, json.dumps(cur_dict, ensure_ascii=True, indent=4))
+        logging.getLogger('JSON.migrate').info(f'Migrated {len(events)} tracks from {file_name} to {log_file}')
+        return True
+
+# a month converted by Archive.py. closed months don't change, so the
+# parser reads it like any other and there is nothing to write back
+class ArchiveStore(SnapshotStore):
+    read_only = True
+
+    def load(self) -> Optional[dict]:
+        with MonthArchive(self.file) as archive:
+            return archive.as_dict()
+
+    def start(self, snapshot: Callable[[], dict], lock: threading.Lock, is_new: bool) -> None:
+        self.snapshot = snapshot
+        self.lock = lock
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+class StoreFactory:
+    def get_store(self, config: dict, file_name: str) -> [SnapshotStore, EventLogStore, ArchiveStore]:
+        # a month that has been archived opens read-only from the archive under either name,
+        # even when its JSON was kept, since that is what the history readers go by
+        archive = MonthArchive.path_for(file_name)
+        if file_name == archive or os.path.exists(archive):
+            return ArchiveStore(archive)
+        if config.get('storage', 'json') == 'eventlog':
+            return EventLogStore(file_name, config.get('compact_interval', 300.0),
+                                 config.get('compact_threshold', 1000), config.get('fsync', True))
+        else:
+            return SnapshotStore(file_name, config.get('flush_interval', 10.0), config.get('flush_threshold', 25))
+
 class JSONparser:
-    def __init__(self, file_name: Optional[str] = None, playlist_id: Optional[str] = None) -> None:
+    def __init__(self, file_name: Optional[str] = None, playlist_id: Optional[str] = None,
+                 store: Optional[SnapshotStore] = None, shared = None, manifest: Optional[dict] = None,
+                 creation_time: Optional[int] = None) -> None:
         if file_name is None:
             self.file: str = JSONparser.file_by_date()
         else:
             self.file: str = file_name
+        self.store = SnapshotStore(self.file) if store is None else store
+        self.shared = shared # SharedState, when other shards may post to this playlist too
 
-        self.is_new = not os.path.exists(self.file)
+        self.lock = threading.Lock()
+        self.loaded = False
+        if manifest is not None and manifest.get('file') == self.file and manifest.get('signature') == JSONparser.signature(self.file):
+            # nothing has touched the file since the manifest was written, so
+            # it is only parsed once something needs more than the dedupe set
+            logging.getLogger('JSON.init').info(f'Opening {self.file} from manifest')
+            self.is_new = False
+            self.playlist: str = manifest['playlist']
+            self.creation_time: int = manifest['creation_time']
+            self.tracks: set[str] = set(manifest['tracks'])
+        else:
+            self.load(playlist_id, creation_time)
+        if self.shared is not None:
+            self.shared.seed(self.file, self.tracks)
+        logging.getLogger('JSON.init').debug(f'{self.playlist = }, {self.creation_time = }, {len(self.tracks) = }')
+
+    def load(self, playlist_id: Optional[str] = None, creation_time: Optional[int] = None) -> None:
+        # authoritative copy of the file contents, keyed by discord ID
+        self.data: dict[int, dict[str, list]] = {}
+        cur_dict = self.store.load()
+        self.is_new = cur_dict is None
         if self.is_new:
             logging.getLogger('JSON.init').info(f'Creating new file: {self.file}')
-            with open(self.file, 'a+', encoding='utf-8') as json_file:
-                self.creation_time: int = int(time.time())
-                self.playlist: str = 'N/A' if playlist_id is None else playlist_id
-                json.dump({'playlist': self.playlist, 'creation_time': self.creation_time}, json_file, ensure_ascii=True, indent=4)
-                self.tracks: set(str) = set()
+            # a playlist set up ahead of its month counts from the start of it
+            self.creation_time: int = int(time.time()) if creation_time is None else creation_time
+            self.playlist: str = 'N/A' if playlist_id is None else playlist_id
         else:
             logging.getLogger('JSON.init').info(f'Reading existing file: {self.file}')
-            with JSONFileLoader(self.file, mode = 'r') as cur_dict:
-                self.playlist: str = cur_dict['playlist']
-                self.creation_time: int = cur_dict['creation_time']
-                self.tracks: set(str) = set(t for users in cur_dict.keys() if type(users) == int for t in cur_dict[users]['tracks'])
-        logging.getLogger('JSON.init').debug(f'{self.playlist = }, {self.creation_time = }, {len(self.tracks) = }')
+            self.playlist: str = cur_dict['playlist']
+            self.creation_time: int = cur_dict['creation_time']
+            self.data = {users: cur_dict[users] for users in cur_dict.keys() if type(users) == int}
+        self.tracks: set[str] = set(t for user in self.data.values() for t in user['tracks'])
+        self.rankings = RankingIndex.from_users(self.data)
+        self.sampler = TrackSampler.from_users(self.data)
+        self.store.start(self.as_dict, self.lock, self.is_new)
+        self.loaded = True
+
+    def __getattr__(self, name: str) -> Any:
+        # data, rankings and sampler of a parser opened from the manifest are read on first use
+        if name in ('data', 'rankings', 'sampler') and not self.__dict__.get('loaded', True):
+            self.load()
+            return getattr(self, name)
+        raise AttributeError(f'{type(self).__name__!r} object has no attribute {name!r}')
 
     def get_playlist(self) -> str:
         return self.playlist
 
-    def append_track(self, disc_id: int, track_id: str) -> bool:
-        if track_id in self.tracks:
+    def writable(self) -> None:
+        if self.store.read_only:
+            raise ValueError(f'{self.file} is archived and can no longer change')
+
+    def append_track(self, disc_id: int, track_id: str, when: Optional[int] = None) -> bool:
+        self.writable()
+        # the shared claim is atomic, so only one shard records a track posted in two places at once
+        if track_id in self.tracks or (self.shared is not None and not self.shared.claim(self.file, track_id)):
             logging.getLogger('JSON.append').info(f'Skipped {disc_id}: {track_id} as track already exists')
             return False
         disc_id = int(disc_id)
-        with JSONFileLoader(self.file) as data:
-            cur_dict, json_file = data
-            if disc_id in cur_dict:
-                cur_dict[disc_id]['tracks'].append(track_id)
-                cur_dict[disc_id]['times'].append(int(time.time()))
-            else:
-                cur_dict[disc_id] = {'tracks': [track_id,], 'times': [int(time.time()),]}
-
-            # move the cursor to the top, dump, trim file to size
-            json_file.seek(0)
-            json.dump(cur_dict, json_file, ensure_ascii=True, indent=4)
-            json_file.truncate()
+        when = int(time.time()) if when is None else int(when)
+        with self.lock:
+            JSONparser.insert(self.data.setdefault(disc_id, {'tracks': [], 'times': []}), track_id, when)
+            self.tracks.add(track_id)
+            self.rankings.add(disc_id, track_id, when)
+            self.sampler.add(disc_id, track_id)
+            self.store.record(disc_id, track_id, when)
         logging.getLogger('JSON.append').info(f'Logged {disc_id}: {track_id} to {self.file}')
-        self.tracks.add(track_id)
         return True
 
+    def append_tracks(self, rows: list[tuple[int, str, int]]) -> list[tuple[int, str, int]]:
+        # a backfill of (discord id, track, time) rows: one dedupe pass and one
+        # store write for the lot. returns the rows that were new
+        self.writable()
+        fresh = {}
+        for disc_id, track_id, when in rows:
+            if track_id not in self.tracks and track_id not in fresh:
+                fresh[track_id] = (int(disc_id), track_id, int(when))
+        if self.shared is not None:
+            fresh = {track_id: row for track_id, row in fresh.items() if self.shared.claim(self.file, track_id)}
+        added = list(fresh.values())
+        if not added:
+            return added
+        with self.lock:
+            for disc_id, track_id, when in added:
+                # backfilled posts are usually older than the live ones
+                JSONparser.insert(self.data.setdefault(disc_id, {'tracks': [], 'times': []}), track_id, when)
+                self.tracks.add(track_id)
+                self.sampler.add(disc_id, track_id)
+            self.rankings = RankingIndex.from_users(self.data)
+            self.store.record_many(added)
+        logging.getLogger('JSON.append').info(f'Logged {len(added)} of {len(rows)} backfilled tracks to {self.file}')
+        return added
+
+    def remove_track(self, track_id: str) -> bool:
+        if track_id not in self.tracks:
+            return False
+        self.writable()
+        with self.lock:
+            disc_id = next(users for users, data in self.data.items() if track_id in data['tracks'])
+            JSONparser.drop(self.data, disc_id, track_id)
+            self.tracks.discard(track_id)
+            self.sampler.remove(track_id)
+            self.rankings.remove(disc_id, self.get_last(disc_id))
+            self.store.remove(disc_id, track_id)
+        if self.shared is not None:
+            self.shared.release(self.file, track_id)
+        logging.getLogger('JSON.remove').info(f'Removed {disc_id}: {track_id} from {self.file}')
+        return True
+
+    def remove_tracks(self, track_ids: Iterable[str]) -> list[str]:
+        # the bulk version of remove_track, with one store write for the lot
+        self.writable()
+        with self.lock:
+            gone = [track_id for track_id in dict.fromkeys(track_ids) if track_id in self.tracks]
+            if not gone:
+                return gone
+            owners = {track_id: users for users, data in self.data.items() for track_id in data['tracks']}
+            for track_id in gone:
+                JSONparser.drop(self.data, owners[track_id], track_id)
+                self.tracks.discard(track_id)
+                self.sampler.remove(track_id)
+            self.rankings = RankingIndex.from_users(self.data)
+            self.store.remove_many([(owners[track_id], track_id) for track_id in gone])
+        if self.shared is not None:
+            for track_id in gone:
+                self.shared.release(self.file, track_id)
+        logging.getLogger('JSON.remove').info(f'Removed {len(gone)} tracks from {self.file}')
+        return gone
+
+    def as_dict(self) -> dict:
+        # same layout as the file on disk; call with the lock held
+        return {'playlist': self.playlist, 'creation_time': self.creation_time, **self.data}
+
+    def flush(self) -> None:
+        if self.loaded:
+            self.store.flush()
+
+    def close(self) -> None:
+        if self.loaded:
+            self.store.close()
+
+    def get_track_ids(self) -> set[str]:
+        return self.tracks
+
+    def manifest(self) -> dict:
+        # enough to reopen this month without parsing it, valid until the file changes
+        return {'file': self.file, 'playlist': self.playlist, 'creation_time': self.creation_time,
+                'signature': JSONparser.signature(self.file), 'tracks': sorted(self.tracks)}
+
     def get_all_track_counts(self) -> dict[int, int]:
-        with JSONFileLoader(self.file, mode = 'r') as cur_dict:
-            return {users: len(cur_dict[users]['tracks']) for users in cur_dict.keys() if type(users) == int}
+        return {users: len(data['tracks']) for users, data in self.data.items()}
 
     def get_all_tracks(self) -> dict[int, list[str]]:
-        with JSONFileLoader(self.file, mode = 'r') as cur_dict:
-            return {users: cur_dict[users]['tracks'] for users in cur_dict.keys() if type(users) == int}
+        return {users: list(data['tracks']) for users, data in self.data.items()}
             
     def get_all_last_track_times(self) -> dict[int, int]:
-        with JSONFileLoader(self.file, mode = 'r') as cur_dict:
-            return {users: cur_dict[users]['times'][-1] for users in cur_dict.keys() if type(users) == int}
+        return {users: data['times'][-1] for users, data in self.data.items()}
 
     def get_all_last_track_ids(self) -> dict[int, str]:
-        with JSONFileLoader(self.file, mode = 'r') as cur_dict:
-            return {users: cur_dict[users]['tracks'][-1] for users in cur_dict.keys() if type(users) == int}
+        return {users: data['tracks'][-1] for users, data in self.data.items()}
 
     def get_track_count(self, disc_id: int) -> int:
         disc_id = int(disc_id)
-        with JSONFileLoader(self.file, mode = 'r') as cur_dict:
-            return len(cur_dict[disc_id]['tracks']) if disc_id in cur_dict else 0
+        return len(self.data[disc_id]['tracks']) if disc_id in self.data else 0
 
     def get_last_track_time(self, disc_id: int) -> int:
         return self.get_last_attr(disc_id, 'times')
@@ -103,13 +495,47 @@ class JSONparser:
 
     def get_last_attr(self, disc_id: int, attr: str) -> Any:
         disc_id = int(disc_id)
-        with JSONFileLoader(self.file, mode = 'r') as cur_dict:
-            return cur_dict[disc_id][attr][-1] if disc_id in cur_dict else None
+        return self.data[disc_id][attr][-1] if disc_id in self.data else None
+
+    def get_last(self, disc_id: int) -> Optional[tuple[str, int]]:
+        disc_id = int(disc_id)
+        return (self.data[disc_id]['tracks'][-1], self.data[disc_id]['times'][-1]) if disc_id in self.data else None
 
     @staticmethod
-    def file_by_date() -> str:
-        curtime = time.gmtime()
-        return f"playlist_data/{curtime.tm_year}-{curtime.tm_mon:02}.json"
+    def insert(user: dict, track_id: str, when: int) -> None:
+        # keep a user's tracks in time order, so the last one is the latest
+        times = user['times']
+        idx = len(times) if not times or when >= times[-1] else bisect_right(times, when)
+        user['tracks'].insert(idx, track_id)
+        times.insert(idx, when)
+
+    @staticmethod
+    def drop(cur_dict: dict, disc_id: int, track_id: str) -> None:
+        user = cur_dict.get(disc_id)
+        if user is None or track_id not in user['tracks']:
+            return
+        idx = user['tracks'].index(track_id)
+        del user['tracks'][idx]
+        del user['times'][idx]
+        if not user['tracks']:
+            del cur_dict[disc_id]
+
+    @staticmethod
+    def signature(file_name: str) -> list:
+        # size and mtime of the snapshot and its event log
+        out = []
+        for path in (file_name, os.path.splitext(file_name)[0] + '.jsonl'):
+            try:
+                stat = os.stat(path)
+                out.append([stat.st_size, stat.st_mtime_ns])
+            except FileNotFoundError:
+                out.append(None)
+        return out
+
+    @staticmethod
+    def file_by_date(folder: str = 'playlist_data', when: Optional[float] = None) -> str:
+        curtime = time.gmtime(when)
+        return f"{folder}/{curtime.tm_year}-{curtime.tm_mon:02}.json"
 
     @staticmethod
     def uniquify(path: str) -> str:
@@ -123,5 +549,14 @@ class JSONparser:
         return path
 
     @staticmethod
-    def unique_name() -> str:
-        return JSONparser.uniquify(JSONparser.file_by_date())
\ No newline at end of file
+    def unique_name(folder: str = 'playlist_data', when: Optional[float] = None) -> str:
+        return JSONparser.uniquify(JSONparser.file_by_date(folder, when))
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(prog = 'JSONtools.py', description='Convert monthly playlist JSON files to the event log format.')
+    parser.add_argument('files', nargs='*', help='files to migrate (default: playlist_data/*.json)')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    for file_name in args.files or sorted(glob.glob('playlist_data/*.json')):
+        EventLogStore.migrate(file_name)
@@ -0,0 +1,87 @@
+from collections import OrderedDict
+from typing import Optional
+import aiohttp
+import logging, asyncio, re
+log = logging.getLogger('links')
+
+# track links as they show up in chat: open.spotify.com/track/<id>, with or
+# without an /intl-xx/ prefix, spotify:track:<id> URIs and spotify.link/<code>
+# short links, which have to be resolved over HTTP
+LINK_RE = re.compile(r'open\.spotify\.com/(?:intl-[a-zA-Z-]+/)?track/([0-9A-Za-z]{22})'
+                     r'|spotify:track:([0-9A-Za-z]{22})'
+                     r'|spotify\.link/([0-9A-Za-z]+)')
+TRACK_RE = re.compile(r'open\.spotify\.com/(?:intl-[a-zA-Z-]+/)?track/([0-9A-Za-z]{22})')
+# the page's own canonical link; whatever else it embeds can be other tracks entirely
+OG_URL_RE = re.compile(r'<meta\s[^>]*property=["\']og:url["\'][^>]*>', re.IGNORECASE)
+CONTENT_RE = re.compile(r'content=["\']([^"\']*)["\']', re.IGNORECASE)
+
+def track_id_from(url: str) -> Optional[str]:
+    # the id of a single (already resolved) track link or URI, if it is one
+    match = LINK_RE.search(url)
+    if match is None or match.group(3):
+        return None
+    return match.group(1) or match.group(2)
+
+class ShortLinkResolver:
+    def __init__(self, max_size: int = 1024, timeout: float = 5.0) -> None:
+        self.max_size = max_size
+        self.timeout = timeout
+        self.cache: OrderedDict[str, Optional[str]] = OrderedDict()
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    async def resolve(self, code: str) -> Optional[str]:
+        if code in self.cache:
+            self.cache.move_to_end(code)
+            return self.cache[code]
+        if self.session is None:
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        try:
+            async with self.session.get(f'https://spotify.link/{code}', allow_redirects=True) as resp:
+                # usually the redirect lands on the track itself. one that lands on an
+                # album, playlist or artist isn't a track, even though the page links some
+                match = TRACK_RE.search(str(resp.url))
+                if match is None and resp.url.host != 'open.spotify.com':
+                    # an interstitial page, which names where it leads in og:url
+                    match = ShortLinkResolver.canonical_track(await resp.text())
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            log.warning(f'Could not resolve spotify.link/{code}: {e!r}')
+            return None # not cached, so the next mention tries again
+        track_id = None if match is None else match.group(1)
+        log.debug(f'Resolved spotify.link/{code} to {track_id}')
+        self.cache[code] = track_id
+        if len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+        return track_id
+
+    @staticmethod
+    def canonical_track(page: str) -> Optional[re.Match]:
+        tag = OG_URL_RE.search(page)
+        content = None if tag is None else CONTENT_RE.search(tag.group(0))
+        return None if content is None else TRACK_RE.fullmatch(re.sub(r'^https?://|[?#].*$', '', content.group(1)))
+
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+
+class LinkExtractor:
+    def __init__(self, resolver: Optional[ShortLinkResolver] = None) -> None:
+        self.resolver = ShortLinkResolver() if resolver is None else resolver
+
+    def scan(self, text: str) -> list[tuple[Optional[str], Optional[str]]]:
+        # (track id, short link code) pairs in order of appearance; most chat
+        # never mentions spotify at all, and the substring test rejects it cheaply
+        if 'spotify' not in text:
+            return []
+        return [(match.group(1) or match.group(2), match.group(3)) for match in LINK_RE.finditer(text)]
+
+    async def track_ids(self, text: str) -> list[str]:
+        out = []
+        for track_id, code in self.scan(text):
+            if code is not None:
+                track_id = await self.resolver.resolve(code)
+            if track_id is not None and track_id not in out:
+                out.append(track_id)
+        return out
+
+    async def close(self) -> None:
+        await self.resolver.close()
@@ -1,62 +1,568 @@
-from SpotifyHandler import HandlerFactory
-from JSONtools import JSONparser
-import logging, os
+from JSONtools import JSONparser, StoreFactory, atomic_write, load_month, month_files
+from Archive import MonthArchive
+from SQLtools import SQLparser
+from Rankings import RankingIndex
+from Analytics import HistoryIndex
+from SeenIndex import SeenIndex
+from Sampling import TrackSampler
+from Metrics import tracks_added, duplicates_skipped
+from LinkTools import track_id_from
+import logging, os, re, time, json, asyncio, datetime, itertools
 log = logging.getLogger('manager')
 
+# playlist state for one watched channel. the spotify client, add queue,
+# track cache and database connection are shared through the ManagerPool
 class Manager:
-    def __init__(self, config, tokens, json_name = None):
-        log.warning(f"{config['use_spotify'] = }")
-        self.sp = HandlerFactory().get_handler(config['use_spotify'], tokens)
-        if json_name is None or not os.path.exists(json_name):
-            self.swap_to_new_playlist()
+    # unique across managers, so one that is evicted and reloaded can't reuse a version
+    versions = itertools.count(1)
+
+    def __init__(self, config, pool, mapping):
+        self.config = config
+        self.mapping = mapping
+        self.sp = pool.sp
+        self.queue = pool.queue
+        self.track_cache = pool.track_cache
+        self.conn = pool.conn
+        self.shared = pool.shared
+        self.pool = pool
+        self.clock = pool.clock # wall clock, swapped out to test the monthly rollover
+        self.parser = None
+        self.staged = None # next month's parser, set up ahead of the boundary
+        self.staged_from = None # the boundary it takes over at
+        self.previous = None # last month's, kept open for adds still in flight
+        self.swapped_at = None
+        self.rollover_at = None # when the active parser's month ends
+        self.rolling = asyncio.Lock()
+        # adds past the boundary while next month isn't set up yet, by track
+        self.held: dict[str, tuple[int, str, float]] = Manager.read_held(mapping.data_dir)
+        self.lead = config.get('rollover_lead', 3600.0)
+        self.grace = config.get('rollover_grace', 300.0)
+        self.alltime = None
+        self.history = None
+        self.artists: dict[str, str] = Manager.read_artists(mapping.data_dir) # track -> first artist, kept across history rebuilds
+        self.artist_lookup = None # background task filling in self.artists
+        self.samples = None # for random picks from every month
+        self.seen = None
+        self.snapshot = None # spotify snapshot_id as of the last sync
+        self.last_used = time.monotonic()
+        self.version: int = next(Manager.versions) # for cached renders of the tables
+
+    async def start(self, json_name = None):
+        if json_name is None or not self.playlist_exists(json_name):
+            await self.swap_to_new_playlist()
         else:
             self.load_existing_playlist(json_name)
+        if self.config.get('global_dedupe'):
+            self.open_seen()
+        # catch up on a rollover missed while the bot was down, for a month reloaded
+        # from disk. a playlist opened by name (the testing one) is kept as is
+        if json_name is not None and Manager.is_month(self.parser.file):
+            try:
+                await self.tick(self.clock())
+            except Exception as e:
+                log.warning(f'Could not roll {self.mapping.channel} over to a new playlist yet: {e!r}')
 
-    def swap_to_new_playlist(self, file_name = None, name = None, desc = ''):
+    async def swap_to_new_playlist(self, file_name = None, name = None, desc = ''):
         log.info('Creating new Spotify playlist')
-        date_text = os.path.splitext(os.path.basename(JSONparser.file_by_date()))[0]
-        name = name or f'Sandyland songs: {date_text}'
-        playlist_id = self.sp.new_playlist(name, desc)
-        self.create_json_from_existing_playlist(playlist_id, file_name)
+        date_text = SQLparser.file_by_date(self.clock())
+        name = name or f'{self.mapping.title} songs: {date_text}'
+        playlist_id = await self.sp.new_playlist(name, desc)
+        await self.create_json_from_existing_playlist(playlist_id, file_name, sync = False)
 
-    def create_json_from_existing_playlist(self, playlist_id, file_name = None):
+    async def create_json_from_existing_playlist(self, playlist_id, file_name = None, sync = True):
         log.info('Creating JSON from Spotify playlist')
-        self.sp.set_playlist(playlist_id)
-        self.parser = JSONparser(file_name = file_name or JSONparser.unique_name(), 
-                                 playlist_id = playlist_id)
+        # settle queued adds (and any rollbacks) before the old parser is closed
+        if self.parser is not None:
+            await self.queue.drain(self.parser.get_playlist())
+        self.close()
+        if self.seen is not None:
+            self.seen.save() # a good moment to fold last month into the file
+        self.parser = self.open_parser(file_name, playlist_id)
+        self.rollover_at = Manager.rollover_for(self.parser)
+        self.changed()
+        self.snapshot = None
+        self.shared.set(f'active:{self.mapping.channel}', self.parser.file)
+        # an existing playlist may already have tracks in it
+        if sync:
+            await self.sync()
+        self.write_manifest()
 
     def load_existing_playlist(self, file_name):
         log.info('Loading existing playlist')
-        self.parser = JSONparser(file_name = file_name)
-        self.sp.set_playlist(self.parser.get_playlist())
+        self.close()
+        manifest = Manager.read_manifest(self.mapping.data_dir)
+        self.parser = self.open_parser(file_name, manifest = manifest)
+        self.rollover_at = Manager.rollover_for(self.parser)
+        if manifest is not None and manifest.get('file') == self.parser.file:
+            self.snapshot = manifest.get('snapshot_id')
+
+    def open_parser(self, file_name = None, playlist_id = None, manifest = None, creation_time = None):
+        # creation_time only applies to a new playlist
+        creation_time = int(self.clock()) if creation_time is None else creation_time
+        # claims only matter between processes; in memory they'd be a second copy of every track set, never freed
+        shared = self.shared if self.shared.durable else None
+        if self.conn is not None:
+            return SQLparser(file_name = file_name or SQLparser.unique_name(self.conn, self.mapping.prefix, self.clock()),
+                             playlist_id = playlist_id, conn = self.conn, prefix = self.mapping.prefix, shared = shared,
+                             creation_time = creation_time)
+        file_name = file_name or JSONparser.unique_name(self.mapping.data_dir, self.clock())
+        return JSONparser(file_name = file_name, playlist_id = playlist_id, store = StoreFactory().get_store(self.config, file_name),
+                          shared = shared, manifest = manifest, creation_time = creation_time)
+
+    def playlist_exists(self, file_name):
+        if self.conn is not None:
+            return SQLparser.exists(self.conn, file_name, self.mapping.prefix)
+        return os.path.exists(file_name) or os.path.exists(MonthArchive.path_for(file_name))
+
+    def open_seen(self):
+        file_name = os.path.join(self.mapping.data_dir, 'seen.idx')
+        if os.path.exists(file_name):
+            self.seen = SeenIndex(file_name)
+        elif self.conn is not None:
+            self.seen = SeenIndex.build(file_name, (track for track, in self.conn.execute(
+                'SELECT track FROM tracks JOIN playlists ON playlists.id = tracks.playlist WHERE playlists.name GLOB ?',
+                (SQLparser.pattern(self.mapping.prefix),))))
+        else:
+            self.seen = SeenIndex.build(file_name, (track for users in self.month_data() for data in users.values()
+                                                    for track in data['tracks']))
+        # anything recorded after the last save (say, before a crash) is in the live month
+        for track_id in self.parser.get_track_ids():
+            if track_id not in self.seen:
+                self.seen.add(track_id)
+        log.info(f'Opened seen-track index with {len(self.seen)} tracks')
 
-    def add_to_playlist(self, discord_id, url):
-        split = url.split('/')
+    def close(self):
+        # flush any pending writes from the current parser
+        if self.parser is not None:
+            self.parser.close()
+
+    def unload(self):
+        self.close()
+        for parser in (self.staged, self.previous):
+            if parser is not None:
+                parser.close()
+        self.write_manifest()
+        Manager.write_held(self.mapping.data_dir, self.held)
+        if self.artist_lookup is not None:
+            self.artist_lookup.cancel()
+        Manager.write_artists(self.mapping.data_dir, self.artists)
+        if self.seen is not None:
+            self.seen.close()
+
+    def write_manifest(self):
+        # the active playlist, and after a clean close a snapshot to reopen it from
+        if self.parser is not None:
+            atomic_write(Manager.manifest_file(self.mapping.data_dir), json.dumps({**self.parser.manifest(), 'snapshot_id': self.snapshot}))
+
+    @staticmethod
+    def manifest_file(data_dir):
+        # a dotfile, so it stays out of the *.json globs over the data directory
+        return os.path.join(data_dir, '.manifest')
+
+    @staticmethod
+    def read_manifest(data_dir):
         try:
-            plidx = split.index('track')
-        except ValueError:
-            return False
-        track_id = split[plidx + 1]
+            with open(Manager.manifest_file(data_dir), 'r', encoding='utf-8') as manifest_file:
+                return json.load(manifest_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    @staticmethod
+    def read_held(data_dir):
+        # adds that were still waiting for their month's playlist at the last shutdown
         try:
-            qidx = track_id.index('?')
-            track_id = track_id[:qidx]
-        except ValueError:
-            pass
+            with open(os.path.join(data_dir, '.held'), 'r', encoding='utf-8') as held_file:
+                return {row[1]: tuple(row) for row in json.load(held_file)}
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    @staticmethod
+    def write_held(data_dir, held):
+        if held or os.path.exists(os.path.join(data_dir, '.held')):
+            atomic_write(os.path.join(data_dir, '.held'), json.dumps(list(held.values())))
+
+    @staticmethod
+    def read_artists(data_dir):
+        try:
+            with open(os.path.join(data_dir, '.artists'), 'r', encoding='utf-8') as artists_file:
+                return json.load(artists_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    @staticmethod
+    def write_artists(data_dir, artists):
+        if artists:
+            atomic_write(os.path.join(data_dir, '.artists'), json.dumps(artists))
+
+    @staticmethod
+    def is_month(file_name):
+        # the date-named playlists the rollover creates, as opposed to one opened by name
+        return re.fullmatch(r'\d{4}-\d{2}(-\d+)?', SQLparser.name_of(file_name)) is not None
+
+    @staticmethod
+    def rollover_for(parser):
+        # only monthly playlists roll over; anything else stays active until replaced by hand
+        return Manager.next_month(parser.creation_time) if Manager.is_month(parser.file) else float('inf')
+
+    @staticmethod
+    def month_start(when):
+        # months roll over at midnight UTC, like the file names
+        day = datetime.datetime.fromtimestamp(when, datetime.timezone.utc)
+        return int(day.replace(day = 1, hour = 0, minute = 0, second = 0, microsecond = 0).timestamp())
+
+    @staticmethod
+    def next_month(when):
+        return Manager.month_start(Manager.month_start(when) + 32 * 86400)
+
+    async def tick(self, now):
+        # the monthly rollover: next month's playlist is set up `lead` seconds
+        # early, swapped in at the boundary, and last month's is closed once
+        # adds posted before the boundary have had `grace` seconds to land
+        async with self.rolling:
+            if self.previous is not None and now >= self.swapped_at + self.grace:
+                await self.retire_previous()
+            if self.staged is None and now >= self.rollover_at - self.lead:
+                await self.stage_next(now)
+            if self.staged is not None and now >= self.staged_from:
+                old_link = self.get_playlist_link()
+                self.promote()
+                held, self.held = self.held, {}
+                for discord_id, track_id, when in held.values():
+                    await self.add_track(discord_id, track_id, when)
+                if self.pool.on_rollover is not None:
+                    await self.pool.on_rollover(self, old_link)
+
+    async def stage_next(self, now):
+        # months missed entirely (the bot was down) are skipped, not created empty
+        boundary = self.rollover_at if now < self.rollover_at else Manager.month_start(now)
+        if self.parser.creation_time >= boundary:
+            # already on that month's playlist, say after a manual new_playlist
+            self.rollover_at = Manager.next_month(boundary)
+            return
+        if self.conn is not None:
+            file_name = SQLparser.file_by_date(boundary)
+        else:
+            file_name = JSONparser.file_by_date(self.mapping.data_dir, boundary)
+        if self.playlist_exists(file_name):
+            # staged before a restart
+            parser = self.open_parser(file_name)
+        else:
+            playlist_id = await self.sp.new_playlist(f'{self.mapping.title} songs: {SQLparser.file_by_date(boundary)}', '')
+            parser = self.open_parser(file_name, playlist_id, creation_time = boundary)
+        self.staged, self.staged_from = parser, boundary
+        log.info(f'Staged {parser.file} for {self.mapping.channel}, taking over at {boundary}')
+
+    def promote(self):
+        # nothing here awaits, so every add sees either the old month or the new one
+        if self.previous is not None:
+            self.previous.close()
+        self.previous, self.parser, self.staged = self.parser, self.staged, None
+        self.changed()
+        self.swapped_at = self.staged_from
+        self.rollover_at = Manager.next_month(self.staged_from)
+        self.snapshot = None
+        self.shared.set(f'active:{self.mapping.channel}', self.parser.file)
+        self.write_manifest()
+        log.info(f'Rolled {self.mapping.channel} over from {self.previous.file} to {self.parser.file}')
+
+    async def retire_previous(self):
+        # settle queued adds (and any rollbacks) before last month is closed
+        previous = self.previous
+        await self.queue.drain(previous.get_playlist())
+        if self.previous is previous:
+            self.previous = None
+        previous.close()
+        if self.seen is not None:
+            self.seen.save() # a good moment to fold last month into the file
+
+    def parser_for(self, when):
+        # a post belongs to the month it was posted in, not the one it's processed in
+        if self.staged is not None and when >= self.staged_from:
+            return self.staged
+        if self.previous is not None and when < self.swapped_at:
+            return self.previous
+        return self.parser
+
+    async def add_to_playlist(self, discord_id, url):
+        track_id = track_id_from(url)
+        if track_id is None:
+            return False
+        return await self.add_track(discord_id, track_id)
+
+    async def add_track(self, discord_id, track_id, when = None):
         # add to json file, check for duplicates
-        success = self.parser.append_track(discord_id, track_id)
-        # add to spotify
-        if success:
-            log.debug(url)
-            # self.sp.add('https://open.spotify.com/track/' + track_id)
-            self.sp.add(url)
+        when = self.clock() if when is None else when
+        self.last_used = time.monotonic()
+        if self.seen is not None and track_id in self.seen:
+            log.info(f'Skipped {discord_id}: {track_id} as it has been posted before')
+            duplicates_skipped.inc('history')
+            return False
+        if self.staged is None and when >= self.rollover_at:
+            # next month's playlist isn't ready; tick adds these once it is
+            if track_id in self.held:
+                duplicates_skipped.inc('playlist')
+                return False
+            self.held[track_id] = (discord_id, track_id, when)
+            log.info(f'Holding {discord_id}: {track_id} until the next playlist is set up')
+            return True
+        parser = self.parser_for(when)
+        when = int(when)
+        success = parser.append_track(discord_id, track_id, when)
+        # queue for spotify, undoing the local record if it can never be added
+        if not success:
+            duplicates_skipped.inc('playlist')
+        else:
+            log.debug(track_id)
+            tracks_added.inc()
+            self.changed()
+            if self.seen is not None:
+                self.seen.add(track_id)
+            if self.alltime is not None:
+                self.alltime.add(int(discord_id), track_id, when)
+            if self.history is not None:
+                self.history.add(int(discord_id), track_id, when)
+            if self.samples is not None:
+                self.samples.add(int(discord_id), track_id)
+            self.queue.put(parser.get_playlist(), 'spotify:track:' + track_id,
+                           on_failure = lambda: self.rollback(parser, discord_id, track_id))
         return success
 
-    def remove_from_playlist(self, tracks):
-        # remove from spotify
-        self.sp.remove(tracks)
-        # sync with json file
-        raise NotImplementedError("I don't actually know why I started making a remove functionality. It's so much easier to just do it from the playlist itself.")
+    async def add_tracks(self, rows):
+        # a backfill of (discord id, track, time) rows: each row goes to the month it
+        # was posted in, deduped and stored a month at a time, then queued for spotify
+        # like any other add. rows from before the open months have nowhere to go
+        self.last_used = time.monotonic()
+        if self.seen is not None:
+            fresh = [row for row in rows if row[1] not in self.seen]
+            duplicates_skipped.inc('history', n=len(rows) - len(fresh))
+            rows = fresh
+        by_parser, outside = {}, 0
+        for row in rows:
+            when = row[2]
+            if self.staged is None and when >= self.rollover_at:
+                # next month's playlist isn't ready; tick adds these once it is
+                self.held.setdefault(row[1], row)
+                continue
+            parser = self.parser_for(when)
+            if Manager.is_month(parser.file) and when < Manager.month_start(parser.creation_time):
+                outside += 1
+                continue
+            by_parser.setdefault(parser, []).append(row)
+        if outside:
+            log.info(f'Skipped {outside} backfilled tracks from before the open months of {self.mapping.channel}')
+        added = []
+        for parser, parser_rows in by_parser.items():
+            parser_added = parser.append_tracks(parser_rows)
+            for discord_id, track_id, _ in parser_added:
+                self.queue.put(parser.get_playlist(), 'spotify:track:' + track_id,
+                               on_failure = lambda parser=parser, discord_id=discord_id, track_id=track_id: self.rollback(parser, discord_id, track_id))
+            added += parser_added
+        duplicates_skipped.inc('playlist', n=sum(map(len, by_parser.values())) - len(added))
+        tracks_added.inc(n=len(added))
+        if not added:
+            return added
+        if self.seen is not None:
+            for _, track_id, _ in added:
+                self.seen.add(track_id)
+        # these are older than what the indexes already hold, so they're rebuilt on next use
+        self.alltime = None
+        self.history = None
+        self.samples = None
+        self.changed()
+        return added
+
+    def read_checkpoint(self):
+        # the last message a backfill got through, while the same playlist is active
+        try:
+            with open(os.path.join(self.mapping.data_dir, '.backfill'), 'r', encoding='utf-8') as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        return checkpoint['after'] if checkpoint.get('file') == self.parser.file else None
+
+    def write_checkpoint(self, message_id):
+        atomic_write(os.path.join(self.mapping.data_dir, '.backfill'), json.dumps({'file': self.parser.file, 'after': message_id}))
+
+    def rollback(self, parser, discord_id, track_id):
+        if parser not in (self.parser, self.staged, self.previous):
+            log.error(f'Could not add {track_id} to Spotify, but {parser.file} is closed so it stays in the record')
+            return
+        if not parser.remove_track(track_id):
+            return
+        self.changed()
+        if self.seen is not None:
+            self.seen.discard(track_id)
+        if self.alltime is not None:
+            # older months can't hold this user's latest track any more, so the
+            # current month's latest (if any) is the right fallback
+            self.alltime.remove(int(discord_id), parser.get_last(discord_id))
+        if self.history is not None:
+            self.history.remove(int(discord_id), track_id)
+        if self.samples is not None:
+            self.samples.remove(track_id)
+
+    def changed(self):
+        # anything the leaderboard or lasttrack could show is different now
+        self.version = next(Manager.versions)
+
+    def alltime_rankings(self):
+        # built on first use, then kept up to date by add_track
+        if self.alltime is None:
+            if self.conn is not None:
+                rows = self.conn.execute(
+                    'SELECT user, COUNT(*), track, MAX(time) FROM tracks JOIN playlists ON playlists.id = tracks.playlist '
+                    'WHERE playlists.name GLOB ? GROUP BY user', (SQLparser.pattern(self.mapping.prefix),))
+            else:
+                rows = [(uid, len(data['tracks']), data['tracks'][-1], data['times'][-1])
+                        for users in self.month_data() for uid, data in users.items()]
+            self.alltime = RankingIndex.from_rows(rows)
+            log.info(f'Built all-time rankings: {self.alltime.total} tracks from {len(self.alltime)} users')
+        return self.alltime
+
+    def history_index(self):
+        # every track this channel has seen, built on first use and kept up to date by add_track
+        if self.history is None:
+            start = time.perf_counter()
+            if self.conn is not None:
+                rows = self.conn.execute('SELECT user, track, time FROM tracks JOIN playlists ON playlists.id = tracks.playlist '
+                                         'WHERE playlists.name GLOB ? ORDER BY time, tracks.id', (SQLparser.pattern(self.mapping.prefix),))
+            else:
+                rows = [(uid, track, when) for users in self.month_data() for uid, data in users.items()
+                        for track, when in zip(data['tracks'], data['times'])]
+            self.history = HistoryIndex.from_rows(rows)
+            self.history.set_artists(self.artists)
+            log.info(f'Built history index: {len(self.history)} tracks in {time.perf_counter() - start:.2f}s')
+        return self.history
+
+    def lookup_artists(self, track_ids):
+        # starts filling in artists for these tracks, unless a lookup is already running.
+        # each run is capped, so a long history is worked through over a few calls
+        if self.artist_lookup is None or self.artist_lookup.done():
+            track_ids = track_ids[:self.config.get('artist_lookups', 500)]
+            self.artist_lookup = asyncio.get_running_loop().create_task(self.fill_artists(track_ids))
+        return self.artist_lookup
+
+    async def fill_artists(self, track_ids):
+        # straight from spotify, since a whole history going through the track cache would only churn it
+        found = 0
+        try:
+            for i in range(0, len(track_ids), 50):
+                chunk = track_ids[i:i + 50]
+                for track_id, data in zip(chunk, (await self.sp.get_track_info(chunk))['tracks']):
+                    if data is None or not data['artists']:
+                        continue
+                    self.artists[track_id] = data['artists'][0]['name']
+                    found += 1
+                    # the index may have been rebuilt meanwhile, in which case it was seeded from self.artists
+                    if self.history is not None and track_id in self.history.track_codes:
+                        self.history.set_artist(track_id, self.artists[track_id])
+        except Exception as e:
+            log.warning(f'Could not look up artists for {self.mapping.channel}: {e!r}')
+        finally:
+            if found:
+                Manager.write_artists(self.mapping.data_dir, self.artists)
+                log.info(f'Looked up artists for {found} of {len(track_ids)} tracks in {self.mapping.channel}')
+
+    def history_sampler(self):
+        # random picks across every month, built from the history index on first use
+        if self.samples is None:
+            history = self.history_index()
+            self.samples = TrackSampler.from_rows((history.user_ids[user], history.track_ids[track])
+                                                  for user, track in zip(history.users, history.tracks) if user >= 0)
+        return self.samples
+
+    def month_data(self):
+        # the users of every month on disk, with the open months read from memory
+        open_parsers = [parser for parser in (self.parser, self.staged, self.previous) if parser is not None]
+        for file_name in month_files(os.path.dirname(self.parser.file)):
+            parser = next((parser for parser in open_parsers if os.path.exists(parser.file) and os.path.samefile(file_name, parser.file)), None)
+            if parser is not None:
+                yield parser.data
+            else:
+                cur_dict = load_month(file_name)
+                yield {uid: cur_dict[uid] for uid in cur_dict.keys() if type(uid) == int}
+
+    async def sync(self):
+        # reconcile the local record with the spotify playlist: tracks added
+        # there are recorded here, tracks removed there are dropped here.
+        # returns (added, removed), or None if nothing changed since last time
+        parser = self.parser
+        playlist = parser.get_playlist()
+        # let our own adds land first, so they aren't mistaken for removals
+        await self.queue.drain(playlist)
+        local = set(parser.get_track_ids())
+        state = await self.sp.get_playlist_state(playlist)
+        if state['snapshot_id'] is None or state['snapshot_id'] == self.snapshot:
+            return None
+        first = state['tracks']
+        pages = [first] + await asyncio.gather(*(self.sp.get_playlist_items(playlist, offset)
+                                                 for offset in range(len(first['items']), first['total'], 100)))
+        remote = {}
+        for page in pages:
+            for item in page['items']:
+                # local files and podcast episodes can't be posted here, so they don't count
+                track = item.get('track') or {}
+                if track.get('id') and not track.get('is_local') and track.get('type', 'track') == 'track':
+                    remote.setdefault(track['id'], item)
+        # adds by spotify accounts nobody mapped to a discord user go to the default user,
+        # if there is one, and otherwise stay out of the record rather than topping the rankings
+        users = self.config.get('spotify_users', {})
+        default = self.config.get('spotify_default_user')
+        rows, unattributed = [], 0
+        for track_id, item in remote.items():
+            if track_id in local:
+                continue
+            uid = users.get((item.get('added_by') or {}).get('id'), default)
+            if uid is None:
+                unattributed += 1
+            else:
+                rows.append((uid, track_id, Manager.added_time(item)))
+        if unattributed:
+            log.info(f'Skipped {unattributed} tracks in {playlist} added by Spotify users with no Discord user')
+        held = set(uri.split(':')[-1] for uri in self.queue.held(playlist))
+        added = parser.append_tracks(rows) if rows else []
+        removed = parser.remove_tracks([track_id for track_id in local if track_id not in remote and track_id not in held])
+        if self.seen is not None:
+            for _, track_id, _ in added:
+                self.seen.add(track_id)
+            for track_id in removed:
+                self.seen.discard(track_id)
+        if added or removed:
+            self.alltime = None
+            self.history = None
+            self.samples = None
+            self.changed()
+        if parser is self.parser:
+            self.snapshot = state['snapshot_id']
+        log.info(f'Synced {parser.file} with {playlist} over {len(pages)} pages: {len(added)} added, {len(removed)} removed')
+        return len(added), len(removed)
+
+    async def remove_from_playlist(self, tracks):
+        # links, URIs or IDs; removed from spotify and then the local record
+        track_ids = list(dict.fromkeys(track_id_from(track) or track for track in tracks))
+        parser = self.parser
+        playlist = parser.get_playlist()
+        await self.queue.drain(playlist)
+        for i in range(0, len(track_ids), 100):
+            await self.sp.remove(['spotify:track:' + track_id for track_id in track_ids[i:i + 100]], playlist)
+        removed = parser.remove_tracks(track_ids)
+        if self.seen is not None:
+            for track_id in removed:
+                self.seen.discard(track_id)
+        if removed:
+            self.alltime = None
+            self.history = None
+            self.samples = None
+            self.changed()
+        return removed
+
+    @staticmethod
+    def added_time(item):
+        # very old playlist items have no added_at
+        if not item.get('added_at'):
+            return int(time.time())
+        return int(datetime.datetime.fromisoformat(item['added_at'].replace('Z', '+00:00')).timestamp())
 
     def get_playlist_link(self):
-        return self.sp.get_playlist()
+        return self.sp.get_playlist(self.parser.get_playlist())
 
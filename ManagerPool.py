@@ -0,0 +1,216 @@
+from SpotifyHandler import HandlerFactory, AsyncSpotify, CircuitBreaker
+from SQLtools import SQLparser, connect
+from AddQueue import AddQueue
+from TrackCache import TrackCache
+from SharedState import SharedStateFactory
+from Metrics import queue_depth, channels_loaded
+from Manager import Manager
+from typing import NamedTuple, Optional
+import logging, asyncio, glob, os, time
+log = logging.getLogger('pool')
+
+class Mapping(NamedTuple):
+    guild: Optional[int] # None matches any guild
+    channel: int
+    title: str
+    data_dir: str
+    prefix: str # playlist name prefix when sharing the SQLite store
+
+# every watched channel gets its own Manager, loaded on first use and closed
+# again once it has been idle for a while. they all share one spotify client
+# (and so one worker pool and circuit breaker), one add queue, one track
+# cache and one storage connection. when sharded, a pool only takes the
+# channels of guilds on its own shards, and shares dedupe sets, active
+# playlists and the add spool with the other shards through SharedState.
+class ManagerPool:
+    def __init__(self, config, tokens, reload = True, fallback_name = None, shard_ids = None, shard_count = 1, clock = time.time):
+        self.timings: dict[str, float] = {} # startup phases, in seconds
+        start = time.perf_counter()
+        timeout = config.get('spotify_timeout', 10.0)
+        breaker = CircuitBreaker(threshold = config.get('breaker_threshold', 5), reset_after = config.get('breaker_reset', 60.0))
+        self.sp = AsyncSpotify(HandlerFactory().get_handler(config['use_spotify'], tokens, timeout, config.get('spotify_api_url')),
+                               max_workers = config.get('spotify_workers', 4), timeout = timeout,
+                               retries = config.get('spotify_retries', 4), retry_budget = config.get('spotify_retry_budget', 30.0),
+                               breaker = breaker)
+        self.timings['spotify client'] = time.perf_counter() - start
+        start = time.perf_counter()
+        self.shared = SharedStateFactory().get_state(config)
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        # an in-memory spool would be lost on exit, so that one stays in the spool file
+        self.queue = AddQueue(self.sp, window = config.get('add_window', 1.0), max_batch = config.get('add_batch', 100),
+                              spool_file = config.get('add_spool_file'), shared = self.shared if self.shared.durable else None,
+                              spool_key = 'spool' if shard_ids is None else 'spool:' + ','.join(map(str, shard_ids)))
+        self.track_cache = TrackCache(self.sp, max_size = config.get('track_cache_size', 2048),
+                                      file_name = config.get('track_cache_file'))
+        self.config = config
+        self.conn = connect(config['sqlite_file']) if config.get('storage') == 'sqlite' else None
+        self.timings['storage open'] = time.perf_counter() - start
+        self.idle_timeout = config.get('idle_timeout', 3600.0)
+        self.evict_interval = config.get('evict_interval', 300.0)
+        self.sync_interval = config.get('sync_interval') # None leaves syncing to the reconcile command
+        self.clock = clock
+        self.rollover_interval = config.get('rollover_check', 60.0)
+        self.on_rollover = None # coroutine fn (manager, old playlist link), for announcing a new month
+        # whether a channel's first load picks up its latest playlist, and what to open otherwise
+        self.reload = reload
+        self.fallback_name = fallback_name
+        self.started: set[int] = set()
+        self.mappings: dict[int, Mapping] = {mapping.channel: mapping for mapping in ManagerPool.read_mappings(config)
+                                             if self.owns(mapping.guild)}
+        self.by_guild: dict[Optional[int], int] = {}
+        for mapping in self.mappings.values():
+            # commands outside a watched channel go to the guild's first one
+            self.by_guild.setdefault(mapping.guild, mapping.channel)
+        self.managers: dict[int, Manager] = {}
+        self.loading: dict[int, asyncio.Task] = {}
+        self.evictor: Optional[asyncio.Task] = None
+        self.syncer: Optional[asyncio.Task] = None
+        self.roller: Optional[asyncio.Task] = None
+        queue_depth.fn = lambda: self.queue.depth
+        channels_loaded.fn = lambda: len(self.managers)
+        log.info(f'Watching {len(self.mappings)} channels in {len(self.by_guild)} guilds')
+
+    @staticmethod
+    def read_mappings(config) -> list[Mapping]:
+        if 'channels' not in config:
+            # single channel setup: keep the original layout
+            return [Mapping(None, config['watch_channel'], config.get('title', 'Sandyland'), 'playlist_data', '')]
+        out = []
+        for entry in config['channels']:
+            data_dir = entry.get('data_dir', f"playlist_data/{entry['channel']}")
+            prefix = '' if data_dir == 'playlist_data' else f"{entry['channel']}/"
+            out.append(Mapping(entry.get('guild'), entry['channel'], entry.get('title', 'Sandyland'), data_dir, prefix))
+        return out
+
+    def owns(self, guild_id) -> bool:
+        # discord's shard assignment; mappings without a guild go to shard 0
+        if self.shard_ids is None:
+            return True
+        shard = 0 if guild_id is None else (guild_id >> 22) % self.shard_count
+        return shard in self.shard_ids
+
+    async def start(self):
+        start = time.perf_counter()
+        try:
+            await self.sp.authenticate()
+        except Exception as e:
+            log.warning(f'Could not authenticate with Spotify yet, will retry on the first call: {e!r}')
+        self.timings['spotify auth'] = time.perf_counter() - start
+        # replay anything left in the spool by a previous run
+        self.queue.resume()
+        self.evictor = asyncio.get_running_loop().create_task(self.evict_idle())
+        if self.sync_interval:
+            self.syncer = asyncio.get_running_loop().create_task(self.sync_loaded())
+        self.roller = asyncio.get_running_loop().create_task(self.roll_loaded())
+
+    def watches(self, channel_id) -> bool:
+        return channel_id in self.mappings
+
+    def mapping_for(self, guild_id, channel_id) -> Optional[Mapping]:
+        if channel_id in self.mappings:
+            return self.mappings[channel_id]
+        channel_id = self.by_guild.get(guild_id, self.by_guild.get(None))
+        return None if channel_id is None else self.mappings[channel_id]
+
+    async def for_context(self, ctx) -> Optional[Manager]:
+        # anything with .guild and .channel: a Context, Message or Interaction
+        mapping = self.mapping_for(getattr(ctx.guild, 'id', None), getattr(ctx.channel, 'id', None))
+        return None if mapping is None else await self.acquire(mapping.channel)
+
+    async def acquire(self, channel_id) -> Optional[Manager]:
+        manager = self.managers.get(channel_id)
+        if manager is None:
+            if channel_id not in self.mappings:
+                return None
+            if channel_id not in self.loading:
+                self.loading[channel_id] = asyncio.get_running_loop().create_task(self.load(self.mappings[channel_id]))
+            # concurrent callers share one load, and a cancelled caller doesn't cancel it
+            manager = await asyncio.shield(self.loading[channel_id])
+        manager.last_used = time.monotonic()
+        return manager
+
+    async def load(self, mapping) -> Manager:
+        try:
+            os.makedirs(mapping.data_dir, exist_ok=True)
+            manager = Manager(self.config, self, mapping)
+            await manager.start(self.first_file(mapping))
+            self.managers[mapping.channel] = manager
+            log.info(f'Loaded {mapping.channel}: {manager.parser.file}, {len(self.managers)} channels loaded')
+            return manager
+        finally:
+            del self.loading[mapping.channel]
+
+    def first_file(self, mapping) -> Optional[str]:
+        if not self.reload and mapping.channel not in self.started:
+            self.started.add(mapping.channel)
+            return None if self.fallback_name is None else os.path.join(mapping.data_dir, self.fallback_name)
+        self.started.add(mapping.channel)
+        return self.latest(mapping)
+
+    def latest(self, mapping) -> Optional[str]:
+        # whichever shard last swapped this channel's playlist recorded it
+        active = self.shared.get(f'active:{mapping.channel}')
+        if active is not None:
+            return active
+        # otherwise the manifest from the last run, so there is nothing to scan
+        manifest = Manager.read_manifest(mapping.data_dir)
+        if manifest is not None:
+            return manifest['file']
+        log.info(f'No manifest for {mapping.channel}, looking for its latest playlist')
+        if self.conn is not None:
+            return SQLparser.latest(self.conn, mapping.prefix)
+        list_of_files = glob.glob(os.path.join(mapping.data_dir, '*.json'))
+        return None if not len(list_of_files) else max(list_of_files, key=os.path.getctime)
+
+    async def evict_idle(self):
+        while True:
+            await asyncio.sleep(self.evict_interval)
+            cutoff = time.monotonic() - self.idle_timeout
+            for channel_id, manager in list(self.managers.items()):
+                # keep managers whose adds could still need rolling back
+                if manager.last_used < cutoff and not self.queue.holds(manager.parser.get_playlist()) and manager.previous is None:
+                    self.evict(channel_id)
+
+    async def sync_loaded(self):
+        # an unchanged playlist costs one request, so checking every loaded channel is cheap
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            for channel_id, manager in list(self.managers.items()):
+                try:
+                    await manager.sync()
+                except Exception as e:
+                    log.warning(f'Could not sync {channel_id} with Spotify: {e!r}')
+
+    async def roll_loaded(self):
+        # channels that aren't loaded catch up on their rollover when they next are
+        while True:
+            await asyncio.sleep(self.rollover_interval)
+            now = self.clock()
+            for channel_id, manager in list(self.managers.items()):
+                try:
+                    await manager.tick(now)
+                except Exception as e:
+                    log.warning(f'Could not roll {channel_id} over to a new playlist: {e!r}')
+
+    def evict(self, channel_id):
+        manager = self.managers.pop(channel_id)
+        manager.unload()
+        log.info(f'Evicted idle channel {channel_id}, {len(self.managers)} channels loaded')
+
+    async def shutdown(self):
+        if self.evictor is not None:
+            self.evictor.cancel()
+        if self.syncer is not None:
+            self.syncer.cancel()
+        if self.roller is not None:
+            self.roller.cancel()
+        try:
+            await asyncio.wait_for(self.queue.drain(), 30)
+        except asyncio.TimeoutError:
+            log.error(f'Shutting down with {self.queue.depth} tracks still waiting to be added to Spotify')
+        self.queue.close()
+        self.track_cache.save()
+        for channel_id in list(self.managers):
+            self.evict(channel_id)
+        self.sp.close()
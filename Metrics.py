@@ -0,0 +1,170 @@
+from bisect import bisect_left
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Callable, Optional
+import logging, threading
+log = logging.getLogger('metrics')
+
+# counters, gauges and latency histograms in the Prometheus text format.
+# an update is a dict lookup and an add under an uncontended lock, cheap
+# enough to leave on everywhere; rendering only happens when scraped.
+class Metric:
+    kind: str = 'untyped'
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.lock = threading.Lock()
+
+    def label_text(self, values: tuple, extra: str = '') -> str:
+        pairs = [f'{label}="{value}"' for label, value in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def render(self) -> list[str]:
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = ()) -> None:
+        super().__init__(name, help_text, labels)
+        self.values: dict[tuple, float] = {} if labels else {(): 0}
+
+    def inc(self, *labels, n: float = 1) -> None:
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + n
+
+    def render(self) -> list[str]:
+        return super().render() + [f'{self.name}{self.label_text(labels)} {value:g}' for labels, value in sorted(self.values.items())]
+
+    def summary(self) -> list[str]:
+        return [f'{self.name}{self.label_text(labels)} {value:g}' for labels, value in sorted(self.values.items())]
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = ()) -> None:
+        super().__init__(name, help_text, labels)
+        self.values: dict[tuple, float] = {}
+        self.fn: Optional[Callable[[], float]] = None # read at render time instead, for unlabelled gauges
+
+    def set(self, value: float, *labels) -> None:
+        self.values[labels] = value
+
+    def current(self) -> dict[tuple, float]:
+        return {(): self.fn()} if self.fn is not None else dict(self.values)
+
+    def render(self) -> list[str]:
+        return super().render() + [f'{self.name}{self.label_text(labels)} {value:g}' for labels, value in sorted(self.current().items())]
+
+    def summary(self) -> list[str]:
+        return [f'{self.name}{self.label_text(labels)} {value:g}' for labels, value in sorted(self.current().items())]
+
+class Histogram(Metric):
+    kind = 'histogram'
+    default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = default_buckets) -> None:
+        super().__init__(name, help_text, labels)
+        self.buckets = buckets
+        self.values: dict[tuple, list] = {} # labels -> [per-bucket counts (+inf last), sum, count]
+
+    def observe(self, value: float, *labels) -> None:
+        idx = bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][idx] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def quantile(self, labels: tuple, q: float) -> float:
+        # upper bound of the bucket holding the q-th observation
+        counts, _, total = self.values[labels]
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            seen += count
+            if seen >= q * total:
+                return bound
+        return float('inf')
+
+    def render(self) -> list[str]:
+        out = super().render()
+        for labels, (counts, total, n) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{bound:g}"'
+                out.append(f'{self.name}_bucket{self.label_text(labels, le)} {cumulative}')
+            out.append(f'{self.name}_sum{self.label_text(labels)} {total:g}')
+            out.append(f'{self.name}_count{self.label_text(labels)} {n}')
+        return out
+
+    def summary(self) -> list[str]:
+        return [f'{self.name}{self.label_text(labels)} n={n} avg={total / n * 1000:.1f}ms p99<={self.quantile(labels, 0.99) * 1000:g}ms'
+                for labels, (_, total, n) in sorted(self.values.items())]
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: list[Metric] = []
+
+    def add(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return '\n'.join(line for metric in self.metrics for line in metric.render()) + '\n'
+
+    def summary(self) -> list[str]:
+        return [line for metric in self.metrics for line in metric.summary()]
+
+registry = Registry()
+messages_scanned = registry.add(Counter('spotibot_messages_scanned_total', 'Messages in watched channels checked for links'))
+links_extracted = registry.add(Counter('spotibot_links_extracted_total', 'Spotify track links found in messages'))
+tracks_added = registry.add(Counter('spotibot_tracks_added_total', 'Tracks recorded and queued for Spotify'))
+duplicates_skipped = registry.add(Counter('spotibot_duplicates_skipped_total', 'Tracks skipped as already posted', ('scope',)))
+storage_writes = registry.add(Histogram('spotibot_storage_write_seconds', 'Time spent writing playlist storage', ('store',)))
+spotify_calls = registry.add(Histogram('spotibot_spotify_call_seconds', 'Latency of single Spotify API attempts', ('endpoint',)))
+spotify_errors = registry.add(Counter('spotibot_spotify_errors_total', 'Failed Spotify API attempts', ('endpoint', 'status')))
+user_fetches = registry.add(Counter('spotibot_user_fetches_total', 'Discord fetch_user REST calls'))
+command_times = registry.add(Histogram('spotibot_command_seconds', 'Time to run and render each command', ('command',)))
+command_errors = registry.add(Counter('spotibot_command_errors_total', 'Commands that raised', ('command',)))
+queue_depth = registry.add(Gauge('spotibot_add_queue_depth', 'Tracks waiting to be added to Spotify'))
+render_cache = registry.add(Counter('spotibot_render_cache_total', 'Leaderboard and lasttrack tables by render cache result', ('result',)))
+channels_loaded = registry.add(Gauge('spotibot_channels_loaded', 'Watched channels with their playlist in memory'))
+
+class MetricsServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port: int = 9100, host: str = '127.0.0.1') -> None:
+        super().__init__((host, port), MetricsRequest)
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self) -> 'MetricsServer':
+        self.thread = threading.Thread(target=self.serve_forever, name='metrics', daemon=True)
+        self.thread.start()
+        host, port = self.server_address[:2]
+        log.info(f'Serving metrics on http://{host}:{port}/metrics')
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+class MetricsRequest(BaseHTTPRequestHandler):
+    def log_message(self, format, *args) -> None:
+        log.debug(format % args)
+
+    def do_GET(self) -> None:
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        out = registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
@@ -0,0 +1,90 @@
+from bisect import bisect_left, insort
+from typing import Iterable, Optional
+
+# running per-user aggregates for the leaderboard and lasttrack tables.
+# both orderings are kept as sorted lists of (-value, uid) so the top rows
+# are a slice and a user's rank is a binary search.
+class RankingIndex:
+    def __init__(self) -> None:
+        self.counts: dict[int, int] = {}
+        self.last: dict[int, tuple[str, int]] = {} # uid -> (track, time)
+        self.total: int = 0
+        self.by_count: list[tuple[int, int]] = []
+        self.by_time: list[tuple[int, int]] = []
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def add(self, uid: int, track_id: str, when: int, n: int = 1) -> None:
+        old = self.counts.get(uid, 0)
+        if old:
+            self.discard(self.by_count, (-old, uid))
+        self.counts[uid] = old + n
+        insort(self.by_count, (-(old + n), uid))
+        self.total += n
+        # a post can be processed after a later one (a backfill, or a slow link)
+        if uid not in self.last or when >= self.last[uid][1]:
+            self.set_last(uid, (track_id, when))
+
+    def remove(self, uid: int, last: Optional[tuple[str, int]]) -> None:
+        # last is the user's latest (track, time) once the removal is done
+        old = self.counts.get(uid, 0)
+        if not old:
+            return
+        self.discard(self.by_count, (-old, uid))
+        self.total -= 1
+        if old > 1:
+            self.counts[uid] = old - 1
+            insort(self.by_count, (-(old - 1), uid))
+        else:
+            del self.counts[uid]
+        self.set_last(uid, last)
+
+    def set_last(self, uid: int, last: Optional[tuple[str, int]]) -> None:
+        if uid in self.last:
+            self.discard(self.by_time, (-self.last[uid][1], uid))
+            del self.last[uid]
+        if last is not None:
+            self.last[uid] = last
+            insort(self.by_time, (-last[1], uid))
+
+    def top_counts(self, n: int = 10) -> list[tuple[int, int]]:
+        return [(uid, -count) for count, uid in self.by_count[:n]]
+
+    def top_recent(self, n: int = 10) -> list[tuple[int, str, int]]:
+        return [(uid, *self.last[uid]) for _, uid in self.by_time[:n]]
+
+    def count_rank(self, uid: int) -> Optional[int]:
+        if uid not in self.counts:
+            return None
+        return bisect_left(self.by_count, (-self.counts[uid], uid)) + 1
+
+    def recent_rank(self, uid: int) -> Optional[int]:
+        if uid not in self.last:
+            return None
+        return bisect_left(self.by_time, (-self.last[uid][1], uid)) + 1
+
+    @staticmethod
+    def discard(order: list[tuple[int, int]], key: tuple[int, int]) -> None:
+        idx = bisect_left(order, key)
+        if idx < len(order) and order[idx] == key:
+            del order[idx]
+
+    @staticmethod
+    def from_users(users: dict[int, dict[str, list]]) -> 'RankingIndex':
+        return RankingIndex.from_rows((uid, len(data['tracks']), data['tracks'][-1], data['times'][-1])
+                                      for uid, data in users.items() if data['tracks'])
+
+    @staticmethod
+    def from_rows(rows: Iterable[tuple[int, int, str, int]]) -> 'RankingIndex':
+        # rows of (uid, count, last track, last time), possibly several per user
+        # (one per month), which are summed and the latest track kept
+        index = RankingIndex()
+        for uid, count, track_id, when in rows:
+            index.counts[uid] = index.counts.get(uid, 0) + count
+            index.total += count
+            if uid not in index.last or when >= index.last[uid][1]:
+                index.last[uid] = (track_id, when)
+        index.by_count = sorted((-count, uid) for uid, count in index.counts.items())
+        index.by_time = sorted((-last[1], uid) for uid, last in index.last.items())
+        return index
@@ -0,0 +1,48 @@
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+from Metrics import render_cache
+import logging, time
+log = logging.getLogger('renders')
+
+# the top rows of the leaderboard and lasttrack tables, shared by everyone
+# who asks until the data behind them changes. an entry remembers the
+# manager version it was rendered at, so a new track or a new playlist makes
+# it stale without any bookkeeping at the write end. entries also age out
+# after `ttl`, since display names and track metadata can change underneath.
+# callers render only their own line on top of the cached rows, which is
+# why the rankings the rows came from are cached alongside them.
+class RenderCache:
+    def __init__(self, max_size: int = 256, ttl: float = 300.0, clock: Callable[[], float] = time.monotonic) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries: OrderedDict[tuple, tuple[int, float, Any]] = OrderedDict() # key -> (version, rendered at, body)
+        self.hits: int = 0
+        self.misses: int = 0
+        self.stale: int = 0 # misses where an older render was thrown away
+
+    def get(self, key: tuple, version: int) -> Optional[Any]:
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == version and self.clock() - entry[1] < self.ttl:
+            self.hits += 1
+            render_cache.inc('hit')
+            self.entries.move_to_end(key)
+            return entry[2]
+        if entry is not None:
+            self.stale += 1
+            del self.entries[key]
+            log.debug(f'Dropped stale render of {key}')
+        self.misses += 1
+        render_cache.inc('miss')
+        return None
+
+    def put(self, key: tuple, version: int, body: Any) -> None:
+        self.entries[key] = (version, self.clock(), body)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict[str, float]:
+        lookups = self.hits + self.misses
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'stale': self.stale,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
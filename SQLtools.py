@@ -0,0 +1,266 @@
+from typing import Any, Iterable, Optional
+from JSONtools import load_month, month_files
+from Rankings import RankingIndex
+from Sampling import TrackSampler
+from Metrics import storage_writes
+import logging, time, os, sqlite3
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS playlists (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    spotify_id TEXT NOT NULL,
+    creation_time INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS tracks (
+    id INTEGER PRIMARY KEY,
+    playlist INTEGER NOT NULL REFERENCES playlists(id),
+    user INTEGER NOT NULL REFERENCES users(id),
+    track TEXT NOT NULL,
+    time INTEGER NOT NULL,
+    UNIQUE (playlist, track)
+);
+CREATE INDEX IF NOT EXISTS tracks_playlist_user ON tracks (playlist, user, time);
+CREATE INDEX IF NOT EXISTS tracks_playlist_time ON tracks (playlist, time);
+'''
+
+def connect(db_file: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_file)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.executescript(SCHEMA)
+    return conn
+
+# same interface as JSONparser, but every month lives in one database.
+# playlists are keyed by the name a JSON file would have had, e.g. 2024-03,
+# behind a per-channel prefix when several channels share the database
+class SQLparser:
+    def __init__(self, file_name: Optional[str] = None, playlist_id: Optional[str] = None,
+                 db_file: str = 'playlist_data/spotibot.db', conn: Optional[sqlite3.Connection] = None,
+                 prefix: str = '', shared = None, creation_time: Optional[int] = None) -> None:
+        self.file: str = prefix + SQLparser.name_of(file_name or SQLparser.file_by_date())
+        self.conn = connect(db_file) if conn is None else conn
+        self.shared = shared # SharedState, for shards that don't share this database
+        row = self.conn.execute('SELECT id, spotify_id, creation_time FROM playlists WHERE name = ?', (self.file,)).fetchone()
+        self.is_new = row is None
+        if self.is_new:
+            logging.getLogger('SQL.init').info(f'Creating new playlist: {self.file}')
+            self.creation_time: int = int(time.time()) if creation_time is None else creation_time
+            self.playlist: str = 'N/A' if playlist_id is None else playlist_id
+            with self.conn:
+                cur = self.conn.execute('INSERT INTO playlists (name, spotify_id, creation_time) VALUES (?, ?, ?)',
+                                        (self.file, self.playlist, self.creation_time))
+            self.row_id: int = cur.lastrowid
+        else:
+            logging.getLogger('SQL.init').info(f'Reading existing playlist: {self.file}')
+            self.row_id, self.playlist, self.creation_time = row
+        self.rankings = self.read_rankings()
+        self.sampler = TrackSampler.from_rows(self.conn.execute('SELECT user, track FROM tracks WHERE playlist = ?', (self.row_id,)))
+        if self.shared is not None:
+            self.shared.seed(self.file, (track for track, in self.conn.execute('SELECT track FROM tracks WHERE playlist = ?', (self.row_id,))))
+        logging.getLogger('SQL.init').debug(f'{self.playlist = }, {self.creation_time = }, {self.row_id = }')
+
+    def get_playlist(self) -> str:
+        return self.playlist
+
+    def append_track(self, disc_id: int, track_id: str, when: Optional[int] = None) -> bool:
+        if self.shared is not None and not self.shared.claim(self.file, track_id):
+            logging.getLogger('SQL.append').info(f'Skipped {disc_id}: {track_id} as another shard has it')
+            return False
+        disc_id = int(disc_id)
+        when = int(time.time()) if when is None else int(when)
+        start = time.perf_counter()
+        # the UNIQUE (playlist, track) index doubles as the duplicate check
+        with self.conn:
+            self.conn.execute('INSERT OR IGNORE INTO users (id) VALUES (?)', (disc_id,))
+            cur = self.conn.execute('INSERT OR IGNORE INTO tracks (playlist, user, track, time) VALUES (?, ?, ?, ?)',
+                                    (self.row_id, disc_id, track_id, when))
+        storage_writes.observe(time.perf_counter() - start, 'sqlite')
+        if cur.rowcount == 0:
+            logging.getLogger('SQL.append').info(f'Skipped {disc_id}: {track_id} as track already exists')
+            return False
+        self.rankings.add(disc_id, track_id, when)
+        self.sampler.add(disc_id, track_id)
+        logging.getLogger('SQL.append').info(f'Logged {disc_id}: {track_id} to {self.file}')
+        return True
+
+    def append_tracks(self, rows: list[tuple[int, str, int]]) -> list[tuple[int, str, int]]:
+        # a backfill of (discord id, track, time) rows, inserted in one transaction
+        existing = self.get_track_ids()
+        fresh = {}
+        for disc_id, track_id, when in rows:
+            if track_id not in existing and track_id not in fresh:
+                fresh[track_id] = (int(disc_id), track_id, int(when))
+        if self.shared is not None:
+            fresh = {track_id: row for track_id, row in fresh.items() if self.shared.claim(self.file, track_id)}
+        added = list(fresh.values())
+        if not added:
+            return added
+        start = time.perf_counter()
+        with self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO users (id) VALUES (?)', set((disc_id,) for disc_id, _, _ in added))
+            self.conn.executemany('INSERT INTO tracks (playlist, user, track, time) VALUES (?, ?, ?, ?)',
+                                  ((self.row_id, *row) for row in added))
+        storage_writes.observe(time.perf_counter() - start, 'sqlite')
+        self.rankings = self.read_rankings()
+        for disc_id, track_id, _ in added:
+            self.sampler.add(disc_id, track_id)
+        logging.getLogger('SQL.append').info(f'Logged {len(added)} of {len(rows)} backfilled tracks to {self.file}')
+        return added
+
+    def remove_track(self, track_id: str) -> bool:
+        row = self.conn.execute('SELECT user FROM tracks WHERE playlist = ? AND track = ?', (self.row_id, track_id)).fetchone()
+        if row is None:
+            return False
+        with self.conn:
+            self.conn.execute('DELETE FROM tracks WHERE playlist = ? AND track = ?', (self.row_id, track_id))
+        if self.shared is not None:
+            self.shared.release(self.file, track_id)
+        self.rankings.remove(row[0], self.get_last(row[0]))
+        self.sampler.remove(track_id)
+        logging.getLogger('SQL.remove').info(f'Removed {track_id} from {self.file}')
+        return True
+
+    def remove_tracks(self, track_ids: Iterable[str]) -> list[str]:
+        # the bulk version of remove_track, in one transaction
+        existing = self.get_track_ids()
+        gone = [track_id for track_id in dict.fromkeys(track_ids) if track_id in existing]
+        if not gone:
+            return gone
+        with self.conn:
+            self.conn.executemany('DELETE FROM tracks WHERE playlist = ? AND track = ?', ((self.row_id, track_id) for track_id in gone))
+        if self.shared is not None:
+            for track_id in gone:
+                self.shared.release(self.file, track_id)
+        self.rankings = self.read_rankings()
+        for track_id in gone:
+            self.sampler.remove(track_id)
+        logging.getLogger('SQL.remove').info(f'Removed {len(gone)} tracks from {self.file}')
+        return gone
+
+    def flush(self) -> None:
+        self.conn.commit()
+
+    def close(self) -> None:
+        self.conn.commit()
+
+    def get_track_ids(self) -> set[str]:
+        return set(track for track, in self.conn.execute('SELECT track FROM tracks WHERE playlist = ?', (self.row_id,)))
+
+    def manifest(self) -> dict:
+        return {'file': self.file, 'playlist': self.playlist, 'creation_time': self.creation_time}
+
+    def read_rankings(self) -> RankingIndex:
+        return RankingIndex.from_rows((user, count, track, when) for user, when, track, count in self.get_all_last_rows())
+
+    def get_all_track_counts(self) -> dict[int, int]:
+        return dict(self.conn.execute('SELECT user, COUNT(*) FROM tracks WHERE playlist = ? GROUP BY user', (self.row_id,)))
+
+    def get_all_tracks(self) -> dict[int, list[str]]:
+        out = {}
+        for user, track in self.conn.execute('SELECT user, track FROM tracks WHERE playlist = ? ORDER BY id', (self.row_id,)):
+            out.setdefault(user, []).append(track)
+        return out
+
+    def get_all_last_track_times(self) -> dict[int, int]:
+        return {user: when for user, when, _, _ in self.get_all_last_rows()}
+
+    def get_all_last_track_ids(self) -> dict[int, str]:
+        return {user: track for user, _, track, _ in self.get_all_last_rows()}
+
+    def get_all_last_rows(self) -> list[tuple]:
+        # sqlite fills the bare columns from the row holding MAX(time), i.e. the latest post
+        # (backfilled rows can be older than ones added before them)
+        return self.conn.execute('SELECT user, MAX(time), track, COUNT(*) FROM tracks WHERE playlist = ? GROUP BY user',
+                                 (self.row_id,)).fetchall()
+
+    def get_track_count(self, disc_id: int) -> int:
+        return self.conn.execute('SELECT COUNT(*) FROM tracks WHERE playlist = ? AND user = ?',
+                                 (self.row_id, int(disc_id))).fetchone()[0]
+
+    def get_last_track_time(self, disc_id: int) -> int:
+        return self.get_last_attr(disc_id, 'times')
+
+    def get_last_track_id(self, disc_id: int) -> str:
+        return self.get_last_attr(disc_id, 'tracks')
+
+    def get_last_attr(self, disc_id: int, attr: str) -> Any:
+        column = {'tracks': 'track', 'times': 'time'}[attr]
+        row = self.conn.execute(f'SELECT {column} FROM tracks WHERE playlist = ? AND user = ? ORDER BY time DESC, id DESC LIMIT 1',
+                                (self.row_id, int(disc_id))).fetchone()
+        return None if row is None else row[0]
+
+    def get_last(self, disc_id: int) -> Optional[tuple[str, int]]:
+        row = self.conn.execute('SELECT track, time FROM tracks WHERE playlist = ? AND user = ? ORDER BY time DESC, id DESC LIMIT 1',
+                                (self.row_id, int(disc_id))).fetchone()
+        return None if row is None else tuple(row)
+
+    @staticmethod
+    def name_of(file_name: str) -> str:
+        return os.path.splitext(os.path.basename(file_name))[0]
+
+    @staticmethod
+    def file_by_date(when: Optional[float] = None) -> str:
+        curtime = time.gmtime(when)
+        return f"{curtime.tm_year}-{curtime.tm_mon:02}"
+
+    @staticmethod
+    def exists(conn: sqlite3.Connection, file_name: str, prefix: str = '') -> bool:
+        name = prefix + SQLparser.name_of(file_name)
+        return conn.execute('SELECT 1 FROM playlists WHERE name = ?', (name,)).fetchone() is not None
+
+    @staticmethod
+    def unique_name(conn: sqlite3.Connection, prefix: str = '', when: Optional[float] = None) -> str:
+        name = SQLparser.file_by_date(when)
+        path, counter = name, 1
+        while SQLparser.exists(conn, path, prefix):
+            path = name + '-' + str(counter)
+            counter += 1
+        return path
+
+    @staticmethod
+    def latest(conn: sqlite3.Connection, prefix: str = '') -> Optional[str]:
+        row = conn.execute('SELECT name FROM playlists WHERE name GLOB ? ORDER BY creation_time DESC, id DESC LIMIT 1',
+                           (SQLparser.pattern(prefix),)).fetchone()
+        return None if row is None else row[0][len(prefix):]
+
+    @staticmethod
+    def pattern(prefix: str = '') -> str:
+        # GLOB matching one channel's playlists, so '' doesn't pick up other channels' 'prefix/2024-03'
+        return prefix + '[0-9][0-9][0-9][0-9]-[0-9][0-9]*'
+
+    @staticmethod
+    def import_json(conn: sqlite3.Connection, file_name: str) -> bool:
+        # pulls in a monthly JSON file (plus its event log tail, if any)
+        name = SQLparser.name_of(file_name)
+        if SQLparser.exists(conn, name):
+            logging.getLogger('SQL.import').info(f'{name} already imported, skipping')
+            return False
+        cur_dict = load_month(file_name)
+        events = [(users, track, when) for users in cur_dict.keys() if type(users) == int
+                  for track, when in zip(cur_dict[users]['tracks'], cur_dict[users]['times'])]
+        events.sort(key=lambda e: e[2]) # stable, so per-user order is kept
+        with conn:
+            row_id = conn.execute('INSERT INTO playlists (name, spotify_id, creation_time) VALUES (?, ?, ?)',
+                                  (name, cur_dict['playlist'], cur_dict['creation_time'])).lastrowid
+            conn.executemany('INSERT OR IGNORE INTO users (id) VALUES (?)', ((users,) for users, _, _ in events))
+            conn.executemany('INSERT OR IGNORE INTO tracks (playlist, user, track, time) VALUES (?, ?, ?, ?)',
+                             ((row_id, users, track, when) for users, track, when in events))
+        logging.getLogger('SQL.import').info(f'Imported {len(events)} tracks from {file_name} as {name}')
+        return True
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(prog = 'SQLtools.py', description='Import monthly playlist JSON files into the SQLite store.')
+    parser.add_argument('files', nargs='*', help='files to import (default: every month in playlist_data)')
+    parser.add_argument('-d', '--db', type = str, help ='SQLite database to import into', default = 'playlist_data/spotibot.db')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    conn = connect(args.db)
+    for file_name in args.files or month_files('playlist_data'):
+        SQLparser.import_json(conn, file_name)
+    conn.close()
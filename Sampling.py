@@ -0,0 +1,118 @@
+from typing import Iterable, Optional
+import random
+
+# random picks for the random command without copying any track lists.
+# every track sits in one flat list, and each user keeps the slots holding
+# their tracks, so a uniform pick, a pick from one user and a "fair" pick
+# (user first, then one of their tracks) are each a couple of randrange
+# calls. a removal moves the last slot into the hole, so both stay dense.
+class TrackSampler:
+    def __init__(self) -> None:
+        self.tracks: list[str] = []
+        self.owners: list[int] = [] # user of each slot
+        self.where: list[int] = [] # each slot's position in its user's list
+        self.slots: dict[str, int] = {} # track -> its (latest) slot
+        self.by_user: dict[int, list[int]] = {}
+        self.users: list[int] = [] # users with at least one track
+        self.user_pos: dict[int, int] = {}
+        self.removals: int = 0 # sessions start over once slots have moved
+
+    def __len__(self) -> int:
+        return len(self.tracks)
+
+    def add(self, uid: int, track_id: str) -> None:
+        slot = len(self.tracks)
+        user = self.by_user.get(uid)
+        if user is None:
+            user = self.by_user[uid] = []
+            self.user_pos[uid] = len(self.users)
+            self.users.append(uid)
+        self.tracks.append(track_id)
+        self.owners.append(uid)
+        self.where.append(len(user))
+        user.append(slot)
+        self.slots[track_id] = slot
+
+    def remove(self, track_id: str) -> bool:
+        slot = self.slots.pop(track_id, None)
+        if slot is None:
+            return False
+        uid = self.owners[slot]
+        TrackSampler.take(self.by_user[uid], self.where[slot], self.where)
+        if not self.by_user[uid]:
+            del self.by_user[uid]
+            TrackSampler.take(self.users, self.user_pos.pop(uid), self.user_pos)
+        # fill the hole with the last slot
+        last = len(self.tracks) - 1
+        if slot != last:
+            moved, owner = self.tracks[last], self.owners[last]
+            self.tracks[slot], self.owners[slot], self.where[slot] = moved, owner, self.where[last]
+            self.by_user[owner][self.where[slot]] = slot
+            if self.slots.get(moved) == last:
+                self.slots[moved] = slot
+        self.tracks.pop()
+        self.owners.pop()
+        self.where.pop()
+        self.removals += 1
+        return True
+
+    @staticmethod
+    def take(items: list, idx: int, positions) -> None:
+        # swap-remove items[idx], keeping the moved item's entry in positions in step
+        last = items.pop()
+        if idx < len(items):
+            items[idx] = last
+            positions[last] = idx
+
+    def sample(self, uid: Optional[int] = None, fair: bool = False, session: Optional['SampleSession'] = None,
+               rng: random.Random = random) -> Optional[str]:
+        # uniform over tracks, over one user's tracks, or over users and then their tracks.
+        # with a session, nothing repeats until everything in that pool has come up
+        if uid is None and fair and self.users:
+            uid = self.users[rng.randrange(len(self.users))]
+        if uid is None:
+            if not self.tracks:
+                return None
+            idx = rng.randrange(len(self.tracks)) if session is None else session.draw(self, None, len(self.tracks), rng)
+            return self.tracks[idx]
+        slots = self.by_user.get(uid)
+        if not slots:
+            return None
+        idx = rng.randrange(len(slots)) if session is None else session.draw(self, uid, len(slots), rng)
+        return self.tracks[slots[idx]]
+
+    @staticmethod
+    def from_rows(rows: Iterable[tuple[int, str]]) -> 'TrackSampler':
+        sampler = TrackSampler()
+        for uid, track_id in rows:
+            sampler.add(uid, track_id)
+        return sampler
+
+    @staticmethod
+    def from_users(users: dict[int, dict[str, list]]) -> 'TrackSampler':
+        return TrackSampler.from_rows((uid, track_id) for uid, data in users.items() for track_id in data['tracks'])
+
+# draws without repeats, as a Fisher-Yates shuffle done one step per draw:
+# only the swapped positions are stored, so a draw costs O(1) whatever the
+# pool size. new tracks join the undrawn part; once a pool is used up it
+# starts over.
+class SampleSession:
+    def __init__(self) -> None:
+        self.sampler: Optional[TrackSampler] = None
+        self.removals: int = 0
+        self.pools: dict[Optional[int], list] = {} # user (None for everyone) -> [draws so far, swapped positions]
+
+    def draw(self, sampler: TrackSampler, pool: Optional[int], size: int, rng: random.Random) -> int:
+        if sampler is not self.sampler or sampler.removals != self.removals:
+            self.sampler, self.removals = sampler, sampler.removals
+            self.pools.clear()
+        state = self.pools.setdefault(pool, [0, {}])
+        k, swaps = state
+        if k >= size:
+            k = 0
+            swaps.clear()
+        j = rng.randrange(k, size)
+        out = swaps.get(j, j)
+        swaps[j] = swaps.get(k, k)
+        state[0] = k + 1
+        return out
@@ -0,0 +1,162 @@
+from heapq import merge
+from typing import Iterable, Optional
+import logging, mmap, os, struct
+log = logging.getLogger('seen')
+
+BASE62 = '0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+DIGITS = {c: i for i, c in enumerate(BASE62)}
+HEADER = struct.Struct('<8sIQQ4x') # magic, version, key count, odd bytes
+MAGIC = b'SPOTSEEN'
+
+# every track ID ever posted in a channel, for a duplicate check across
+# months. spotify IDs are 128-bit numbers in base62, so the file holds them
+# as sorted 16-byte big-endian keys (byte order is numeric order) that are
+# memory-mapped and binary searched in place: opening it costs nothing and
+# only the pages a lookup touches get read. tracks added since the last
+# save sit in a small set until they are merged in. the odd ID that doesn't
+# decode is kept verbatim after the keys.
+class SeenIndex:
+    width: int = 16
+
+    def __init__(self, file_name: str) -> None:
+        self.file = file_name
+        self.mm: Optional[mmap.mmap] = None
+        self.count: int = 0
+        self.odd: set[str] = set()
+        self.added: set[int] = set()
+        self.removed: set[int] = set()
+        self.dirty = False
+        if os.path.exists(self.file):
+            self.map()
+
+    def map(self) -> None:
+        with open(self.file, 'rb') as index_file:
+            magic, version, self.count, odd_size = HEADER.unpack(index_file.read(HEADER.size))
+            if magic != MAGIC or version != 1:
+                raise ValueError(f'{self.file} is not a seen-track index')
+            if self.count:
+                self.mm = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+            index_file.seek(HEADER.size + self.count * self.width)
+            self.odd = set(index_file.read(odd_size).decode().split('\n')) - {''}
+        log.debug(f'Mapped {self.count} tracks from {self.file}')
+
+    def __len__(self) -> int:
+        return self.count - len(self.removed) + len(self.added) + len(self.odd)
+
+    def __contains__(self, track_id: str) -> bool:
+        key = SeenIndex.key(track_id)
+        if key is None:
+            return track_id in self.odd
+        if key in self.added:
+            return True
+        return key not in self.removed and self.in_file(key)
+
+    def in_file(self, key: int) -> bool:
+        if self.mm is None:
+            return False
+        target = key.to_bytes(self.width, 'big')
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = HEADER.size + mid * self.width
+            found = self.mm[start:start + self.width]
+            if found < target:
+                lo = mid + 1
+            elif found > target:
+                hi = mid
+            else:
+                return True
+        return False
+
+    def add(self, track_id: str) -> None:
+        key = SeenIndex.key(track_id)
+        if key is None:
+            self.odd.add(track_id)
+        else:
+            self.removed.discard(key)
+            if not self.in_file(key):
+                self.added.add(key)
+        self.dirty = True
+
+    def discard(self, track_id: str) -> None:
+        key = SeenIndex.key(track_id)
+        if key is None:
+            self.odd.discard(track_id)
+        elif key in self.added:
+            self.added.discard(key)
+        elif self.in_file(key):
+            self.removed.add(key)
+        self.dirty = True
+
+    def keys(self) -> Iterable[int]:
+        for i in range(self.count):
+            start = HEADER.size + i * self.width
+            yield int.from_bytes(self.mm[start:start + self.width], 'big')
+
+    def save(self) -> None:
+        # merge the new keys into the sorted file and map the result
+        if not self.dirty:
+            return
+        removed = self.removed
+        keys = [key for key in merge(self.keys(), sorted(self.added)) if key not in removed]
+        odd = '\n'.join(sorted(self.odd)).encode()
+        tmp = self.file + '.tmp'
+        with open(tmp, 'wb') as out_file:
+            out_file.write(HEADER.pack(MAGIC, 1, len(keys), len(odd)))
+            for i in range(0, len(keys), 4096):
+                out_file.write(b''.join(key.to_bytes(self.width, 'big') for key in keys[i:i + 4096]))
+            out_file.write(odd)
+            out_file.flush()
+            os.fsync(out_file.fileno())
+        self.unmap()
+        os.replace(tmp, self.file)
+        self.added, self.removed, self.dirty = set(), set(), False
+        self.map()
+        log.info(f'Saved {self.count} tracks to {self.file}')
+
+    def unmap(self) -> None:
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+    def close(self) -> None:
+        self.save()
+        self.unmap()
+
+    @staticmethod
+    def key(track_id: str) -> Optional[int]:
+        if len(track_id) != 22:
+            return None
+        value = 0
+        for c in track_id:
+            digit = DIGITS.get(c)
+            if digit is None:
+                return None
+            value = value * 62 + digit
+        return value if value >> 128 == 0 else None
+
+    @staticmethod
+    def build(file_name: str, track_ids: Iterable[str]) -> 'SeenIndex':
+        index = SeenIndex(file_name)
+        for track_id in track_ids:
+            index.add(track_id)
+        index.dirty = True
+        index.save()
+        return index
+
+
+if __name__ == '__main__':
+    import argparse
+    from JSONtools import load_month, month_files
+    parser = argparse.ArgumentParser(prog = 'SeenIndex.py', description='Build the seen-track index from monthly playlist JSON files.')
+    parser.add_argument('files', nargs='*', help='files to index (default: every month in playlist_data)')
+    parser.add_argument('-o', '--output', type = str, help ='index file to write', default = 'playlist_data/seen.idx')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if os.path.exists(args.output):
+        os.remove(args.output)
+    tracks = []
+    for file_name in args.files or month_files('playlist_data'):
+        cur_dict = load_month(file_name)
+        tracks += [track for uid in cur_dict.keys() if type(uid) == int for track in cur_dict[uid]['tracks']]
+    SeenIndex.build(args.output, tracks).close()
@@ -0,0 +1,99 @@
+from typing import Iterable, Optional
+import redis
+import logging, threading
+log = logging.getLogger('shared')
+
+# state that every shard has to agree on: which tracks each playlist already
+# holds, which playlist a channel is on, and the spool of adds waiting for
+# spotify. RedisState is the real thing; LocalState keeps the same
+# interface in memory for a single process and for testing.
+class LocalState:
+    durable: bool = False
+
+    def __init__(self) -> None:
+        self.sets: dict[str, set[str]] = {}
+        self.values: dict[str, str] = {}
+        self.lists: dict[str, list[str]] = {}
+        self.lock = threading.Lock()
+
+    def claim(self, key: str, member: str) -> bool:
+        # true for exactly one caller per member, like SADD returning 1
+        with self.lock:
+            members = self.sets.setdefault(key, set())
+            if member in members:
+                return False
+            members.add(member)
+            return True
+
+    def release(self, key: str, member: str) -> None:
+        with self.lock:
+            self.sets.get(key, set()).discard(member)
+
+    def seed(self, key: str, members: Iterable[str]) -> None:
+        # replaces the set, see RedisState.seed
+        with self.lock:
+            self.sets[key] = set(members)
+
+    def get(self, key: str) -> Optional[str]:
+        return self.values.get(key)
+
+    def set(self, key: str, value: str) -> None:
+        self.values[key] = value
+
+    def load_list(self, key: str) -> list[str]:
+        return list(self.lists.get(key, []))
+
+    def save_list(self, key: str, items: list[str]) -> None:
+        self.lists[key] = list(items)
+
+class RedisState:
+    durable: bool = True
+    seed_batch: int = 1000
+
+    def __init__(self, url: str, namespace: str = 'spotibot') -> None:
+        self.redis = redis.Redis.from_url(url, decode_responses=True)
+        self.namespace = namespace
+        log.info(f'Using shared state at {url} under {namespace}')
+
+    def key(self, kind: str, key: str) -> str:
+        return f'{self.namespace}:{kind}:{key}'
+
+    def claim(self, key: str, member: str) -> bool:
+        return self.redis.sadd(self.key('tracks', key), member) == 1
+
+    def release(self, key: str, member: str) -> None:
+        self.redis.srem(self.key('tracks', key), member)
+
+    def seed(self, key: str, members: Iterable[str]) -> None:
+        # the set becomes exactly what the month holds on disk. claims outlive the
+        # process, so one whose track was lost from the write-behind store in a
+        # crash would otherwise reject that track for good
+        members = list(members)
+        with self.redis.pipeline(transaction=True) as pipe:
+            pipe.delete(self.key('tracks', key))
+            for i in range(0, len(members), self.seed_batch):
+                pipe.sadd(self.key('tracks', key), *members[i:i + self.seed_batch])
+            pipe.execute()
+
+    def get(self, key: str) -> Optional[str]:
+        return self.redis.get(self.key('value', key))
+
+    def set(self, key: str, value: str) -> None:
+        self.redis.set(self.key('value', key), value)
+
+    def load_list(self, key: str) -> list[str]:
+        return self.redis.lrange(self.key('list', key), 0, -1)
+
+    def save_list(self, key: str, items: list[str]) -> None:
+        with self.redis.pipeline(transaction=True) as pipe:
+            pipe.delete(self.key('list', key))
+            if items:
+                pipe.rpush(self.key('list', key), *items)
+            pipe.execute()
+
+class SharedStateFactory:
+    def get_state(self, config: dict) -> [LocalState, RedisState]:
+        if config.get('redis_url'):
+            return RedisState(config['redis_url'], config.get('redis_namespace', 'spotibot'))
+        else:
+            return LocalState()
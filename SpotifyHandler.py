@@ -1,16 +1,40 @@
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth
-import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from Metrics import spotify_calls, spotify_errors
+import requests
+import logging, asyncio, functools, random, time
 log = logging.getLogger('SPOTIFY')
 
 class SpotifyHandler:
 	scopes: str = 'playlist-modify-public'
-	def __init__(self, credentials: dict[str, str]) -> None:
-		log.debug(f'Creating real API object')
-		self.spotify = spotipy.Spotify(auth_manager=SpotifyOAuth(scope=self.scopes, 
-			client_id=credentials['spotify_client_id'], client_secret=credentials['spotify_secret'], redirect_uri=credentials['spotify_redirect_uri']))
+	item_fields: str = 'items(added_at,added_by.id,track(id,type,is_local))' # all a sync needs from each item
+	def __init__(self, credentials: dict[str, str], timeout: float = 10.0, api_url: Optional[str] = None) -> None:
+		if api_url is not None:
+			# a local stand-in (see FakeSpotify.py) only needs some bearer token
+			log.warning(f'Using Spotify API at {api_url}')
+			self.spotify = spotipy.Spotify(auth='local-token', requests_timeout=timeout, requests_session=SpotifyHandler.session())
+			self.spotify.prefix = api_url
+		else:
+			log.debug(f'Creating real API object')
+			self.spotify = spotipy.Spotify(auth_manager=SpotifyOAuth(scope=self.scopes, 
+				client_id=credentials['spotify_client_id'], client_secret=credentials['spotify_secret'], redirect_uri=credentials['spotify_redirect_uri']),
+				requests_timeout=timeout, requests_session=SpotifyHandler.session())
 		self.playlist = None
 
+	@staticmethod
+	def session() -> requests.Session:
+		# AsyncSpotify does the retrying. spotipy's own session retries 429s and 5xxs
+		# even with retries=0 and then reports a bare 429, losing the real status and
+		# its Retry-After; a plain session hands back spotify's response as it is
+		return requests.Session()
+
+	def authenticate(self) -> None:
+		# fetch (or refresh) the access token now rather than on the first call
+		if self.spotify.auth_manager is not None:
+			self.spotify.auth_manager.get_access_token(as_dict=False)
+
 	def get_track_info(self, urls):
 		return self.spotify.tracks(urls)
 
@@ -18,13 +42,16 @@ class SpotifyHandler:
 		log.info(f'Setting playlist ID to {playlist}')
 		self.playlist = playlist
 
-	def get_playlist(self) -> str:
-		return 'https://open.spotify.com/playlist/' + str(self.playlist)
+	def get_playlist(self, playlist: str = None) -> str:
+		if playlist is None:
+			playlist = self.playlist
+		return 'https://open.spotify.com/playlist/' + str(playlist)
 
-	def add(self, tracks: str) -> None:
-		playlist = self.playlist
+	def add(self, tracks: list[str], playlist: str = None) -> None:
+		if playlist is None:
+			playlist = self.playlist
 		log.info(f'Adding {tracks} to playlist {playlist}')
-		self.spotify.playlist_add_items(self.playlist, [tracks])
+		self.spotify.playlist_add_items(playlist, tracks)
 
 	def remove(self, tracks: str, playlist: str = None) -> None:
 		if playlist is None:
@@ -32,6 +59,13 @@ class SpotifyHandler:
 		log.info(f'Setting removing {tracks} from playlist {playlist}')
 		self.spotify.playlist_remove_all_occurrences_of_items(playlist, tracks)
 
+	def get_playlist_state(self, playlist: str) -> dict:
+		# the snapshot_id and the first page of tracks in a single request
+		return self.spotify.playlist(playlist, fields=f'snapshot_id,tracks(total,{self.item_fields})')
+
+	def get_playlist_items(self, playlist: str, offset: int = 0) -> dict:
+		return self.spotify.playlist_items(playlist, fields=self.item_fields, limit=100, offset=offset)
+
 	def new_playlist(self, playlist_name: str = None, playlist_desc: str = None) -> str:
 		if playlist_name is None:
 			playlist_name = 'New spotipy playlist'
@@ -48,33 +82,202 @@ class Dummy:
 		log.debug(f'Creating dummy object')
 		pass
 
+	def authenticate(self) -> None:
+		pass
+
 	def set_playlist(self, playlist) -> None:
 		log.info(f'Setting playlist ID to {playlist}')
 		pass
 
-	def get_playlist(self) -> str:
+	def get_playlist(self, playlist: str = None) -> str:
 		return 'http://localhost:5000'
 
-	def add(self, tracks: str) -> None:
-		log.info(f'Adding {tracks} to playlist')
+	def add(self, tracks: list[str], playlist: str = None) -> None:
+		log.info(f'Adding {tracks} to playlist {playlist}')
 		pass
 
-	def remove_by_name(self, tracks: str, playlist: str = None) -> None:
+	def remove(self, tracks: str, playlist: str = None) -> None:
 		log.info(f'Setting removing {tracks} from playlist {playlist}')
 		pass
 
+	def get_playlist_state(self, playlist: str) -> dict:
+		# no snapshot, so there is never anything to sync
+		return {'snapshot_id': None, 'tracks': {'total': 0, 'items': []}}
+
+	def get_playlist_items(self, playlist: str, offset: int = 0) -> dict:
+		return {'items': []}
+
 	def new_playlist(self, playlist_name: str = None, playlist_desc: str = None) -> str:
 		log.info(f'Creating new playlist named {playlist_name} with description {playlist_desc}')
 		return ''
 
 	def get_track_info(self, urls):
-		thislen = len(urls)
-		return thislen * ['Artist',], thislen * ['Track',]
+		# same shape as spotipy's tracks()
+		return {'tracks': [{'name': 'Track', 'artists': [{'name': 'Artist'}],
+			'external_urls': {'spotify': 'https://open.spotify.com/track/' + str(url).split('/')[-1].split(':')[-1]},
+			'album': {'images': [{'url': 'http://localhost:5000'}]}} for url in urls]}
+
+
+class CircuitOpen(Exception):
+	pass
+
+# trips after `threshold` consecutive failures and rejects calls for
+# `reset_after` seconds, then lets a single trial call through
+class CircuitBreaker:
+	def __init__(self, threshold: int = 5, reset_after: float = 60.0) -> None:
+		self.threshold = threshold
+		self.reset_after = reset_after
+		self.failures: int = 0
+		self.opened_at: Optional[float] = None
+		self.trial = False
+
+	@property
+	def state(self) -> str:
+		if self.opened_at is None:
+			return 'closed'
+		return 'half-open' if self.retry_in() == 0 else 'open'
+
+	def retry_in(self) -> float:
+		if self.opened_at is None:
+			return 0.0
+		return max(0.0, self.opened_at + self.reset_after - time.monotonic())
+
+	def allow(self) -> bool:
+		if self.opened_at is None:
+			return True
+		if self.retry_in() > 0 or self.trial:
+			return False
+		self.trial = True
+		return True
+
+	def success(self) -> None:
+		if self.opened_at is not None:
+			log.warning('Spotify circuit breaker closed')
+		self.failures = 0
+		self.opened_at = None
+		self.trial = False
+
+	def failure(self) -> None:
+		self.failures += 1
+		self.trial = False
+		if self.failures >= self.threshold:
+			if self.opened_at is None:
+				log.error(f'Spotify circuit breaker opened after {self.failures} failures')
+			self.opened_at = time.monotonic()
+
+# runs the blocking spotipy calls on a small thread pool so a slow
+# response never stalls the discord event loop. transient failures are
+# retried with jittered exponential backoff (or Retry-After, if given)
+# until the per-call retry budget runs out. calls that aren't idempotent
+# are only retried when spotify can't have acted on them (a 429).
+class AsyncSpotify:
+	def __init__(self, handler: [SpotifyHandler, Dummy], max_workers: int = 4, timeout: float = 10.0,
+			retries: int = 4, retry_budget: float = 30.0, backoff: float = 0.5, breaker: Optional[CircuitBreaker] = None) -> None:
+		self.handler = handler
+		self.timeout = timeout
+		self.retries = retries
+		self.retry_budget = retry_budget
+		self.backoff = backoff
+		self.breaker = CircuitBreaker() if breaker is None else breaker
+		self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='spotify')
+		self.slots = asyncio.Semaphore(max_workers)
+
+	async def call(self, func, *args, idempotent: bool = True, **kwargs):
+		deadline = time.monotonic() + self.retry_budget
+		for attempt in range(self.retries + 1):
+			if not self.breaker.allow():
+				raise CircuitOpen(f'Spotify calls suspended for another {self.breaker.retry_in():.0f}s')
+			try:
+				result = await self.attempt(func, *args, **kwargs)
+			except Exception as e:
+				spotify_errors.inc(func.__name__, str(getattr(e, 'http_status', None) or type(e).__name__))
+				if not AsyncSpotify.is_transient(e):
+					self.breaker.success() # spotify answered, it just didn't like the request
+					raise
+				self.breaker.failure()
+				delay = self.delay(e, attempt)
+				if attempt == self.retries or time.monotonic() + delay > deadline:
+					raise
+				if not idempotent and not AsyncSpotify.is_unsent(e):
+					raise # it may have landed, leave it to the caller to check
+				log.warning(f'{func.__name__} failed ({e!r}), retrying in {delay:.1f}s')
+				await asyncio.sleep(delay)
+			else:
+				self.breaker.success()
+				return result
+
+	async def attempt(self, func, *args, **kwargs):
+		# only time the call itself, not the wait for a free worker
+		async with self.slots:
+			loop = asyncio.get_running_loop()
+			start = time.perf_counter()
+			try:
+				return await asyncio.wait_for(loop.run_in_executor(self.pool, functools.partial(func, *args, **kwargs)), self.timeout)
+			finally:
+				spotify_calls.observe(time.perf_counter() - start, func.__name__)
+
+	def delay(self, e: Exception, attempt: int) -> float:
+		retry_after = getattr(e, 'headers', None) and e.headers.get('Retry-After')
+		if retry_after:
+			return float(retry_after) + random.uniform(0, self.backoff)
+		return random.uniform(0, self.backoff * 2**attempt)
+
+	@staticmethod
+	def is_transient(e: Exception) -> bool:
+		if isinstance(e, spotipy.SpotifyException):
+			return e.http_status == 429 or (e.http_status or 0) >= 500
+		return isinstance(e, (CircuitOpen, asyncio.TimeoutError, requests.RequestException))
+
+	@staticmethod
+	def is_unsent(e: Exception) -> bool:
+		# failures that mean spotify never acted on the request
+		if isinstance(e, spotipy.SpotifyException):
+			return e.http_status == 429
+		return isinstance(e, (CircuitOpen, requests.ConnectTimeout))
+
+	def set_playlist(self, playlist) -> None:
+		self.handler.set_playlist(playlist)
+
+	def get_playlist(self, playlist: str = None) -> str:
+		return self.handler.get_playlist(playlist)
+
+	async def authenticate(self) -> None:
+		# a single attempt, startup shouldn't sit out the retry budget
+		await self.attempt(self.handler.authenticate)
+
+	async def get_track_info(self, urls):
+		return await self.call(self.handler.get_track_info, urls)
+
+	async def add(self, tracks: list[str], playlist: str = None) -> None:
+		# adding twice puts the track in the playlist twice
+		await self.call(self.handler.add, tracks, playlist, idempotent=False)
+
+	async def remove(self, tracks: str, playlist: str = None) -> None:
+		await self.call(self.handler.remove, tracks, playlist)
+
+	async def get_playlist_state(self, playlist: str) -> dict:
+		return await self.call(self.handler.get_playlist_state, playlist)
+
+	async def get_playlist_items(self, playlist: str, offset: int = 0) -> dict:
+		return await self.call(self.handler.get_playlist_items, playlist, offset)
+
+	async def get_playlist_uris(self, playlist: str) -> set[str]:
+		# every track URI in a playlist, with the pages after the first fetched together
+		first = (await self.get_playlist_state(playlist))['tracks']
+		pages = [first] + await asyncio.gather(*(self.get_playlist_items(playlist, offset)
+			for offset in range(len(first['items']), first['total'], 100)))
+		return set('spotify:track:' + item['track']['id'] for page in pages for item in page['items'] if (item.get('track') or {}).get('id'))
+
+	async def new_playlist(self, playlist_name: str = None, playlist_desc: str = None) -> str:
+		return await self.call(self.handler.new_playlist, playlist_name, playlist_desc)
 
+	def close(self) -> None:
+		self.pool.shutdown(wait=False, cancel_futures=True)
 
 class HandlerFactory:
-    def get_handler(self, use_spotify: bool, credentials: dict[str, str] = None) -> [SpotifyHandler, Dummy]:
+    def get_handler(self, use_spotify: bool, credentials: dict[str, str] = None, timeout: float = 10.0,
+                    api_url: Optional[str] = None) -> [SpotifyHandler, Dummy]:
         if use_spotify:
-            return SpotifyHandler(credentials)
+            return SpotifyHandler(credentials, timeout, api_url)
         else:
             return Dummy()
\ No newline at end of file
@@ -0,0 +1,69 @@
+from collections import OrderedDict
+from typing import Optional
+from JSONtools import atomic_write
+import logging, json, os
+log = logging.getLogger('tracks')
+
+# track metadata never changes for a given ID, so keep the bits the embeds
+# use in an LRU and only ask Spotify about the ones we haven't seen
+class TrackCache:
+    max_batch: int = 50 # spotify's limit per tracks() call
+
+    def __init__(self, sp, max_size: int = 2048, file_name: Optional[str] = None) -> None:
+        self.sp = sp
+        self.max_size = max_size
+        self.file = file_name
+        self.entries: OrderedDict[str, dict] = OrderedDict()
+        self.hits: int = 0
+        self.misses: int = 0
+        if self.file is not None and os.path.exists(self.file):
+            with open(self.file, 'r', encoding='utf-8') as cache_file:
+                self.entries.update(json.load(cache_file))
+            self.trim()
+            log.info(f'Loaded {len(self.entries)} cached tracks from {self.file}')
+
+    def stats(self) -> dict[str, float]:
+        lookups = self.hits + self.misses
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
+    async def get_tracks(self, track_ids: list[str]) -> list[Optional[dict]]:
+        missing = []
+        for track_id in track_ids:
+            if track_id in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(track_id)
+            else:
+                self.misses += 1
+                if track_id not in missing:
+                    missing.append(track_id)
+        for i in range(0, len(missing), self.max_batch):
+            chunk = missing[i:i + self.max_batch]
+            for track_id, data in zip(chunk, (await self.sp.get_track_info(chunk))['tracks']):
+                if data is not None:
+                    self.entries[track_id] = TrackCache.slim(data)
+        out = [self.entries.get(track_id) for track_id in track_ids]
+        self.trim()
+        return out
+
+    async def get_track_info(self, track_ids: list[str]) -> dict[str, list[Optional[dict]]]:
+        # same shape as spotipy's tracks() so callers can swap one for the other
+        return {'tracks': await self.get_tracks(track_ids)}
+
+    def trim(self) -> None:
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def save(self) -> None:
+        if self.file is None:
+            return
+        atomic_write(self.file, json.dumps(self.entries))
+        log.info(f'Saved {len(self.entries)} cached tracks to {self.file}')
+
+    @staticmethod
+    def slim(data: dict) -> dict:
+        # just the fields the embeds read, in the same layout spotipy returns
+        return {'name': data['name'],
+                'artists': [{'name': artist['name']} for artist in data['artists']],
+                'external_urls': {'spotify': data['external_urls']['spotify']},
+                'album': {'images': [{'url': image['url']} for image in data['album']['images'][:1]]}}
@@ -0,0 +1,50 @@
+from typing import Iterable, Optional
+from Metrics import user_fetches
+import discord
+import logging, asyncio, time
+log = logging.getLogger('users')
+
+# turns discord IDs into display names for the stats embeds, trying the
+# gateway caches first, then our own TTL cache, then the REST API
+class UserResolver:
+    def __init__(self, bot, ttl: float = 3600.0, concurrency: int = 5) -> None:
+        self.bot = bot
+        self.ttl = ttl
+        self.slots = asyncio.Semaphore(concurrency)
+        self.names: dict[int, tuple[Optional[str], float]] = {}
+        self.fetches: int = 0
+
+    async def display_names(self, uids: Iterable[int], guild: Optional[discord.Guild] = None) -> dict[int, Optional[str]]:
+        out = {}
+        missing = []
+        now = time.monotonic()
+        for uid in uids:
+            member = None if guild is None else guild.get_member(uid)
+            user = member or self.bot.get_user(uid)
+            if user is not None:
+                out[uid] = user.display_name
+                self.names[uid] = (user.display_name, now)
+            elif uid in self.names and now - self.names[uid][1] < self.ttl:
+                out[uid] = self.names[uid][0]
+            elif uid not in missing:
+                missing.append(uid)
+        # whatever is left costs one concurrent round of REST calls
+        for uid, name in zip(missing, await asyncio.gather(*(self.fetch(uid) for uid in missing))):
+            out[uid] = name
+            self.names[uid] = (name, now)
+        return out
+
+    async def display_name(self, uid: int, guild: Optional[discord.Guild] = None) -> Optional[str]:
+        return (await self.display_names([uid], guild))[uid]
+
+    async def fetch(self, uid: int) -> Optional[str]:
+        async with self.slots:
+            self.fetches += 1
+            user_fetches.inc()
+            try:
+                return (await self.bot.fetch_user(uid)).display_name
+            except discord.NotFound:
+                return None
+            except discord.HTTPException as e:
+                log.warning(f'Could not fetch user {uid}: {e}')
+                return None
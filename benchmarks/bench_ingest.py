@@ -0,0 +1,152 @@
+import logging, argparse, asyncio, datetime, json, os, random, string, sys, tempfile, time
+from types import SimpleNamespace
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ManagerPool import ManagerPool
+from FakeSpotify import FakeSpotify
+import cogs.PlaylistManagement as pm
+
+#--------------------------------------------------
+# Replays synthetic (or recorded) chat through PlaylistManagement.on_message
+# -> Manager.add_track -> parser.append_track without a Discord
+# connection, and reports throughput, per-stage latency and bytes written.
+#--------------------------------------------------
+parser = argparse.ArgumentParser(prog = 'bench_ingest.py', description='Benchmark the message ingest path.')
+parser.add_argument('-n', '--messages', type = int, help ='messages per run', default = 5000)
+parser.add_argument('--users', type = str, help ='comma separated user counts to sweep', default = '20')
+parser.add_argument('--month-sizes', type = str, help ='comma separated numbers of tracks already in the month', default = '0,1000,10000')
+parser.add_argument('--storage', type = str, choices = ['json', 'eventlog', 'sqlite'], default = 'json')
+parser.add_argument('--spotify', type = str, choices = ['dummy', 'fake'], help ='Dummy handler or the local FakeSpotify server', default = 'dummy')
+parser.add_argument('--latency', type = float, help ='FakeSpotify latency in seconds', default = 0.05)
+parser.add_argument('--link-rate', type = float, help ='fraction of messages with Spotify links', default = 0.3)
+parser.add_argument('--multi-rate', type = float, help ='fraction of link messages with several links', default = 0.1)
+parser.add_argument('--dup-rate', type = float, help ='fraction of links that were already posted', default = 0.1)
+parser.add_argument('--handoff-rate', type = float, help ='fraction of messages that are .s bot handoffs', default = 0.02)
+parser.add_argument('--recorded', type = str, help ='.jsonl of {"author": id, "content": str} to replay instead', default = None)
+parser.add_argument('--seed', type = int, default = 0)
+args = parser.parse_args()
+logging.basicConfig(level=logging.WARNING)
+
+WATCH = 1
+BASE62 = string.ascii_letters + string.digits
+WORDS = 'the a song is good lol anyone heard this new album today vibes mood listen tune'.split()
+
+def track_id(rng):
+    return ''.join(rng.choice(BASE62) for _ in range(22))
+
+def link(track):
+    return f'https://open.spotify.com/track/{track}?si={track[:8]}'
+
+def synthetic(n, users, rng):
+    posted = []
+    for _ in range(n):
+        author = rng.choice(users)
+        r = rng.random()
+        if r < args.handoff_rate:
+            # someone asks the other bot for a song, which then posts the link
+            yield author, f'{rng.choice(pm.spotify_bot_commands)} {rng.choice(WORDS)}'
+            track = track_id(rng)
+            posted.append(track)
+            yield pm.spotify_bot_ids[0], link(track)
+        elif r < args.handoff_rate + args.link_rate:
+            links = []
+            for _ in range(rng.randint(2, 4) if rng.random() < args.multi_rate else 1):
+                track = rng.choice(posted) if posted and rng.random() < args.dup_rate else track_id(rng)
+                posted.append(track)
+                links.append(link(track))
+            yield author, ' '.join(rng.choices(WORDS, k=3) + links)
+        else:
+            yield author, ' '.join(rng.choices(WORDS, k=rng.randint(2, 12)))
+
+def recorded(file_name):
+    with open(file_name, 'r', encoding='utf-8') as f:
+        for line in f:
+            msg = json.loads(line)
+            yield int(msg['author']), msg['content']
+
+def timed(stage, func, samples):
+    samples[stage] = []
+    async def wrapper(*a, **kw):
+        start = time.perf_counter()
+        try:
+            return await func(*a, **kw)
+        finally:
+            samples[stage].append(time.perf_counter() - start)
+    def sync_wrapper(*a, **kw):
+        start = time.perf_counter()
+        try:
+            return func(*a, **kw)
+        finally:
+            samples[stage].append(time.perf_counter() - start)
+    return wrapper if asyncio.iscoroutinefunction(func) else sync_wrapper
+
+def io_bytes():
+    # bytes this process has passed to write(), linux only
+    try:
+        with open('/proc/self/io') as f:
+            return int(dict(line.split(': ') for line in f.read().splitlines())['wchar'])
+    except (OSError, KeyError):
+        return 0
+
+def pct(values, q):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] * 1000
+
+async def run(n_users, month_size, fake):
+    rng = random.Random(args.seed)
+    users = [10**17 + i for i in range(n_users)]
+    config = {'watch_channel': WATCH, 'use_spotify': fake is not None, 'storage': args.storage,
+              'spotify_api_url': None if fake is None else fake.url, 'sqlite_file': 'playlist_data/bench.db',
+              'flush_interval': 10, 'flush_threshold': 25, 'fsync': True}
+    pool = ManagerPool(config, {}, reload = False)
+    await pool.start()
+    manager = await pool.acquire(WATCH)
+    for i in range(month_size):
+        manager.parser.append_track(rng.choice(users), track_id(rng))
+    manager.parser.flush()
+    bot = SimpleNamespace(config=config, managers=pool)
+    cog = pm.PlaylistManagement(bot)
+
+    samples = {}
+    manager.parser.append_track = timed('append_track', manager.parser.append_track, samples)
+    manager.add_track = timed('add_track', manager.add_track, samples)
+    on_message = timed('on_message', cog.on_message, samples)
+    stream = recorded(args.recorded) if args.recorded else synthetic(args.messages, users, rng)
+    messages = [SimpleNamespace(channel=SimpleNamespace(id=WATCH), author=SimpleNamespace(id=author), content=content,
+                                reference=None, created_at=datetime.datetime.now(datetime.timezone.utc))
+                for author, content in stream]
+
+    before = io_bytes()
+    start = time.perf_counter()
+    for message in messages:
+        await on_message(message)
+    ingest = time.perf_counter() - start
+    await manager.queue.drain()
+    total = time.perf_counter() - start
+    manager.parser.flush()
+    written = io_bytes() - before
+    await pool.shutdown()
+
+    print(f'users={n_users:<5} month={month_size:<7} msgs={len(messages):<6} '
+          f'{len(messages) / ingest:9.0f} msg/s  drained in {total:6.2f}s  '
+          f'{written / 1e6:8.2f} MB written  last flush {manager.queue.flush_latency * 1000:.1f}ms')
+    for stage, values in samples.items():
+        print(f'    {stage:<16} n={len(values):<6} p50={pct(values, 0.5):8.3f}ms  p99={pct(values, 0.99):8.3f}ms')
+
+async def main():
+    fake = FakeSpotify(port=0, latency=args.latency).start() if args.spotify == 'fake' else None
+    cwd = os.getcwd()
+    for n_users in map(int, args.users.split(',')):
+        for month_size in map(int, args.month_sizes.split(',')):
+            with tempfile.TemporaryDirectory() as tmp:
+                os.chdir(tmp)
+                os.mkdir('playlist_data')
+                try:
+                    await run(n_users, month_size, fake)
+                finally:
+                    os.chdir(cwd)
+    if fake is not None:
+        fake.stop()
+
+asyncio.run(main())
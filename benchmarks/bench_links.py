@@ -0,0 +1,54 @@
+import argparse, os, random, string, sys, timeit
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from urlextract import URLExtract
+from LinkTools import LinkExtractor
+
+#--------------------------------------------------
+# Microbenchmark: the old URLExtract scan + substring filter + split('/')
+# parsing against LinkExtractor.scan, over a mix of plain chat, messages
+# with other URLs and messages with (possibly intl-prefixed) track links.
+#--------------------------------------------------
+parser = argparse.ArgumentParser(prog = 'bench_links.py', description='Compare Spotify link extractors.')
+parser.add_argument('-n', '--messages', type = int, help ='messages in the corpus', default = 10000)
+parser.add_argument('--link-rate', type = float, help ='fraction of messages with a track link', default = 0.1)
+parser.add_argument('--url-rate', type = float, help ='fraction of messages with some other URL', default = 0.05)
+parser.add_argument('-r', '--repeat', type = int, default = 5)
+args = parser.parse_args()
+
+rng = random.Random(0)
+WORDS = 'the a song is good lol anyone heard this new album today vibes mood listen tune'.split()
+BASE62 = string.ascii_letters + string.digits
+
+def message():
+    words = rng.choices(WORDS, k=rng.randint(2, 15))
+    r = rng.random()
+    if r < args.link_rate:
+        track = ''.join(rng.choice(BASE62) for _ in range(22))
+        prefix = rng.choice(['', '', 'intl-de/', 'intl-pt/'])
+        words.insert(rng.randrange(len(words)), f'https://open.spotify.com/{prefix}track/{track}?si=abcdef')
+    elif r < args.link_rate + args.url_rate:
+        words.append('https://www.youtube.com/watch?v=dQw4w9WgXcQ')
+    return ' '.join(words)
+
+corpus = [message() for _ in range(args.messages)]
+extractor = URLExtract()
+links = LinkExtractor()
+
+def old():
+    out = []
+    for text in corpus:
+        for url in extractor.gen_urls(text):
+            if 'open.spotify.com/track/' in url:
+                split = url.split('/')
+                track_id = split[split.index('track') + 1]
+                out.append(track_id.split('?')[0])
+    return out
+
+def new():
+    return [track_id for text in corpus for track_id, _ in links.scan(text)]
+
+found_old, found_new = old(), new()
+print(f'{len(corpus)} messages, old found {len(found_old)} links, new found {len(found_new)}')
+for name, func in [('URLExtract', old), ('LinkExtractor', new)]:
+    best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+    print(f'{name:<14} {best * 1000:9.2f} ms  {best / len(corpus) * 1e6:8.2f} us/message')
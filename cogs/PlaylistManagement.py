@@ -1,18 +1,15 @@
-from discord.ext import commands, tasks
+from discord.ext import commands
 from discord import app_commands
 import discord
-from urlextract import URLExtract
-import datetime, time, logging, queue
+from LinkTools import LinkExtractor
+from Metrics import messages_scanned, links_extracted, registry
+from Handoff import HandoffScheduler
+from typing import Optional
+import datetime, time, logging, asyncio
 
 log = logging.getLogger('playlist')
 
 utc = datetime.timezone.utc
-times = [
-    datetime.time(hour=8, tzinfo=utc),
-    datetime.time(hour=8, minute=15, tzinfo=utc),
-    datetime.time(hour=8, minute=30, tzinfo=utc),
-    datetime.time(hour=8, minute=30, tzinfo=utc),
-]
 
 # ids and commands for other bots who get spotify links
 # will wait 5 seconds and capture the first bot-posted spotify link
@@ -21,34 +18,46 @@ spotify_bot_ids = [356268235697553409, 128822128072982528]
 spotify_bot_commands = ['.s', '.spotify',]
 
 class PlaylistManagement(commands.Cog, name='Playlist management'):
+    backfill_page: int = 500 # messages per storage batch and progress update
+
     def __init__(self, bot):
         self.bot = bot
-        self.re = URLExtract()
-        self.check_for_playlist_update.start()
-        # handles the use of other bots
-        self.command_waiting = queue.SimpleQueue() # queue the IDs of users waiting for bot
-        self.waiting_tasks = [] # holds task which will kill queue entry on timeout
+        self.links = LinkExtractor()
+        self.backfilling: set[int] = set() # channels with a backfill running
+        # handles the use of other bots: who is waiting for a link in which channel
+        self.handoffs = HandoffScheduler(timeout=5.0)
         log.info('Cog loaded')
 
     @app_commands.command(name='add', description='Add a Spotify track to the playlist')
     async def add(self, inter: discord.Interaction, spotify_url: str) -> None:
         '''Add a Spotify track to the playlist [slash command only]'''
-        if 'open.spotify.com/track/' in spotify_url:
-            track_added = self.bot.manager.add_to_playlist(inter.user.id, spotify_url)
+        # loading the channel and resolving a short link can take longer than discord's 3s to respond
+        await inter.response.defer(ephemeral=True)
+        manager = await self.bot.managers.for_context(inter)
+        if manager is None:
+            await inter.followup.send('No playlist is set up for this server!', ephemeral=True)
+            return
+        track_ids = await self.links.track_ids(spotify_url)
+        if track_ids:
+            track_added = await manager.add_track(inter.user.id, track_ids[0], inter.created_at.timestamp())
             if track_added:
-                await inter.response.send_message('Track added!', ephemeral=True)
+                await inter.followup.send('Track added!', ephemeral=True)
             else:
-                await inter.response.send_message("Track not added: it's already in the playlist!", ephemeral=True)
+                await inter.followup.send("Track not added: it's already in the playlist!", ephemeral=True)
         else:
-            await inter.response.send_message('Unrecognized link! Please provide a Spotify track URL.', ephemeral=True)
+            await inter.followup.send('Unrecognized link! Please provide a Spotify track URL.', ephemeral=True)
 
     @commands.command(name='new_playlist', description='Switch to a new playlist')
     @commands.is_owner()
     async def new_playlist(self, ctx: commands.Context, spotify_url: str = None) -> None:
         '''Force the bot to create/swap to a new playlist **[stellar only]**'''
+        manager = await self.bot.managers.for_context(ctx)
+        if manager is None:
+            await ctx.reply('No playlist is set up for this server!', ephemeral=True)
+            return
         if spotify_url is None:
-            self.bot.manager.swap_to_new_playlist()
-            await ctx.reply(f'New playlist created, check it out: {self.bot.manager.get_playlist_link()}', ephemeral=True)
+            await manager.swap_to_new_playlist()
+            await ctx.reply(f'New playlist created, check it out: {manager.get_playlist_link()}', ephemeral=True)
             return
         # try to load in the provided URL: get the playlist ID from it
         split = spotify_url.split('/')
@@ -63,74 +72,168 @@ class PlaylistManagement(commands.Cog, name='Playlist management'):
             playlist_id = playlist_id[:qidx]
         except ValueError:
             pass
-        self.bot.manager.create_json_from_existing_playlist(playlist_id)
-        await ctx.reply(f'Playlist loaded: {self.bot.manager.get_playlist_link()}', ephemeral=True)
+        await manager.create_json_from_existing_playlist(playlist_id)
+        await ctx.reply(f'Playlist loaded: {manager.get_playlist_link()}', ephemeral=True)
+
+    @commands.command(name='reconcile', description='Sync the playlist record with Spotify')
+    @commands.is_owner()
+    async def reconcile(self, ctx: commands.Context) -> None:
+        '''Pick up tracks added or removed on Spotify itself **[stellar only]**'''
+        manager = await self.bot.managers.for_context(ctx)
+        if manager is None:
+            await ctx.reply('No playlist is set up for this server!', ephemeral=True)
+            return
+        result = await manager.sync()
+        if result is None:
+            await ctx.reply('Playlist is unchanged since the last sync', ephemeral=True)
+        else:
+            await ctx.reply(f'Synced with Spotify: {result[0]} tracks added, {result[1]} removed', ephemeral=True)
+
+    @commands.command(name='remove', description='Remove tracks from the playlist')
+    @commands.is_owner()
+    async def remove(self, ctx: commands.Context, *spotify_urls: str) -> None:
+        '''Remove tracks from the playlist and its record **[stellar only]**'''
+        manager = await self.bot.managers.for_context(ctx)
+        if manager is None:
+            await ctx.reply('No playlist is set up for this server!', ephemeral=True)
+            return
+        removed = await manager.remove_from_playlist(spotify_urls)
+        await ctx.reply(f'Removed {len(removed)} of {len(spotify_urls)} tracks', ephemeral=True)
+
+    @commands.command(name='queue', description='Show the Spotify add queue')
+    @commands.is_owner()
+    async def queue_stats(self, ctx: commands.Context) -> None:
+        '''Show the state of the Spotify add queue **[stellar only]**'''
+        pool = self.bot.managers
+        stats = pool.queue.stats()
+        await ctx.reply(f"{stats['depth']} queued, {stats['spooled']} held, {stats['sent']} sent in {stats['batches']} batches, "
+                        f"{stats['failed']} failed, last flush took {stats['flush_latency']:.2f}s, "
+                        f"Spotify breaker {pool.sp.breaker.state}, {len(pool.managers)}/{len(pool.mappings)} channels loaded, "
+                        f"{len(self.handoffs)} waiting on other bots", ephemeral=True)
+
+    @commands.command(name='backfill', description='Add links posted while the bot was away')
+    @commands.is_owner()
+    async def backfill(self, ctx: commands.Context, after: Optional[int] = None) -> None:
+        '''Add links posted after a message ID, or since the last backfill or start of the playlist **[stellar only]**'''
+        manager = await self.bot.managers.for_context(ctx)
+        if manager is None:
+            await ctx.reply('No playlist is set up for this server!', ephemeral=True)
+            return
+        channel_id = manager.mapping.channel
+        if channel_id in self.backfilling:
+            await ctx.reply('A backfill is already running for that channel', ephemeral=True)
+            return
+        channel = self.bot.get_channel(channel_id) or await self.bot.fetch_channel(channel_id)
+        # pick up where the last backfill of this playlist stopped
+        after = after or manager.read_checkpoint()
+        start = discord.Object(id=after) if after is not None else datetime.datetime.fromtimestamp(manager.parser.creation_time, utc)
+        self.backfilling.add(channel_id)
+        progress = await ctx.reply(f'Backfilling {channel.mention}...')
+        began = time.perf_counter()
+        scanned = found = added = 0
+        handoffs = HandoffScheduler(timeout=5.0) # replayed on message times, carried across pages
+        try:
+            page = []
+            async for message in channel.history(limit=None, after=start, oldest_first=True):
+                page.append(message)
+                if len(page) < self.backfill_page:
+                    continue
+                rows = await self.backfill_rows(page, handoffs)
+                added += len(await manager.add_tracks(rows))
+                manager.write_checkpoint(page[-1].id)
+                scanned, found, page = scanned + len(page), found + len(rows), []
+                await progress.edit(content=f'Backfilling {channel.mention}: {scanned} messages, {found} links, {added} new tracks...')
+            if page:
+                rows = await self.backfill_rows(page, handoffs)
+                added += len(await manager.add_tracks(rows))
+                manager.write_checkpoint(page[-1].id)
+                scanned, found = scanned + len(page), found + len(rows)
+        finally:
+            self.backfilling.discard(channel_id)
+        await manager.queue.drain(manager.parser.get_playlist())
+        await progress.edit(content=f'Backfilled {channel.mention}: {scanned} messages, {found} links, '
+                                    f'{added} new tracks in {time.perf_counter() - began:.1f}s')
+
+    async def backfill_rows(self, page, handoffs):
+        # the same link extraction and bot handoff as on_message, timed by the messages themselves
+        messages_scanned.inc(n=len(page))
+        found = await asyncio.gather(*(self.links.track_ids(message.content) for message in page))
+        rows = []
+        for message, track_ids in zip(page, found):
+            when = message.created_at.timestamp()
+            if message.content.split(' ')[0] in spotify_bot_commands:
+                handoffs.expect(message.channel.id, message.author.id, now=when)
+                continue
+            links_extracted.inc(n=len(track_ids))
+            if not track_ids:
+                continue
+            logged_id = self.poster(message, handoffs, now=when)
+            rows += [(logged_id, track_id, int(when)) for track_id in track_ids]
+        return rows
+
+    @staticmethod
+    def poster(message, handoffs, now = None):
+        # who a message's links belong to: for another bot's link, whoever asked
+        # for it (the command it replied to, if it did), else the author
+        if message.author.id not in spotify_bot_ids:
+            return message.author.id
+        ref = None if message.reference is None else message.reference.resolved
+        asked = handoffs.claim(message.channel.id, ref.author.id if isinstance(ref, discord.Message) else None, now=now)
+        if asked is None:
+            return message.author.id
+        log.info(f'Tracks from bot ID {message.author.id} assigned to {asked}')
+        return asked
+
+    @commands.command(name='metrics', description='Show the bot metrics')
+    @commands.is_owner()
+    async def metrics(self, ctx: commands.Context) -> None:
+        '''Show counters and latencies since startup **[stellar only]**'''
+        text = '\n'.join(registry.summary())
+        if len(text) > 1900:
+            text = text[:1900].rsplit('\n', 1)[0] + '\n...'
+        await ctx.reply(f'```\n{text}\n```', ephemeral=True)
 
     @commands.hybrid_command(name="playlist", description='Get the current playlist', aliases=['p','pl'])
     async def get_playlist(self, ctx: commands.Context[commands.Bot]) -> None:
         '''Get the current playlist'''
-        await ctx.reply(f'Current playlist URL: {self.bot.manager.get_playlist_link()}', ephemeral=(ctx.prefix == '/'))
+        manager = await self.bot.managers.for_context(ctx)
+        if manager is None:
+            await ctx.reply('No playlist is set up for this server!', ephemeral=(ctx.prefix == '/'))
+            return
+        await ctx.reply(f'Current playlist URL: {manager.get_playlist_link()}', ephemeral=(ctx.prefix == '/'))
 
     @commands.Cog.listener()
     async def on_message(self, message):
         channel = message.channel
-        if channel.id == self.bot.config['watch_channel']:
+        if self.bot.managers.watches(channel.id):
             if message.content.split(' ')[0] in spotify_bot_commands:
-                self.command_waiting.put(message.author.id)
-                self.start_waiting()
+                self.handoffs.expect(channel.id, message.author.id)
                 return # ignore commands for other bots
-            i = 0
-            for url in self.re.gen_urls(message.content):
-                if 'open.spotify.com/track/' in url:
-                    if (message.author.id in spotify_bot_ids) and (not self.command_waiting.empty()):
-                        self.waiting_tasks[0].cancel()
-                        logged_id = self.command_waiting.get_nowait()
-                        log.info(f'Track {url} assigned to {logged_id} rather than bot ID {message.author.id}')
-                    else:
-                        logged_id = message.author.id
-                    track_added = self.bot.manager.add_to_playlist(logged_id, url)
-                    # can do something with this bool if needed
-
-    @tasks.loop(time=times)
-    async def check_for_playlist_update(self):
-        creation_time = self.bot.manager.parser.creation_time
-        current_time = int(time.time())
-        ndays = 20
-        delta = (current_time - creation_time)//86400
-        if datetime.datetime.now().day != 1:
-            log.debug("Check for playlist update loop ran but it's not the first")
-        elif delta < ndays:
-            log.debug(f"It's been {delta} days since the last playlist so a new one is not yet created")
-        else:
-            channel = await self.bot.fetch_channel(self.bot.config['watch_channel'])
-            oldlink = self.bot.manager.get_playlist_link()
-            self.bot.manager.swap_to_new_playlist()
-            newlink = self.bot.manager.get_playlist_link()
-            await channel.send(f'🎉 **NEW PLAYLIST TIME!!!** Check out the old one [here](<{oldlink}>), new songs will be added to {newlink}')
-
-    def start_waiting(self): # spawns a task which monitors for timeouts
-        new_task = tasks.loop(seconds=5, count=1)(self.wait_to_pop_queue)
-        new_task.after_loop(self.clear_waiting)
-        new_task.start()
-        self.waiting_tasks.append(new_task)
-
-    async def wait_to_pop_queue(self):
-        # this runs immediately as a spotify command is called
-        log.debug(f'Waiting for other bot, queue length = {self.command_waiting.qsize()}, {len(self.waiting_tasks)} tasks pending')
-
-    async def clear_waiting(self): 
-        # don't pop if we successfully popped above
-        if self.waiting_tasks[0].is_being_cancelled():
-            log.info('Timeout canceled, link found')
-            del self.waiting_tasks[0]
-            return
-        # remove from the queue if we timeout waiting for a bot request
-        if not self.command_waiting.empty():
-            deleting = self.command_waiting.get_nowait()
-            log.warning(f'Timeout, {deleting} from queue')
-        else:
-            log.error('Timeout requested but queue empty')
-        del self.waiting_tasks[0]
+            messages_scanned.inc()
+            track_ids = await self.links.track_ids(message.content)
+            links_extracted.inc(n=len(track_ids))
+            if not track_ids:
+                return # don't load a channel's playlist just for chatter
+            manager = await self.bot.managers.acquire(channel.id)
+            # one bot message answers one command, however many links it has
+            logged_id = self.poster(message, self.handoffs)
+            for track_id in track_ids:
+                track_added = await manager.add_track(logged_id, track_id, message.created_at.timestamp())
+                # can do something with this bool if needed
+
+    async def cog_load(self):
+        self.handoffs.start()
+        # the pool rolls each channel over to a new playlist at the start of the month
+        self.bot.managers.on_rollover = self.announce_rollover
+
+    async def cog_unload(self):
+        self.handoffs.stop()
+        self.bot.managers.on_rollover = None
+        await self.links.close()
+
+    async def announce_rollover(self, manager, old_link):
+        channel = await self.bot.fetch_channel(manager.mapping.channel)
+        await channel.send(f'🎉 **NEW PLAYLIST TIME!!!** Check out the old one [here](<{old_link}>), new songs will be added to {manager.get_playlist_link()}')
 
 async def setup(bot):
     await bot.add_cog(PlaylistManagement(bot))
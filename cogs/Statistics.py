@@ -1,6 +1,10 @@
 from discord.ext import commands
+from typing import Literal
+from collections import OrderedDict
+from Sampling import SampleSession
+from RenderCache import RenderCache
 import discord
-import logging, random, datetime
+import logging, datetime, asyncio, time
 
 log = logging.getLogger('stats')
 
@@ -11,121 +15,267 @@ def escape_markdown(text):
         text = text.replace(char, "\\"+char)
     return text
 
+def months_ago(months):
+    # start of the calendar month (UTC) months-1 before this one, None for all time
+    if months is None:
+        return None
+    now = datetime.datetime.now(datetime.timezone.utc)
+    month = now.year * 12 + now.month - months
+    return int(datetime.datetime(month // 12, month % 12 + 1, 1, tzinfo=datetime.timezone.utc).timestamp())
+
+HEAT = ' ░▒▓█'
+DAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+
 class Statistics(commands.Cog, name='Statistics'):
+    max_sessions: int = 256
+
     def __init__(self, bot):
         self.bot = bot
+        # per caller, channel and scope, so someone's random picks don't repeat until they've heard everything
+        self.sessions: OrderedDict[tuple, SampleSession] = OrderedDict()
+        # top-10 rows of the tables, shared between callers until the data changes
+        self.renders = RenderCache(ttl = self.bot.config.get('render_cache_ttl', 300.0))
         log.info('Cog loaded')
 
+    def session(self, key) -> SampleSession:
+        session = self.sessions.get(key)
+        if session is None:
+            session = self.sessions[key] = SampleSession()
+            if len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+        self.sessions.move_to_end(key)
+        return session
+
+    @staticmethod
+    def with_caller(rows, senderid):
+        # the shared rows, with the caller's own in bold if they made the cut
+        output = ''
+        found_user = False
+        for uid, thisline in rows:
+            if uid == senderid:
+                found_user = True
+                thisline = f'**{thisline}**'
+            output += thisline +'\n'
+        return output, found_user
+
     @commands.hybrid_command(name="lasttrack", description='Get the last track posted for each user (or someone in particular)', aliases=['lt'])
     async def lasttrack(self, ctx: commands.Context[commands.Bot], user: discord.User = None) -> None:
         '''Get the last track posted for each user (or someone in particular)'''
+        manager = await self.bot.managers.for_context(ctx)
+        if manager is None:
+            await ctx.reply('No playlist is set up for this server!', ephemeral=(ctx.prefix == '/'))
+            return
         # handle this easy case first
         if user is not None:
-            lasttime = self.bot.manager.parser.get_last_track_time(user.id)
-            lasttrack = self.bot.manager.parser.get_last_track_id(user.id)
+            lasttime = manager.parser.get_last_track_time(user.id)
+            lasttrack = manager.parser.get_last_track_id(user.id)
             if lasttrack is None:
                 embed = discord.Embed(title=f"Last track from {user.display_name}", description='No tracks found!',
-                                  url = self.bot.manager.get_playlist_link(), color=0x7289da)
+                                  url = manager.get_playlist_link(), color=0x7289da)
             else:
-                data = self.bot.manager.sp.get_track_info([lasttrack])['tracks'][0]
+                data = (await manager.track_cache.get_tracks([lasttrack]))[0]
                 outline = ''
                 # outline += escape_markdown(user.display_name)
                 # outline += f' added\n'
                 outline += f'[' + escape_markdown(data['artists'][0]['name']) + ' / ' + escape_markdown(data['name']) + f']({data["external_urls"]["spotify"]})'
                 outline += f', added <t:{lasttime}:R>'
                 embed = discord.Embed(title=f"Last track from {user.display_name}", description=outline,
-                                  url = self.bot.manager.get_playlist_link(), color=0x7289da)
+                                  url = manager.get_playlist_link(), color=0x7289da)
                 embed.set_thumbnail(url=data['album']['images'][0]['url'])
             await ctx.reply(embed=embed, ephemeral=(ctx.prefix == '/'))
             return
         # go into the meat of constructing the table
         senderid = ctx.author.id
-        times = self.bot.manager.parser.get_all_last_track_times()
-        urls = self.bot.manager.parser.get_all_last_track_ids()
-        srt = [(k, urls[k]) for k in sorted(times, key=times.get, reverse=True)]
-        big_urls = [t[1] for t in srt[:10]]
-        info = self.bot.manager.sp.get_track_info(big_urls)['tracks']
-        output = ''
-        found_user = False
-        for i, tup in enumerate(srt[:10]):
-            uid, url = tup
-            thisline = f'{i+1}.'
-            user = await self.bot.fetch_user(uid)
-            thisline += f'  '
-            thisline += '<@{uid}>' if user is None else escape_markdown(user.display_name)
-            thistrack = info[i]
-            thisline += f' — [' + escape_markdown(thistrack['artists'][0]['name']) + ' / ' + escape_markdown(thistrack['name']) + f']({thistrack["external_urls"]["spotify"]})'
-            if uid == senderid:
-                found_user = True
-                thisline = f'**{thisline}**'
-            output += thisline +'\n'
+        # display names are per guild, so renders are too
+        key = (manager.mapping.channel, 'lasttrack', getattr(ctx.guild, 'id', None))
+        # taken before any awaits, so a track added meanwhile makes this render stale
+        version = manager.version
+        cached = self.renders.get(key, version)
+        if cached is None:
+            rankings = manager.parser.rankings
+            srt = [(uid, track) for uid, track, _ in rankings.top_recent(10)]
+            big_urls = [t[1] for t in srt]
+            info, names = await asyncio.gather(manager.track_cache.get_tracks(big_urls),
+                                               self.bot.resolver.display_names([t[0] for t in srt], ctx.guild))
+            rows = []
+            for i, tup in enumerate(srt):
+                uid, url = tup
+                thisline = f'{i+1}.'
+                thisline += f'  '
+                thisline += f'<@{uid}>' if names[uid] is None else escape_markdown(names[uid])
+                thistrack = info[i]
+                thisline += f' — [' + escape_markdown(thistrack['artists'][0]['name']) + ' / ' + escape_markdown(thistrack['name']) + f']({thistrack["external_urls"]["spotify"]})'
+                rows.append((uid, thisline))
+            cached = (rows, rankings)
+            self.renders.put(key, version, cached)
+        rows, rankings = cached
+        output, found_user = self.with_caller(rows, senderid)
         if not found_user:
-            try:
-                user_idx = [s[0] for s in srt].index(senderid) + 1
-                thisurl = [urls[senderid],]
-                artists, tracks = self.bot.manager.sp.get_track_info(thisurl)
-                addl_text = escape_markdown(artists[0]) + ' / ' + escape_markdown(tracks[0])
-            except ValueError:
-                user_idx = len(srt) + 1
+            user_idx = rankings.recent_rank(senderid)
+            if user_idx is None:
+                user_idx = len(rankings) + 1
                 addl_text = 'No submissions!'
+            else:
+                thistrack = (await manager.track_cache.get_tracks([rankings.last[senderid][0]]))[0]
+                addl_text = escape_markdown(thistrack['artists'][0]['name']) + ' / ' + escape_markdown(thistrack['name'])
             output += f'**{user_idx}. {escape_markdown(ctx.author.display_name)} — {addl_text}**'
-        embed = discord.Embed(title=f"Songs of Sandyland", description=output, 
-                              timestamp = datetime.datetime.utcfromtimestamp(self.bot.manager.parser.creation_time), 
-                              url = self.bot.manager.get_playlist_link(), color=0x7289da)
+        embed = discord.Embed(title=f"Songs of {manager.mapping.title}", description=output, 
+                              timestamp = datetime.datetime.utcfromtimestamp(manager.parser.creation_time), 
+                              url = manager.get_playlist_link(), color=0x7289da)
         # embed.set_footer(text=f'{total_count} total tracks')
         await ctx.reply(embed=embed, ephemeral=(ctx.prefix == '/'))
 
     @commands.hybrid_command(name="leaderboard", description='See who has posted the most songs so far', aliases=['lb'])
-    async def leaderboard(self, ctx: commands.Context[commands.Bot]) -> None:
-        '''See who has posted the most songs so far'''
+    async def leaderboard(self, ctx: commands.Context[commands.Bot], scope: Literal['month', 'year', 'alltime'] = 'month') -> None:
+        '''See who has posted the most songs so far (this month, the last year or all time)'''
+        manager = await self.bot.managers.for_context(ctx)
+        if manager is None:
+            await ctx.reply('No playlist is set up for this server!', ephemeral=(ctx.prefix == '/'))
+            return
         senderid = ctx.author.id
-        counts = self.bot.manager.parser.get_all_track_counts()
-        total_count = sum(cts for cts in counts.values())
-        srt = [(k, counts[k]) for k in sorted(counts, key=counts.get, reverse=True)]
-        output = ''
-        found_user = False
-        for i, tup in enumerate(srt[:10]):
-            uid, playcount = tup
-            thisline = ''
-            if i == 0:
-                thisline +='👑'
+        key = (manager.mapping.channel, 'leaderboard', scope, getattr(ctx.guild, 'id', None))
+        version = manager.version
+        cached = self.renders.get(key, version)
+        if cached is None:
+            if scope == 'alltime':
+                rankings = manager.alltime_rankings()
+            elif scope == 'year':
+                rankings = manager.history_index().rankings(start=months_ago(12))
             else:
-                thisline += f'{i+1}.'
-            user = await self.bot.fetch_user(uid)
-            thisline += f'  '
-            thisline += '<@{uid}>' if user is None else escape_markdown(user.display_name)
-            thisline += f' — {playcount} tracks'
-            if uid == senderid:
-                found_user = True
-                thisline = f'**{thisline}**'
-            output += thisline +'\n'
+                rankings = manager.parser.rankings
+            srt = rankings.top_counts(10)
+            names = await self.bot.resolver.display_names([t[0] for t in srt], ctx.guild)
+            rows = []
+            for i, tup in enumerate(srt):
+                uid, playcount = tup
+                thisline = ''
+                if i == 0:
+                    thisline +='👑'
+                else:
+                    thisline += f'{i+1}.'
+                thisline += f'  '
+                thisline += f'<@{uid}>' if names[uid] is None else escape_markdown(names[uid])
+                thisline += f' — {playcount} tracks'
+                rows.append((uid, thisline))
+            cached = (rows, rankings)
+            self.renders.put(key, version, cached)
+        rows, rankings = cached
+        total_count = rankings.total
+        output, found_user = self.with_caller(rows, senderid)
         if not found_user:
-            try:
-                user_idx = [s[0] for s in srt].index(senderid) + 1
-                playcount = counts[senderid]
-            except ValueError:
-                user_idx = len(srt) + 1
+            user_idx = rankings.count_rank(senderid)
+            if user_idx is None:
+                user_idx = len(rankings) + 1
                 playcount = 0
+            else:
+                playcount = rankings.counts[senderid]
             output += f'**{user_idx}. {escape_markdown(ctx.author.display_name)} — {playcount} tracks**'
-        embed = discord.Embed(title=f"Songs of Sandyland", description=output, 
-                              timestamp = datetime.datetime.utcfromtimestamp(self.bot.manager.parser.creation_time), 
-                              url = self.bot.manager.get_playlist_link(), color=0x7289da)
+        embed = discord.Embed(title=f"Songs of {manager.mapping.title}", description=output, 
+                              timestamp = None if scope != 'month' else datetime.datetime.utcfromtimestamp(manager.parser.creation_time), 
+                              url = manager.get_playlist_link(), color=0x7289da)
         embed.set_footer(text=f'{total_count} total tracks')
         await ctx.reply(embed=embed, ephemeral=(ctx.prefix == '/'))
 
     @commands.hybrid_command(name="random", description='Get a random song from the playlist (optionally specifying a user)', aliases=['r'])
-    async def get_random_song(self, ctx: commands.Context[commands.Bot], user: discord.User = None) -> None:
-        '''Get a random song from the playlist (optionally specifying a user)'''
-        tracks = self.bot.manager.parser.get_all_tracks()
-        songbank = []
-        if user is None:
-            list(map(songbank.extend, tracks.values())) 
+    async def get_random_song(self, ctx: commands.Context[commands.Bot], user: discord.User = None, fair: bool = False,
+                              scope: Literal['month', 'alltime'] = 'month') -> None:
+        '''Get a random song from the playlist (optionally specifying a user, giving every user the same chance, or from all time)'''
+        manager = await self.bot.managers.for_context(ctx)
+        if manager is None:
+            await ctx.reply('No playlist is set up for this server!', ephemeral=(ctx.prefix == '/'))
+            return
+        if scope == 'alltime':
+            await ctx.defer(ephemeral=(ctx.prefix == '/'))
+            sampler = manager.history_sampler()
         else:
-            if user.id not in tracks:
-                await ctx.reply(f'No tracks found from {user.display_name}', ephemeral=(ctx.prefix == '/'))
-                return
-            songbank = tracks[user.id]
-        await ctx.reply(f'https://open.spotify.com/track/{random.choice(songbank)}', ephemeral=(ctx.prefix == '/'))
+            sampler = manager.parser.sampler
+        track_id = sampler.sample(None if user is None else user.id, fair, self.session((ctx.author.id, manager.mapping.channel, scope)))
+        if track_id is None:
+            await ctx.reply('No tracks found!' if user is None else f'No tracks found from {user.display_name}', ephemeral=(ctx.prefix == '/'))
+            return
+        await ctx.reply(f'https://open.spotify.com/track/{track_id}', ephemeral=(ctx.prefix == '/'))
+
+    @commands.hybrid_command(name="artists", description='See the most posted artists (optionally over the last few months)')
+    async def artists(self, ctx: commands.Context[commands.Bot], months: commands.Range[int, 1, 120] = None) -> None:
+        '''See the most posted artists (optionally over the last few months)'''
+        manager = await self.bot.managers.for_context(ctx)
+        if manager is None:
+            await ctx.reply('No playlist is set up for this server!', ephemeral=(ctx.prefix == '/'))
+            return
+        await ctx.defer(ephemeral=(ctx.prefix == '/'))
+        history = manager.history_index()
+        start = months_ago(months)
+        # artists are looked up once per track in the background and kept by the manager.
+        # a small history is done before the wait is up, a long one fills in over a few calls
+        missing = history.missing_artists(start)
+        if missing:
+            await asyncio.wait({manager.lookup_artists(missing)}, timeout=3.0)
+            missing = history.missing_artists(start)
+        output = ''
+        for i, (artist, count) in enumerate(history.top_artists(10, start)):
+            output += f'{i+1}.  {escape_markdown(artist)} — {count} tracks\n'
+        embed = discord.Embed(title=f"Top artists of {manager.mapping.title}", description=output or 'No tracks found!',
+                              url = manager.get_playlist_link(), color=0x7289da)
+        footer = 'All time' if months is None else f'Last {months} months'
+        if missing:
+            footer += f' (still looking up {len(missing)} tracks)'
+        embed.set_footer(text=footer)
+        await ctx.reply(embed=embed, ephemeral=(ctx.prefix == '/'))
+
+    @commands.hybrid_command(name="heatmap", description='See when songs get posted (optionally for one user)')
+    async def heatmap(self, ctx: commands.Context[commands.Bot], user: discord.User = None, months: commands.Range[int, 1, 120] = None) -> None:
+        '''See when songs get posted, by UTC weekday and hour (optionally for one user)'''
+        manager = await self.bot.managers.for_context(ctx)
+        if manager is None:
+            await ctx.reply('No playlist is set up for this server!', ephemeral=(ctx.prefix == '/'))
+            return
+        grid = manager.history_index().heatmap(None if user is None else user.id, months_ago(months))
+        peak = max(max(row) for row in grid) or 1
+        lines = ['    ' + ''.join(str(hour // 10) if hour % 6 == 0 else ' ' for hour in range(24)),
+                 '    ' + ''.join(str(hour % 10) if hour % 6 == 0 else ' ' for hour in range(24))]
+        for day, row in zip(DAYS, grid):
+            lines.append(day + ' ' + ''.join(HEAT[-(-count * (len(HEAT) - 1) // peak)] for count in row))
+        title = 'Posting times' if user is None else f'Posting times for {user.display_name}'
+        embed = discord.Embed(title=title, description='```\n' + '\n'.join(lines) + '\n```', color=0x7289da)
+        embed.set_footer(text=f'{sum(map(sum, grid))} tracks, UTC')
+        await ctx.reply(embed=embed, ephemeral=(ctx.prefix == '/'))
+
+    @commands.hybrid_command(name="streaks", description='See who has posted songs the most days in a row')
+    async def streaks(self, ctx: commands.Context[commands.Bot]) -> None:
+        '''See who has posted songs the most days in a row'''
+        manager = await self.bot.managers.for_context(ctx)
+        if manager is None:
+            await ctx.reply('No playlist is set up for this server!', ephemeral=(ctx.prefix == '/'))
+            return
+        history = manager.history_index()
+        now = int(time.time())
+        srt = history.streaks(now)[:10]
+        names = await self.bot.resolver.display_names([t[0] for t in srt], ctx.guild)
+        output = ''
+        for i, (uid, longest, current) in enumerate(srt):
+            thisline = f'{i+1}.  '
+            thisline += f'<@{uid}>' if names[uid] is None else escape_markdown(names[uid])
+            thisline += f' — {longest} days' + (f' ({current} ongoing)' if current else '')
+            if uid == ctx.author.id:
+                thisline = f'**{thisline}**'
+            output += thisline + '\n'
+        if ctx.author.id not in [t[0] for t in srt]:
+            longest, current = history.streak(ctx.author.id, now)
+            output += f'**{escape_markdown(ctx.author.display_name)} — {longest} days' + (f' ({current} ongoing)' if current else '') + '**'
+        embed = discord.Embed(title=f"Streaks of {manager.mapping.title}", description=output,
+                              url = manager.get_playlist_link(), color=0x7289da)
+        await ctx.reply(embed=embed, ephemeral=(ctx.prefix == '/'))
+
+    @commands.command(name='cache', description='Show track metadata and table render cache statistics')
+    @commands.is_owner()
+    async def cache_stats(self, ctx: commands.Context) -> None:
+        '''Show track metadata and table render cache statistics **[stellar only]**'''
+        stats = self.bot.managers.track_cache.stats()
+        renders = self.renders.stats()
+        await ctx.reply(f"{stats['size']} tracks cached, {stats['hits']} hits / {stats['misses']} misses "
+                        f"({stats['hit_rate']:.0%} hit rate)\n"
+                        f"{renders['size']} tables cached, {renders['hits']} hits / {renders['misses']} misses, "
+                        f"{renders['stale']} invalidated ({renders['hit_rate']:.0%} hit rate)", ephemeral=True)
 
 async def setup(bot):
     await bot.add_cog(Statistics(bot))
\ No newline at end of file
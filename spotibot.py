@@ -1,7 +1,9 @@
-import logging, argparse, json, time, asyncio, glob, os
+import logging, argparse, json, time, asyncio
 import discord
 from discord.ext import commands
-from Manager import Manager as man
+from ManagerPool import ManagerPool
+from UserResolver import UserResolver
+from Metrics import MetricsServer, command_times, command_errors
 from cogs.HelpCommand import HelpCommand
 #--------------------------------------------------
 # SETUP: load in config files, etc.
@@ -14,6 +16,9 @@ parser.add_argument('-c', '--config', type = str, help ='.json file with configu
 parser.add_argument('-v', '--verbose', action='count', default=0, dest='verbosity', help ='Set verbosity level (warning, info, debug)')
 parser.add_argument("--testing", action='store_true', help="Disable Spotify API calls")
 parser.add_argument('--reload', action=argparse.BooleanOptionalAction, default=True)
+parser.add_argument('--shards', type = str, help ='comma separated shard IDs to run in this process (needs --shard-count)', default = None)
+parser.add_argument('--shard-count', type = int, help ='total number of shards across all processes', default = None)
+parser.add_argument('--auto-shard', action='store_true', help='let discord.py pick the shard count and run every shard here')
 args = parser.parse_args()
 
 if args.testing:
@@ -25,6 +30,15 @@ verb = 0 if args.verbosity < 0 else 2 if args.verbosity > 2 else args.verbosity
 logging.basicConfig(level=[logging.WARNING, logging.INFO, logging.DEBUG][verb])
 logging.getLogger('SETUP').info(f'Log level set to {["WARNING", "INFO", "DEBUG"][verb]}')
 
+# time each startup phase, reported once the bot is ready
+startup = {}
+phase_start = time.perf_counter()
+def phase(name):
+    global phase_start
+    now = time.perf_counter()
+    startup[name] = now - phase_start
+    phase_start = now
+
 # load in API tokens
 with open(args.tokens) as f:
     tokens = json.load(f)
@@ -37,24 +51,37 @@ with open(args.config) as f:
 use_spotify = not (args.testing or not config['use_spotify']) 
 config['use_spotify'] = use_spotify
 logging.getLogger('SETUP').info('Using Spotify API' if use_spotify else 'Not using Spotify API')
+phase('config load')
 
-# see if we should grab the last playlist
-if args.reload:
-    list_of_files = glob.glob('playlist_data/*.json')
-    json_name = None if not len(list_of_files) else max(list_of_files, key=os.path.getctime)
-elif args.testing:
-    json_name = 'playlist_data/testing.json'
-else:
-    json_name = None
+# see if we should grab the last playlist: each channel's latest is picked up
+# when it is first used, unless --no-reload asks for a fresh one
+fallback_name = 'testing.json' if args.testing else None
 
 #--------------------------------------------------
 # BOT
 #--------------------------------------------------
 
 intents = discord.Intents(guild_messages=True, guilds=True, guild_reactions=True, message_content=True)
-bot = commands.Bot(command_prefix='!', intents=intents, owner_id=args.owner)
+if args.shards is not None:
+    # one of several processes, each running its own slice of the shards
+    if args.shard_count is None or not config.get('redis_url'):
+        parser.error('--shards needs --shard-count and a redis_url in the config for state shared between processes')
+    shard_ids = [int(shard) for shard in args.shards.split(',')]
+    bot = commands.AutoShardedBot(command_prefix='!', intents=intents, owner_id=args.owner,
+                                  shard_ids=shard_ids, shard_count=args.shard_count)
+    logging.getLogger('SETUP').info(f'Running shards {shard_ids} of {args.shard_count}')
+elif args.auto_shard:
+    shard_ids = None
+    bot = commands.AutoShardedBot(command_prefix='!', intents=intents, owner_id=args.owner)
+else:
+    shard_ids = None
+    bot = commands.Bot(command_prefix='!', intents=intents, owner_id=args.owner)
 bot.config = config
-bot.manager = man(config, tokens, json_name = json_name)
+bot.managers = ManagerPool(config, tokens, reload = args.reload, fallback_name = fallback_name,
+                           shard_ids = shard_ids, shard_count = args.shard_count or 1)
+startup.update(bot.managers.timings)
+phase_start = time.perf_counter()
+bot.resolver = UserResolver(bot, ttl = config.get('user_cache_ttl', 3600), concurrency = config.get('user_fetch_concurrency', 5))
 # manually add command which will sync the CommandTree
 @bot.command()
 @commands.is_owner()
@@ -64,16 +91,48 @@ async def sync(ctx: commands.Context) -> None:
     print(synced)
     await ctx.send(f"Synced {len(synced)} commands globally")
 
+# time every command from invoke to reply, failures included
+@bot.before_invoke
+async def start_timer(ctx: commands.Context) -> None:
+    ctx.started = time.perf_counter()
+
+@bot.after_invoke
+async def stop_timer(ctx: commands.Context) -> None:
+    command_times.observe(time.perf_counter() - ctx.started, ctx.command.qualified_name)
+
+@bot.event
+async def on_command_error(ctx: commands.Context, error: commands.CommandError) -> None:
+    if ctx.command is not None:
+        command_errors.inc(ctx.command.qualified_name)
+    if not isinstance(error, commands.CommandNotFound):
+        # this replaces discord.py's default handler, so keep its traceback
+        logging.getLogger('commands').error(f'{ctx.command} failed: {error!r}', exc_info=getattr(error, 'original', error))
+
 @bot.event
 async def on_ready():
     print('Ready!')
     bot.help_command = HelpCommand()
+    if 'login' not in startup: # on_ready fires again after reconnects
+        phase('login')
+        logging.getLogger('SETUP').warning('Startup: ' + ', '.join(f'{name} {secs * 1000:.0f}ms' for name, secs in startup.items())
+                                           + f', ready after {sum(startup.values()):.2f}s')
     
 
 async def main():
+    global phase_start
     async with bot:
+        await bot.managers.start()
+        startup['spotify auth'] = bot.managers.timings['spotify auth']
+        phase_start = time.perf_counter()
         await bot.load_extension("cogs.PlaylistManagement")
         await bot.load_extension("cogs.Statistics")
-        await bot.start(tokens['discord_token'])
+        phase('cog load')
+        metrics = None if config.get('metrics_port') is None else MetricsServer(config['metrics_port']).start()
+        try:
+            await bot.start(tokens['discord_token'])
+        finally:
+            await bot.managers.shutdown()
+            if metrics is not None:
+                metrics.stop()
 
 asyncio.run(main())
\ No newline at end of file
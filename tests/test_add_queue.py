@@ -0,0 +1,53 @@
+from FakeSpotify import FakeSpotify
+from SpotifyHandler import SpotifyHandler, AsyncSpotify
+from AddQueue import AddQueue
+import asyncio, time
+
+def test_timed_out_add_is_not_added_twice():
+    # the first add lands on the fake but answers too late, so it is spooled
+    fake = FakeSpotify(port=0, latency=0.5).start()
+    try:
+        handler = SpotifyHandler({}, timeout=5.0, api_url=fake.url)
+        sp = AsyncSpotify(handler, timeout=0.2, retries=3, backoff=0.01)
+        async def run():
+            queue = AddQueue(sp, window=0.01, replay_delay=60.0)
+            queue.put('pl', 'spotify:track:4uLU6hMCjMI75M1A2tKUQC')
+            queue.put('pl', 'spotify:track:7ouMYWpwJ422jRcDASZB7P')
+            await queue.drain()
+            assert len(queue.spool) == 2
+            await asyncio.sleep(0.5) # let the late request finish on the fake
+            fake.latency = 0.0
+            queue.replay()
+            await queue.drain()
+            queue.close()
+            return queue
+        queue = asyncio.run(run())
+        sp.close()
+        assert queue.sent == 2 and not queue.spool
+        assert fake.playlists['pl']['tracks'] == ['spotify:track:4uLU6hMCjMI75M1A2tKUQC', 'spotify:track:7ouMYWpwJ422jRcDASZB7P']
+        assert fake.requests['POST playlists'] == 1
+    finally:
+        fake.stop()
+
+class Recorder:
+    def __init__(self):
+        self.calls = []
+
+    async def add(self, uris, playlist):
+        self.calls.append(len(uris))
+
+def test_burst_goes_out_without_waiting_a_window_per_batch():
+    sp = Recorder()
+    async def run():
+        queue = AddQueue(sp, window=1.0, max_batch=100)
+        start = time.monotonic()
+        for i in range(250):
+            queue.put('pl', f'spotify:track:{i}')
+        await queue.drain()
+        elapsed = time.monotonic() - start
+        queue.close()
+        return elapsed
+    elapsed = asyncio.run(run())
+    # two full batches go at once, the last partial one waits out a single window
+    assert sp.calls == [100, 100, 50]
+    assert elapsed < 1.5
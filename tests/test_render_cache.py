@@ -0,0 +1,103 @@
+from RenderCache import RenderCache
+from ManagerPool import ManagerPool
+import asyncio, datetime
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+def test_hit_until_version_changes():
+    cache = RenderCache(clock=Clock())
+    cache.put(('lb', 1), 1, 'rows')
+    assert cache.get(('lb', 1), 1) == 'rows'
+    assert cache.get(('lb', 1), 2) is None # a new track bumped the version
+    assert cache.get(('lb', 1), 1) is None # and the old render is gone
+    assert cache.stats() == {'size': 0, 'hits': 1, 'misses': 2, 'stale': 1, 'hit_rate': 1 / 3}
+
+def test_renders_expire_after_ttl():
+    clock = Clock()
+    cache = RenderCache(ttl=300.0, clock=clock)
+    cache.put('lt', 1, 'rows')
+    clock.now = 299.0
+    assert cache.get('lt', 1) == 'rows'
+    clock.now = 300.0
+    assert cache.get('lt', 1) is None
+    assert cache.stale == 1
+
+def test_least_recently_used_is_evicted():
+    cache = RenderCache(max_size=2, clock=Clock())
+    cache.put('a', 1, 'a rows')
+    cache.put('b', 1, 'b rows')
+    assert cache.get('a', 1) == 'a rows' # now b is the oldest
+    cache.put('c', 1, 'c rows')
+    assert cache.get('b', 1) is None
+    assert cache.get('a', 1) == 'a rows' and cache.get('c', 1) == 'c rows'
+    # evicted entries are plain misses, not invalidations
+    assert cache.stats() == {'size': 2, 'hits': 3, 'misses': 1, 'stale': 0, 'hit_rate': 0.75}
+
+def test_put_replaces_older_render():
+    cache = RenderCache(clock=Clock())
+    cache.put('lb', 1, 'old rows')
+    cache.put('lb', 2, 'new rows')
+    assert cache.get('lb', 2) == 'new rows'
+    assert len(cache.entries) == 1
+
+# every write a table could show has to bump Manager.version, or the cache would serve old rows
+
+TRACK = '4uLU6hMCjMI75M1A2tKUQC'
+
+def rerenders(tmp_path, change, now=datetime.datetime(2026, 9, 15, tzinfo=datetime.timezone.utc).timestamp()):
+    # whether a render cached just before `change` (a coroutine fn taking the manager and clock) is stale after it
+    clock = Clock()
+    clock.now = now
+    config = {'use_spotify': False, 'channels': [{'channel': 1, 'data_dir': str(tmp_path)}]}
+    cache = RenderCache(clock=Clock())
+    async def run():
+        pool = ManagerPool(config, {}, clock=clock)
+        manager = await pool.acquire(1)
+        cache.put(('lb', 1), manager.version, 'rows')
+        await change(manager, clock)
+        fresh = cache.get(('lb', 1), manager.version) is None
+        await pool.shutdown()
+        pool.sp.close()
+        return fresh
+    return asyncio.run(run())
+
+def test_add_track_invalidates_renders(tmp_path):
+    async def change(manager, clock):
+        assert await manager.add_track(1, TRACK, clock())
+    assert rerenders(tmp_path, change)
+
+def test_rollback_invalidates_renders(tmp_path):
+    async def change(manager, clock):
+        await manager.add_track(1, TRACK, clock())
+        version = manager.version
+        manager.rollback(manager.parser, 1, TRACK)
+        assert manager.version != version
+    assert rerenders(tmp_path, change)
+
+def test_remove_invalidates_renders(tmp_path):
+    async def change(manager, clock):
+        await manager.add_track(1, TRACK, clock())
+        version = manager.version
+        assert await manager.remove_from_playlist([TRACK]) == [TRACK]
+        assert manager.version != version
+    assert rerenders(tmp_path, change)
+
+def test_new_playlist_invalidates_renders(tmp_path):
+    async def change(manager, clock):
+        await manager.swap_to_new_playlist()
+    assert rerenders(tmp_path, change)
+
+def test_rollover_invalidates_renders(tmp_path):
+    async def change(manager, clock):
+        file_name = manager.parser.file
+        await manager.tick(clock()) # next month is staged an hour ahead, which changes nothing yet
+        version = manager.version
+        clock.now += 1800
+        await manager.tick(clock())
+        assert manager.parser.file != file_name and manager.version != version
+    assert rerenders(tmp_path, change, now=datetime.datetime(2026, 9, 30, 23, 30, tzinfo=datetime.timezone.utc).timestamp())
@@ -0,0 +1,57 @@
+from ManagerPool import ManagerPool
+import asyncio, datetime, json, os
+
+def at(*date):
+    return datetime.datetime(*date, tzinfo=datetime.timezone.utc).timestamp()
+
+def write_month(path, creation_time):
+    with open(path, 'w', encoding='utf-8') as month_file:
+        json.dump({'playlist': 'pl', 'creation_time': int(creation_time)}, month_file)
+
+def load(data_dir, now, **kwargs):
+    config = {'use_spotify': False, 'channels': [{'channel': 1, 'data_dir': data_dir}]}
+    async def run():
+        pool = ManagerPool(config, {}, clock=lambda: now, **kwargs)
+        manager = await pool.acquire(1)
+        held = await manager.add_track(7, '4uLU6hMCjMI75M1A2tKUQC', now)
+        await manager.tick(now)
+        files = manager.parser.file, None if manager.previous is None else manager.previous.file
+        await pool.shutdown()
+        pool.sp.close()
+        return files, held, manager.held
+    return asyncio.run(run())
+
+def test_testing_playlist_from_an_earlier_month_stays_active(tmp_path):
+    data_dir = str(tmp_path)
+    write_month(os.path.join(data_dir, 'testing.json'), at(2026, 9, 15))
+    (active, previous), added, held = load(data_dir, at(2026, 10, 18), reload=False, fallback_name='testing.json')
+    assert active == os.path.join(data_dir, 'testing.json') and previous is None
+    assert added and not held
+    assert not os.path.exists(os.path.join(data_dir, '2026-10.json'))
+
+def test_reloaded_month_catches_up_on_a_missed_rollover(tmp_path):
+    data_dir = str(tmp_path)
+    write_month(os.path.join(data_dir, '2026-09.json'), at(2026, 9, 15))
+    (active, previous), added, held = load(data_dir, at(2026, 10, 18))
+    # september's grace period is long over, so it is retired straight away
+    assert active == os.path.join(data_dir, '2026-10.json') and previous is None
+    assert added and not held
+
+def test_backfill_rows_go_to_the_month_they_were_posted_in(tmp_path):
+    data_dir = str(tmp_path)
+    write_month(os.path.join(data_dir, '2026-09.json'), at(2026, 9, 1))
+    config = {'use_spotify': False, 'channels': [{'channel': 1, 'data_dir': data_dir}]}
+    rows = [(7, 'august', int(at(2026, 8, 20))), (7, 'september', int(at(2026, 9, 30, 23, 59))),
+            (8, 'october', int(at(2026, 10, 1, 0, 0, 30)))]
+    async def run():
+        # a minute past the boundary, so september is still open for adds in flight
+        pool = ManagerPool(config, {}, clock=lambda: at(2026, 10, 1, 0, 1))
+        manager = await pool.acquire(1)
+        added = await manager.add_tracks(rows)
+        months = {os.path.basename(parser.file): parser.get_track_ids() for parser in (manager.previous, manager.parser)}
+        await pool.shutdown()
+        pool.sp.close()
+        return added, months
+    added, months = asyncio.run(run())
+    assert added == rows[1:]
+    assert {name: list(tracks) for name, tracks in months.items()} == {'2026-09.json': ['september'], '2026-10.json': ['october']}
@@ -0,0 +1,28 @@
+from FakeSpotify import FakeSpotify
+from SpotifyHandler import SpotifyHandler, AsyncSpotify
+import spotipy, pytest, asyncio
+
+# a single failed call against a fake that always fails, to see the error AsyncSpotify gets
+def failed_call(**fake_args) -> tuple[spotipy.SpotifyException, AsyncSpotify]:
+    fake = FakeSpotify(port=0, **fake_args).start()
+    try:
+        handler = SpotifyHandler({}, timeout=5.0, api_url=fake.url)
+        sp = AsyncSpotify(handler, retries=0)
+        with pytest.raises(spotipy.SpotifyException) as info:
+            asyncio.run(sp.call(handler.get_track_info, ['4uLU6hMCjMI75M1A2tKUQC']))
+        sp.close()
+        return info.value, sp
+    finally:
+        fake.stop()
+
+def test_retry_after_sets_the_delay():
+    error, sp = failed_call(throttle_rate=1.0, retry_after=7)
+    assert error.http_status == 429
+    assert error.headers['Retry-After'] == '7'
+    assert 7.0 <= sp.delay(error, 0) <= 7.0 + sp.backoff
+
+def test_server_errors_keep_their_status():
+    error, sp = failed_call(error_rate=1.0)
+    assert error.http_status == 500
+    assert AsyncSpotify.is_transient(error)
+    assert sp.delay(error, 0) <= sp.backoff
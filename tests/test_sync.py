@@ -0,0 +1,33 @@
+from FakeSpotify import FakeSpotify
+from ManagerPool import ManagerPool
+import asyncio
+
+TRACKS = ['4uLU6hMCjMI75M1A2tKUQC', '7ouMYWpwJ422jRcDASZB7P']
+
+def attach(tmp_path, **config):
+    # attaches a spotify playlist that someone filled in by hand, returning the local record
+    fake = FakeSpotify(port=0).start()
+    fake.playlists['pl'] = {'id': 'pl', 'name': 'pl', 'tracks': ['spotify:track:' + track_id for track_id in TRACKS],
+                            'added': {}, 'version': 1}
+    config = {'use_spotify': True, 'spotify_api_url': fake.url, 'channels': [{'channel': 1, 'data_dir': str(tmp_path)}], **config}
+    async def run():
+        pool = ManagerPool(config, {})
+        manager = await pool.acquire(1)
+        await manager.create_json_from_existing_playlist('pl')
+        data = {uid: list(user['tracks']) for uid, user in manager.parser.data.items()}
+        await pool.shutdown()
+        pool.sp.close()
+        return data
+    try:
+        return asyncio.run(run())
+    finally:
+        fake.stop()
+
+def test_unmapped_spotify_adds_are_not_credited_to_anyone(tmp_path):
+    assert attach(tmp_path) == {}
+
+def test_spotify_adds_are_credited_through_the_user_mapping(tmp_path):
+    assert attach(tmp_path, spotify_users={'fake-user': 42}) == {42: TRACKS}
+
+def test_unmapped_spotify_adds_go_to_the_default_user(tmp_path):
+    assert attach(tmp_path, spotify_default_user=7) == {7: TRACKS}